@@ -0,0 +1,5 @@
+from src import create_app
+from src.asgi import create_asgi_app
+
+# Async serving mode: gunicorn -w 4 -k uvicorn.workers.UvicornWorker --keep-alive 30 asgi:app
+app = create_asgi_app(create_app())
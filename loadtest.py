@@ -0,0 +1,79 @@
+"""
+Concurrency load test for the read endpoints (needs httpx, a dev-only dependency).
+
+    python loadtest.py http://localhost:5555 /maps/get_all_maps_with_waypoints --token <jwt> -c 64 -n 2000
+
+Keeps `concurrency` requests in flight until `requests` have completed, then prints
+throughput and latency percentiles. Run it against the sync (app:app) and async
+(asgi:app) servers with the same worker count to compare them. Start the async server
+with ASYNC_IN_FLIGHT_HEADER=1 to also get the most requests each worker served at once,
+which a sync worker caps at its thread count.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+async def run(base_url, paths, total, concurrency, token=None):
+    headers = {'Accept-Encoding': 'gzip'}
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    latencies, statuses, peak_in_flight = [], {}, {}
+    remaining = iter(range(total))
+
+    async def worker(client):
+        for i in remaining:
+            path = paths[i % len(paths)]
+            started = time.perf_counter()
+            try:
+                response = await client.get(path)
+                await response.aread()
+                status = response.status_code
+                # X-In-Flight-Peak: <worker pid>:<peak>, see AsyncReadConfig.IN_FLIGHT_HEADER
+                pid, _, peak = response.headers.get('x-in-flight-peak', '').partition(':')
+                if peak:
+                    peak_in_flight[pid] = max(peak_in_flight.get(pid, 0), int(peak))
+            except httpx.TransportError as e:
+                # E.g. a kept-alive connection the server closed as it was reused
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 2),
+        "rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "statuses": statuses,
+        "peak_in_flight": peak_in_flight or "n/a",
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('base_url')
+    parser.add_argument('paths', nargs='+', help="Paths requested in turn, e.g. /maps/1 /maps/2")
+    parser.add_argument('-n', '--requests', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=32)
+    parser.add_argument('--token', help="JWT access token for the authenticated endpoints")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.base_url, args.paths, args.requests, args.concurrency, args.token))
+    for key, value in result.items():
+        print(f"{key:>10}: {value}")
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,59 @@
-from flask import Flask
-from src.config import SecretsConfig
+from flask import Flask, jsonify
+from src.config import SecretsConfig, UploadConfig
 from flask_cors import CORS
 from .extensions import db, jwt, migrate
+from .admission import init_admission
+from .compression import init_compression
+from .replicas import init_replicas
 from .auth.routes import auth_bp
-from .maps.routes import maps_bp
+from .maps.routes import autocomplete_bp, maps_bp, waypoints_bp
 from .users.routes import user_bp
+from .maps.commands import maps_cli
+from .maps.view_counts import init_view_counts
+from .maps.geocoder import init_geocoder
+from .maps.autocomplete import init_autocomplete
+from .soft_delete import init_soft_delete
 
 # Register DB models
 from .auth.models import User
-from .maps.models import Map, Waypoint, Rating
+from .maps.models import Map, Waypoint, Rating, MapChange, WaypointCell, WaypointCellMap
 
 def create_app():
     app = Flask(__name__)
     
     # Load configuration
     app.config.from_object(SecretsConfig)
+    app.config.from_object(UploadConfig)
 
     # Allow cross origin calls
     CORS(app)
 
+    # Compress JSON responses
+    init_compression(app)
+
     # Initialize extensions
     db.init_app(app)
     jwt.init_app(app)
     migrate.init_app(app, db)
 
+    # Rate limit clients and cap expensive requests in flight, ahead of any other work
+    init_admission(app)
+
+    # Route read-only requests to the read replicas, if any are configured
+    init_replicas(app)
+
+    # Buffer map views and write them behind in batches
+    init_view_counts(app)
+
+    # Hide deleted maps and accounts from every read and reject deleted accounts' tokens
+    init_soft_delete(app)
+
+    # Map the offline reverse geocoding index used to fill in waypoint cities and countries
+    init_geocoder(app)
+
+    # Keep the per-worker prefix indexes behind /autocomplete in step with the map change log
+    init_autocomplete(app)
+
     # Create the database tables if they don't exist
     with app.app_context():
         db.create_all()
@@ -31,6 +61,15 @@ def create_app():
     # Register blueprints
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(maps_bp, url_prefix='/maps')
+    app.register_blueprint(waypoints_bp, url_prefix='/waypoints')
     app.register_blueprint(user_bp, url_prefix='/users')
+    app.register_blueprint(autocomplete_bp, url_prefix='/autocomplete')
+
+    @app.errorhandler(413)
+    def request_too_large(error):
+        return jsonify({"error": f"Request body exceeds {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)}MB."}), 413
+
+    # Register CLI commands
+    app.cli.add_command(maps_cli)
 
     return app
\ No newline at end of file
@@ -0,0 +1,166 @@
+import fcntl
+import math
+import os
+import threading
+import time
+from flask import current_app, g, jsonify, request
+from .auth.identity import optional_user_id
+from .cache import LRUCache
+from .config import AdmissionConfig
+
+class TokenBucket:
+    """Allows `capacity` requests in a burst, refilled at `rate` per second."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        """Takes a token. Returns 0 when admitted, otherwise the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+def parse_rate_limits(limits):
+    """{"maps": "120/60"} -> {"maps": (rate per second, burst)}, i.e. 120 requests per 60 seconds."""
+    parsed = {}
+    for name, spec in limits.items():
+        count, seconds = spec.split('/')
+        parsed[name] = (int(count) / float(seconds), int(count))
+    return parsed
+
+class RateLimiter:
+    """
+    Per-worker token buckets keyed by client and by rule. Rules are looked up by endpoint
+    ("maps.get_all_maps_with_waypoints") first, then by blueprint ("maps"), so a hot
+    route can be limited more tightly than the rest of its blueprint.
+    """
+
+    def __init__(self, rules, max_clients=100000):
+        self.rules = rules
+        self._lock = threading.Lock()
+        # An evicted bucket was idle and starts over full, which is what it would have refilled to anyway
+        self._buckets = LRUCache(maxsize=max_clients)
+
+    def rule_for(self, endpoint, blueprint):
+        if endpoint in self.rules:
+            return endpoint
+        if blueprint in self.rules:
+            return blueprint
+        return None
+
+    def check(self, client, endpoint, blueprint):
+        """Returns 0 when the request is admitted, otherwise the seconds the client should wait."""
+        rule = self.rule_for(endpoint, blueprint)
+        if rule is None:
+            return 0
+        key = (rule, client)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(*self.rules[rule])
+                self._buckets.set(key, bucket)
+            return bucket.take()
+
+class ConcurrencySlots:
+    """
+    At most `limit` holders at a time across every worker process on the host.
+
+    Each slot is a lock file held with a non-blocking flock(), so a slot is released by
+    the kernel even if the worker holding it is killed. A per-slot thread lock keeps two
+    threads of the same worker from sharing a slot, since flock is per open file.
+    """
+
+    def __init__(self, name, limit, directory):
+        self.name = name
+        self.limit = limit
+        self.directory = directory
+        self._files = None
+        self._thread_locks = [threading.Lock() for _ in range(limit)]
+        self._open_lock = threading.Lock()
+
+    def _slot_files(self):
+        # Opened lazily so every forked worker has its own open files, and with them its own locks
+        with self._open_lock:
+            if self._files is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._files = [
+                    open(os.path.join(self.directory, f"{self.name}.{slot}.lock"), 'a+')
+                    for slot in range(self.limit)
+                ]
+            return self._files
+
+    def acquire(self):
+        """Returns the slot held, or None when all of them are taken."""
+        files = self._slot_files()
+        for slot in range(self.limit):
+            if not self._thread_locks[slot].acquire(blocking=False):
+                continue
+            try:
+                fcntl.flock(files[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                self._thread_locks[slot].release()
+        return None
+
+    def release(self, slot):
+        fcntl.flock(self._files[slot], fcntl.LOCK_UN)
+        self._thread_locks[slot].release()
+
+def client_key():
+    """The JWT user id for authenticated requests, the client IP otherwise."""
+    user_id = optional_user_id()
+    if user_id is not None:
+        return f"user:{user_id}"
+    route = request.access_route
+    hops = AdmissionConfig.PROXY_HOPS
+    ip = route[-hops] if hops and len(route) >= hops else request.remote_addr
+    return f"ip:{ip}"
+
+def _shed(status, message, retry_after):
+    response = jsonify({"error": message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def admit_request():
+    """before_request hook: rate limits the client, then claims a slot for expensive endpoints."""
+    if request.method == 'OPTIONS' or request.endpoint is None:
+        return None
+    admission = current_app.extensions['admission']
+
+    wait = admission['limiter'].check(client_key(), request.endpoint, request.blueprint)
+    if wait:
+        return _shed(429, "Too many requests, please retry later.", wait)
+
+    if request.endpoint in AdmissionConfig.EXPENSIVE_ENDPOINTS:
+        slots = admission['expensive_slots']
+        slot = slots.acquire()
+        if slot is None:
+            return _shed(503, "Server busy, please retry later.", AdmissionConfig.BUSY_RETRY_AFTER_SECONDS)
+        g.admission_slot = (slots, slot)
+    return None
+
+def release_request(error=None):
+    held = g.pop('admission_slot', None)
+    if held is not None:
+        slots, slot = held
+        slots.release(slot)
+
+def init_admission(app):
+    app.extensions['admission'] = {
+        'limiter': RateLimiter(parse_rate_limits(AdmissionConfig.RATE_LIMITS)),
+        'expensive_slots': ConcurrencySlots(
+            'expensive', AdmissionConfig.MAX_EXPENSIVE_IN_FLIGHT, AdmissionConfig.LOCK_DIRECTORY,
+        ),
+    }
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
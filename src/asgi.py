@@ -0,0 +1,372 @@
+import math
+import os
+from a2wsgi import WSGIMiddleware
+from flask_jwt_extended import decode_token
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import default_exceptions
+from werkzeug.http import parse_accept_header, parse_etags
+from .auth.models import User
+from .compression import StreamCompressor, compress, negotiate_encoding
+from .config import AdmissionConfig, AsyncReadConfig, CompressionConfig
+from .maps.filter_cache import FILTERED_PAGES, filtered_maps_cache, filtered_variant
+from .maps.filters import filter_maps, parse_page, parse_sort
+from .maps.geometry import (
+    PACKED_MIMETYPE, coordinates_statement, group_coordinates, pack_records, parse_geometry_params, polyline_payload,
+)
+from .maps.map_utils import parse_fields
+from .maps.models import Map, Waypoint
+from .maps.payload_cache import map_payload_cache, payload_variant, render_entry, split_entry
+from .maps.sql_json import maps_json_statement, sql_json_enabled
+from .maps.view_counts import creator_stats, view_counter
+from .soft_delete import token_of_deleted_user
+
+# Async serving mode for the read-only endpoints. The Starlette app answers the routes
+# below on an asyncpg engine, so a worker keeps many requests in flight while they wait
+# on Postgres, and hands every other request to the Flask app. Handlers use the same
+# models, serializers, filters and caches as the Flask path and keep its endpoint names
+# for rate limiting and for SQL_JSON_ENDPOINTS.
+
+class HTTPError(Exception):
+    def __init__(self, status, body=None, retry_after=None):
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+    def response(self):
+        if self.body is None:
+            # The werkzeug error page, as first_or_404() gives on the Flask path
+            error = default_exceptions[self.status]()
+            return Response(error.get_body(), status_code=self.status, media_type='text/html')
+        headers = {'Retry-After': str(max(1, math.ceil(self.retry_after)))} if self.retry_after else None
+        return JSONResponse(self.body, status_code=self.status, headers=headers)
+
+def async_database_url(url):
+    return url.replace('postgres://', 'postgresql://').replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+class ReadContext:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.engine = create_async_engine(
+            async_database_url(AsyncReadConfig.DATABASE_URL or flask_app.config['SQLALCHEMY_DATABASE_URI']),
+            pool_size=AsyncReadConfig.POOL_SIZE,
+            max_overflow=AsyncReadConfig.MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+        self.session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        # Shared cache fills read from the primary, since DATABASE_URL may be a lagging replica
+        if AsyncReadConfig.DATABASE_URL:
+            self.primary_engine = create_async_engine(
+                async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+                pool_size=AsyncReadConfig.POOL_SIZE,
+                max_overflow=AsyncReadConfig.MAX_OVERFLOW,
+                pool_pre_ping=True,
+            )
+        else:
+            self.primary_engine = self.engine
+        self.primary_session = sessionmaker(self.primary_engine, class_=AsyncSession, expire_on_commit=False)
+        # Handlers running on this worker's event loop, and the most there have been at once
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def dispose(self):
+        await self.engine.dispose()
+        if self.primary_engine is not self.engine:
+            await self.primary_engine.dispose()
+
+    def dumps(self, data):
+        # Same bytes as jsonify on the Flask path
+        return self.flask_app.json.response(data).get_data()
+
+    def decoded_token(self, request, required=True):
+        """The request's decoded JWT, None without one, or with an invalid one when not `required`."""
+        header = request.headers.get('authorization', '')
+        if not header.startswith('Bearer '):
+            if required:
+                raise HTTPError(401, {"msg": "Missing Authorization Header"})
+            return None
+        try:
+            with self.flask_app.app_context():
+                return decode_token(header[len('Bearer '):])
+        except Exception as e:
+            if required:
+                raise HTTPError(422 if 'expired' not in str(e).lower() else 401, {"msg": str(e)})
+            return None
+
+    def _token_of_deleted_user(self, decoded):
+        with self.flask_app.app_context():
+            return token_of_deleted_user(decoded)
+
+    async def identity(self, request):
+        """The JWT identity of the request, validated the way jwt_required does."""
+        decoded = self.decoded_token(request)
+        if decoded.get('type') != 'access':
+            raise HTTPError(422, {"msg": "Only non-refresh tokens are allowed"})
+        # decode_token skips the blocklist loader, and its lookup is blocking
+        if await run_in_threadpool(self._token_of_deleted_user, decoded):
+            raise HTTPError(401, {"msg": "Token has been revoked"})
+        return decoded[self.flask_app.config['JWT_IDENTITY_CLAIM']]
+
+    async def admit(self, request, endpoint):
+        """
+        Applies the Flask path's rate limits and expensive endpoint slots under the same
+        endpoint names. Returns the slot held, for release() once the response is sent.
+        """
+        admission = self.flask_app.extensions.get('admission')
+        if admission is None:
+            return None
+        decoded = self.decoded_token(request, required=False)
+        identity = decoded.get(self.flask_app.config['JWT_IDENTITY_CLAIM']) if decoded else None
+        if isinstance(identity, dict) and identity.get('id') is not None:
+            client = f"user:{identity['id']}"
+        else:
+            forwarded = [ip.strip() for ip in request.headers.get('x-forwarded-for', '').split(',') if ip.strip()]
+            hops = AdmissionConfig.PROXY_HOPS
+            client = f"ip:{forwarded[-hops] if hops and len(forwarded) >= hops else request.client.host}"
+        wait = admission['limiter'].check(client, endpoint, endpoint.split('.')[0])
+        if wait:
+            raise HTTPError(429, {"error": "Too many requests, please retry later."}, retry_after=wait)
+
+        if endpoint not in AdmissionConfig.EXPENSIVE_ENDPOINTS:
+            return None
+        # The slots are shared with the Flask workers through flock(), so they are taken off the event loop
+        slots = admission['expensive_slots']
+        slot = await run_in_threadpool(slots.acquire)
+        if slot is None:
+            raise HTTPError(503, {"error": "Server busy, please retry later."},
+                            retry_after=AdmissionConfig.BUSY_RETRY_AFTER_SECONDS)
+        return slots, slot
+
+    @staticmethod
+    def release(held):
+        slots, slot = held
+        slots.release(slot)
+
+def _encoding(request):
+    return negotiate_encoding(parse_accept_header(request.headers.get('accept-encoding')))
+
+def json_response(context, request, data, status=200):
+    body = context.dumps(data)
+    encoding = _encoding(request)
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding is not None and len(body) >= CompressionConfig.MIN_SIZE:
+        body = compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, status_code=status, media_type='application/json', headers=headers)
+
+def endpoint(name, auth=False):
+    """Wraps a handler(context, request[, identity]) with admission, auth and error responses."""
+    def decorator(handler):
+        async def wrapper(request):
+            context = request.app.state.read_context
+            try:
+                held = await context.admit(request, name)
+            except HTTPError as e:
+                return e.response()
+
+            context.in_flight += 1
+            context.peak_in_flight = max(context.peak_in_flight, context.in_flight)
+            try:
+                if auth:
+                    response = await handler(context, request, await context.identity(request))
+                else:
+                    response = await handler(context, request)
+            except HTTPError as e:
+                response = e.response()
+            except BaseException:
+                if held is not None:
+                    await run_in_threadpool(context.release, held)
+                raise
+            finally:
+                context.in_flight -= 1
+
+            # Streamed bodies still read from the database, so the slot is kept until they are sent
+            if held is not None:
+                response.background = BackgroundTask(context.release, held)
+            if AsyncReadConfig.IN_FLIGHT_HEADER:
+                response.headers['X-In-Flight-Peak'] = f"{os.getpid()}:{context.peak_in_flight}"
+            return response
+        return wrapper
+    return decorator
+
+@endpoint('maps.get_map')
+async def get_map(context, request):
+    map_id = request.path_params['map_id']
+    try:
+        fields = parse_fields(request.query_params.get('fields'), Map.SERIALIZED_FIELDS)
+    except ValueError as e:
+        raise HTTPError(400, {"error": str(e)})
+
+    # Shares the cached, compressed payloads with the Flask path (maps/payload_cache.py)
+    encoding = _encoding(request)
+    variant = payload_variant(fields, encoding)
+    entry = map_payload_cache.get(map_id, variant)
+    if entry is None:
+        version = map_payload_cache.version(map_id)
+        async with context.primary_session() as session:
+            result = await session.execute(select(Map).options(*Map.load_options(fields)).where(Map.id == map_id))
+            map_ = result.unique().scalars().first()
+            if map_ is None:
+                raise HTTPError(404)
+            entry = render_entry(context.dumps(map_.serialize(fields)), encoding)
+        map_payload_cache.set(map_id, variant, entry, version)
+
+    view_counter.record(map_id)
+    return entry_response(request, entry)
+
+def entry_response(request, entry):
+    """Conditional response serving a cache entry as-is."""
+    etag, content_encoding, body = split_entry(entry)
+    # Weak comparison, as make_conditional does on the Flask path: lists, W/ tags and *
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return Response(status_code=304, headers={'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding'})
+    headers = {'ETag': f'"{etag}"', 'Vary': 'Accept-Encoding'}
+    if content_encoding != 'identity':
+        headers['Content-Encoding'] = content_encoding
+    return Response(body, media_type='application/json', headers=headers)
+
+@endpoint('maps.get_waypoints')
+async def get_waypoints(context, request):
+    map_id = request.path_params['map_id']
+    try:
+        geometry_format, precision = parse_geometry_params(request.query_params)
+    except ValueError as e:
+        raise HTTPError(400, {"error": str(e)})
+
+    async with context.session() as session:
+        if (await session.execute(select(Map.id).where(Map.id == map_id))).first() is None:
+            raise HTTPError(404)
+        if geometry_format == 'json':
+            waypoints = (await session.execute(
+                select(Waypoint).where(Waypoint.map_id == map_id).order_by(Waypoint.id)
+            )).scalars().all()
+            return json_response(context, request, [waypoint.serialize() for waypoint in waypoints])
+        coordinates = group_coordinates(await session.execute(coordinates_statement([map_id])))
+
+    if geometry_format == 'packed':
+        return Response(pack_records(coordinates, [map_id], precision), media_type=PACKED_MIMETYPE)
+    return json_response(context, request, {"precision": precision, **polyline_payload(coordinates, [map_id], precision)[0]})
+
+async def _compress_stream(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.finish()
+
+async def _maps_listing(context, request, statement, endpoint_name, order_by=None):
+    """Serialized maps for a select() of Map: rendered by Postgres and streamed, or through the ORM."""
+    if sql_json_enabled(endpoint_name, request.query_params):
+        async def documents():
+            async with context.session() as session:
+                result = await session.stream(maps_json_statement(statement, order_by))
+                yield '['
+                first = True
+                async for (document,) in result:
+                    yield document if first else ',' + document
+                    first = False
+                yield ']'
+
+        encoding = _encoding(request)
+        headers = {'Vary': 'Accept-Encoding'}
+        if encoding is None:
+            return StreamingResponse(documents(), media_type='application/json', headers=headers)
+        headers['Content-Encoding'] = encoding
+        return StreamingResponse(_compress_stream(documents(), encoding), media_type='application/json', headers=headers)
+
+    async with context.session() as session:
+        result = await session.execute(statement.options(*Map.load_options()))
+        maps = result.unique().scalars().all()
+        return json_response(context, request, [map_.serialize() for map_ in maps])
+
+@endpoint('maps.get_all_maps_with_waypoints', auth=True)
+async def get_all_maps_with_waypoints(context, request, identity):
+    return await _maps_listing(context, request, select(Map), 'maps.get_all_maps_with_waypoints')
+
+@endpoint('maps.get_filtered_maps_with_waypoints', auth=True)
+async def get_filtered_maps_with_waypoints(context, request, identity):
+    args = request.query_params
+    try:
+        order_by = parse_sort(args)
+        limit, offset = parse_page(args)
+    except ValueError as e:
+        raise HTTPError(400, {"error": str(e)})
+
+    statement = filter_maps(select(Map), args).order_by(*order_by)
+    if limit is not None:
+        statement = statement.limit(limit)
+    if offset:
+        statement = statement.offset(offset)
+
+    # Shares the cached pages with the Flask path (maps/filter_cache.py)
+    sql_json = sql_json_enabled('maps.get_filtered_maps_with_waypoints', args)
+    encoding = _encoding(request)
+    variant = filtered_variant(args, limit, offset, sql_json, encoding)
+    if variant is None:
+        return await _maps_listing(context, request, statement, 'maps.get_filtered_maps_with_waypoints', order_by)
+
+    entry = filtered_maps_cache.get(FILTERED_PAGES, variant)
+    if entry is None:
+        version = filtered_maps_cache.version(FILTERED_PAGES)
+        async with context.primary_session() as session:
+            if sql_json:
+                documents = (await session.execute(maps_json_statement(statement, order_by))).scalars()
+                body = ('[' + ','.join(documents) + ']').encode('utf-8')
+            else:
+                result = await session.execute(statement.options(*Map.load_options()))
+                body = context.dumps([map_.serialize() for map_ in result.unique().scalars().all()])
+        entry = render_entry(body, encoding)
+        filtered_maps_cache.set(FILTERED_PAGES, variant, entry, version)
+    return entry_response(request, entry)
+
+async def _profile(context, request, identity):
+    async with context.session() as session:
+        user = (await session.execute(select(User).where(User.email == identity['email']))).scalars().first()
+        if user is None:
+            raise HTTPError(404, {"error": "User not found"})
+        return json_response(context, request, user.serialize())
+
+@endpoint('users.get_profile', auth=True)
+async def get_profile(context, request, identity):
+    return await _profile(context, request, identity)
+
+@endpoint('auth.profile', auth=True)
+async def auth_profile(context, request, identity):
+    return await _profile(context, request, identity)
+
+@endpoint('auth.get_user_profile')
+async def get_user_profile(context, request):
+    async with context.session() as session:
+        user = (await session.execute(select(User).where(User.alias == request.path_params['alias']))).scalars().first()
+        if user is None:
+            raise HTTPError(404, {"error": "User not found"})
+        maps = (await session.execute(select(Map).where(Map.creator_id == user.id))).scalars().all()
+        user_data = user.serialize()
+        user_data["maps"] = [map_.serialize_summary() for map_ in maps]
+        user_data["stats"] = creator_stats(maps)
+        return json_response(context, request, user_data)
+
+def create_asgi_app(flask_app):
+    """Starlette app serving the read endpoints asynchronously, with the Flask app mounted for the rest."""
+    routes = [
+        Route('/maps/{map_id:int}', get_map, methods=['GET', 'HEAD']),
+        Route('/maps/{map_id:int}/waypoints', get_waypoints, methods=['GET', 'HEAD']),
+        Route('/maps/get_all_maps_with_waypoints', get_all_maps_with_waypoints, methods=['GET', 'HEAD']),
+        Route('/maps/get_filtered_maps_with_waypoints', get_filtered_maps_with_waypoints, methods=['GET', 'HEAD']),
+        Route('/users/profile', get_profile, methods=['GET', 'HEAD']),
+        Route('/auth/profile', auth_profile, methods=['GET', 'HEAD']),
+        Route('/auth/user/{alias}', get_user_profile, methods=['GET', 'HEAD']),
+        # Writes, and every other endpoint, run on the Flask app in the worker's thread pool
+        Mount('/', app=WSGIMiddleware(flask_app, workers=AsyncReadConfig.WSGI_THREADS)),
+    ]
+    read_context = ReadContext(flask_app)
+    app = Starlette(routes=routes, on_shutdown=[read_context.dispose])
+    app.state.read_context = read_context
+    return app
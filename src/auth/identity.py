@@ -0,0 +1,10 @@
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+
+def optional_user_id():
+    """The user id from the request's JWT, or None for anonymous requests and invalid or expired tokens."""
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        return None
+    return identity.get('id') if isinstance(identity, dict) else None
@@ -16,6 +16,11 @@ class User(db.Model):
     map_ids = db.Column(ARRAY(db.Integer), nullable=True, default=[])
     image_data = db.Column(db.LargeBinary, nullable=True)
     alias = db.Column(db.String(100), nullable=True) 
+    deleted_at = db.Column(db.DateTime, nullable=True)  # Account deleted, hidden until purged (see soft_delete.py)
+
+    __table_args__ = (
+        db.Index('ix_users_deleted_at', deleted_at, postgresql_where=deleted_at.isnot(None)),
+    )
 
     def serialize(self):
         return {
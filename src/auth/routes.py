@@ -6,7 +6,10 @@ from datetime import timedelta
 from .models import User
 from ..extensions import db
 from ..maps.map_utils import validate_image
-from ..maps.models import Map, format_duration
+from ..maps.models import Map
+from ..maps.signals import notify_map_changed
+from ..maps.view_counts import creator_stats
+from ..soft_delete import soft_delete_user
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -23,12 +26,12 @@ def register():
     if not email or not password or not role:
         return jsonify({"error": "Email, password, and role are required"}), 400
 
-    # Check if the email is already registered
-    if User.query.filter_by(email=email).first():
+    # Check if the email is already registered, deleted accounts keep theirs until purged
+    if User.query.execution_options(include_deleted=True).filter_by(email=email).first():
         return jsonify({"error": "Email is already registered"}), 409
     
     # Check if the alias is already registered
-    if User.query.filter_by(alias=alias).first():
+    if User.query.execution_options(include_deleted=True).filter_by(alias=alias).first():
         return jsonify({"error": "Alias is already registered"}), 409
     
     profile_image = image_files.get('profile_image')
@@ -73,7 +76,7 @@ def update_user_profile(user_id):
         # Update alias if provided and not already taken by someone else
         new_alias = data.get('alias')
         if new_alias and new_alias != user.alias:
-            if User.query.filter_by(alias=new_alias).first():
+            if User.query.execution_options(include_deleted=True).filter_by(alias=new_alias).first():
                 return jsonify({"error": "Alias is already taken"}), 409
             user.alias = new_alias
 
@@ -96,6 +99,27 @@ def update_user_profile(user_id):
         db.session.rollback()
         return jsonify({"error": "An error occurred while updating the profile", "details": str(e)}), 500
 
+@auth_bp.route('/user/<int:user_id>/delete', methods=['DELETE'])
+@jwt_required()
+def delete_user(user_id):
+    current_user = get_jwt_identity()
+    if current_user['id'] != user_id:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    try:
+        # The account and its maps are hidden right away and removed later by the purger
+        map_ids = soft_delete_user(user_id)
+        if map_ids is None:
+            return jsonify({"error": "User not found"}), 404
+        db.session.commit()
+        for map_id in map_ids:
+            notify_map_changed(map_id, 'delete')
+        return jsonify({"message": "User and their maps deleted successfully."}), 200
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": "An error occurred while deleting the user", "details": str(e)}), 500
+
 @auth_bp.route('/login', methods=['POST'])
 def login():
     data = request.get_json()
@@ -146,24 +170,12 @@ def get_user_profile(alias):
     # Dynamically fetch all maps where the user is the creator
     maps = Map.query.filter_by(creator_id=user.id).all()
 
-    maps_metadata = [
-        {
-            "id": map.id,
-            "title": map.title,
-            "description": map.description,
-            "duration": format_duration(map.duration),
-            "rating": map.rating.average_rating if map.rating else None,
-            "price": map.price,
-            "countries": map.countries,
-            "tags": map.tags,
-            "image_data": base64.b64encode(map.image_data).decode('utf-8') if map.image_data else None
-        }
-        for map in maps
-    ]
+    maps_metadata = [map.serialize_summary() for map in maps]
 
     # Serialize user data and add maps metadata
     user_data = user.serialize()
     user_data["maps"] = maps_metadata  # ✅ Fetch maps dynamically
+    user_data["stats"] = creator_stats(maps)
 
     return jsonify(user_data), 200
 
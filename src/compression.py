@@ -0,0 +1,89 @@
+import hashlib
+import zlib
+from flask import request
+from .cache import LRUCache
+from .config import CompressionConfig
+
+try:
+    import brotli
+except ImportError:  # Optional, responses fall back to gzip without it
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {"application/json"}
+
+# Compressed bodies keyed by (ETag of the uncompressed body, encoding), so a hot
+# payload is compressed once per worker no matter how often it is requested
+compressed_cache = LRUCache(maxsize=4096, maxbytes=CompressionConfig.CACHE_MAX_BYTES)
+
+class StreamCompressor:
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=CompressionConfig.BROTLI_QUALITY)
+            self.compress, self.finish = self._compressor.process, self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(CompressionConfig.GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.compress, self.finish = self._compressor.compress, self._compressor.flush
+
+def compress(data, encoding):
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+def compress_chunks(chunks, encoding):
+    compressor = StreamCompressor(encoding)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+def negotiate_encoding(accept_encodings=None):
+    """Best of br/gzip for the request's Accept-Encoding (or the parsed `accept_encodings`), None for identity."""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    accept = request.accept_encodings if accept_encodings is None else accept_encodings
+    return accept.best_match(offered)
+
+def compress_response(response):
+    """after_request hook: content-negotiated gzip/brotli for JSON bodies, with a precompressed cache for GETs."""
+    if (response.status_code != 200 or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or 'Content-Encoding' in response.headers or response.direct_passthrough):
+        return response
+
+    encoding = negotiate_encoding()
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+
+    # Streamed bodies (e.g. the Postgres-rendered listings) are compressed chunk by chunk
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    data = response.get_data()
+    if len(data) < CompressionConfig.MIN_SIZE:
+        return response
+
+    if request.method not in ('GET', 'HEAD'):
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    # Each encoding is its own representation, so it gets its own ETag
+    etag = f"{hashlib.sha1(data).hexdigest()}-{encoding}"
+    response.set_etag(etag)
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        response.set_data(b'')
+        return response
+
+    compressed = compressed_cache.get((etag, encoding))
+    if compressed is None:
+        compressed = compress(data, encoding)
+        compressed_cache.set((etag, encoding), compressed, size=len(compressed))
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -1,14 +1,121 @@
 import os
+import tempfile
 
 class SecretsConfig:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'invalid_key'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL').replace("postgres://", "postgresql://") or 'invalid_db_uri'
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or 'invalid_db_uri').replace("postgres://", "postgresql://")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'supersecret')
 
+class UploadConfig:
+    # Requests with a larger body are rejected with 413 before any of it is read
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+
 class ValidationConfig:
     MAX_EMAIL_LEN = 120
     MAX_NAME_LEN = 100
 
+class ReadPathConfig:
+    # Comma separated endpoints (e.g. "maps.get_all_maps_with_waypoints") whose JSON is rendered by Postgres
+    SQL_JSON_ENDPOINTS = {
+        endpoint.strip() for endpoint in os.environ.get('SQL_JSON_ENDPOINTS', '').split(',') if endpoint.strip()
+    }
+
+class CompressionConfig:
+    MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))  # Bytes, smaller JSON bodies are sent as-is
+    GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+    BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 5))
+    CACHE_MAX_BYTES = int(os.environ.get('COMPRESSION_CACHE_MAX_BYTES', 64 * 1024 * 1024))  # Per worker
+
+class SharedCacheConfig:
+    # Shared by the workers of a host, tmpfs keeps the entries in memory
+    DIRECTORY = os.environ.get('SHARED_CACHE_DIRECTORY', '/dev/shm/pathless' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'pathless'))
+    MAX_BYTES = int(os.environ.get('SHARED_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    # Bounds staleness for changes this host does not see: writes on other hosts, creator profile edits
+    TTL_SECONDS = int(os.environ.get('SHARED_CACHE_TTL_SECONDS', 300))
+
+class FilterCacheConfig:
+    # Pages of the filtered listing, shared by the workers of a host (maps/filter_cache.py)
+    MAX_BYTES = int(os.environ.get('FILTER_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+    # Bounds staleness for changes this host does not see: writes on other hosts, saves, views, profile edits
+    TTL_SECONDS = int(os.environ.get('FILTER_CACHE_TTL_SECONDS', 60))
+    MAX_LIMIT = int(os.environ.get('FILTER_CACHE_MAX_LIMIT', 100))  # Larger and unbounded pages are not cached
+
+class ReplicaConfig:
+    # Comma separated database URLs of read replicas; GET requests are spread over them
+    REPLICA_URLS = [
+        url.strip().replace("postgres://", "postgresql://")
+        for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+    ]
+    STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))  # Clients read from the primary this long after a write
+    HEALTH_CHECK_SECONDS = int(os.environ.get('REPLICA_HEALTH_CHECK_SECONDS', 5))
+    MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 5))
+    # Kept short so an unreachable replica costs a request little before it falls back to the primary
+    CONNECT_TIMEOUT_SECONDS = int(os.environ.get('REPLICA_CONNECT_TIMEOUT_SECONDS', 2))
+    # Read-only endpoints that must still see the primary
+    PRIMARY_ENDPOINTS = {
+        endpoint.strip() for endpoint in os.environ.get('REPLICA_PRIMARY_ENDPOINTS', '').split(',') if endpoint.strip()
+    }
+
+class AdmissionConfig:
+    # Token buckets per client (JWT user, else IP) as "<requests>/<seconds>", keyed by endpoint or blueprint.
+    # Each gunicorn worker keeps its own buckets. Override with e.g. RATE_LIMITS="maps=120/60,auth=20/60"
+    RATE_LIMITS = dict(
+        rule.strip().split('=', 1)
+        for rule in os.environ.get('RATE_LIMITS', (
+            'auth=20/60,maps=300/60,users=300/60,waypoints=300/60,autocomplete=1200/60,'
+            'maps.get_all_maps_with_waypoints=20/60,maps.get_filtered_maps_with_waypoints=60/60,'
+            'maps.create_map_with_waypoints=10/60,maps.update_map_with_waypoints=20/60,maps.fork_map_route=10/60'
+        )).split(',') if rule.strip()
+    )
+    # Endpoints that share MAX_EXPENSIVE_IN_FLIGHT slots across the workers of a host
+    EXPENSIVE_ENDPOINTS = {
+        endpoint.strip() for endpoint in os.environ.get('EXPENSIVE_ENDPOINTS', (
+            'maps.get_all_maps_with_waypoints,maps.get_filtered_maps_with_waypoints,'
+            'maps.create_map_with_waypoints,maps.update_map_with_waypoints,users.get_saved_maps'
+        )).split(',') if endpoint.strip()
+    }
+    MAX_EXPENSIVE_IN_FLIGHT = int(os.environ.get('MAX_EXPENSIVE_IN_FLIGHT', 2))  # Leaves workers free for cheap requests
+    BUSY_RETRY_AFTER_SECONDS = int(os.environ.get('BUSY_RETRY_AFTER_SECONDS', 2))
+    LOCK_DIRECTORY = os.environ.get('ADMISSION_LOCK_DIRECTORY', '/tmp/pathless-admission')
+    PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))  # Trusted proxies in front of the app, for the client IP
+
+class ViewCountConfig:
+    # Views are buffered per worker and written every FLUSH_SECONDS, which bounds what a crash loses
+    FLUSH_SECONDS = float(os.environ.get('VIEW_COUNT_FLUSH_SECONDS', 5))
+    FLUSH_PENDING_MAPS = int(os.environ.get('VIEW_COUNT_FLUSH_PENDING_MAPS', 1000))  # Flush early past this many maps
+
+class PurgeConfig:
+    # Soft-deleted maps and users are removed by `flask maps purge-deleted` in small transactions,
+    # pausing in between so WAL volume and vacuum work stay spread out
+    GRACE_SECONDS = int(os.environ.get('PURGE_GRACE_SECONDS', 3600))  # Kept this long before purging, e.g. to undo by hand
+    MAP_BATCH_SIZE = int(os.environ.get('PURGE_MAP_BATCH_SIZE', 100))
+    WAYPOINT_BATCH_SIZE = int(os.environ.get('PURGE_WAYPOINT_BATCH_SIZE', 500))  # Waypoints carry the images
+    PAUSE_SECONDS = float(os.environ.get('PURGE_PAUSE_SECONDS', 0.5))
+
+class AutocompleteConfig:
+    # Per-worker typeahead index (maps/autocomplete.py), following the map change log
+    REFRESH_SECONDS = float(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 5))
+    FULL_REBUILD_SECONDS = float(os.environ.get('AUTOCOMPLETE_FULL_REBUILD_SECONDS', 600))  # Picks up alias renames
+    BUILD_WAIT_SECONDS = float(os.environ.get('AUTOCOMPLETE_BUILD_WAIT_SECONDS', 5))  # First requests wait this long for the build
+
+class GeocoderConfig:
+    # Reverse geocoding index built by `flask maps build-geocoder`, memory-mapped by every worker
+    DIRECTORY = os.environ.get('GEOCODER_DIRECTORY', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'geocoder'))
+    # GeoNames extract shipped in data/geocoder, indexed on startup when DIRECTORY has no index yet
+    CITIES_FILE = os.environ.get('GEOCODER_CITIES_FILE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'geocoder', 'cities15000.txt.gz'))
+    COUNTRY_INFO_FILE = os.environ.get('GEOCODER_COUNTRY_INFO_FILE', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'geocoder', 'countryInfo.txt'))
+    MAX_CITY_KM = float(os.environ.get('GEOCODER_MAX_CITY_KM', 50))  # Farther from any city, only the country is filled in
+    MAX_COUNTRY_KM = float(os.environ.get('GEOCODER_MAX_COUNTRY_KM', 200))  # Farther than this, e.g. at sea, neither is
+
+class AsyncReadConfig:
+    # Async serving mode (asgi.py), defaults to DATABASE_URL. Can point at a replica, reads only go through it
+    DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', 10))  # Per worker
+    MAX_OVERFLOW = int(os.environ.get('ASYNC_MAX_OVERFLOW', 10))
+    WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 8))  # Per worker, for requests handed to the Flask app
+    # 1 adds X-In-Flight-Peak: <pid>:<most handlers this worker has had running at once>, for loadtest.py
+    IN_FLIGHT_HEADER = int(os.environ.get('ASYNC_IN_FLIGHT_HEADER', 0))
+
 class HostConfig:
     PORT = int(os.environ.get('PORT', 5555))
\ No newline at end of file
@@ -1,9 +1,15 @@
 import logging
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import orm
+from .replicas import RoutingSession
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+db = RoutingSQLAlchemy()
 jwt = JWTManager()
 migrate = Migrate()
 
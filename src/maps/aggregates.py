@@ -0,0 +1,116 @@
+from ..extensions import db
+from .clusters import add_waypoint_cells, rebuild_waypoint_cells, remove_map_cells
+from .geocoder import fill_places
+
+# Map columns derived from its waypoints, along with the waypoint clusters
+# (maps/clusters.py). Waypoint changes are applied as a delta computed from the
+# changed rows only; repair_map_aggregates() rebuilds every map from scratch.
+AGGREGATE_FIELDS = (
+    'price', 'countries', 'cities', 'duration', 'waypoint_count',
+    'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude',
+)
+
+APPLY_WAYPOINTS_SQL = db.text("""
+    UPDATE maps SET
+        waypoint_count = coalesce(maps.waypoint_count, 0) + delta.waypoint_count,
+        price = coalesce(maps.price, 0) + delta.price,
+        duration = CASE WHEN delta.duration IS NULL THEN maps.duration
+                        ELSE coalesce(maps.duration, interval '0') + delta.duration END,
+        countries = coalesce(maps.countries, '{}') || ARRAY(
+            SELECT DISTINCT country FROM unnest(delta.countries) AS country
+            WHERE country <> ALL(coalesce(maps.countries, '{}'))
+        ),
+        cities = coalesce(maps.cities, '{}') || ARRAY(
+            SELECT DISTINCT city FROM unnest(delta.cities) AS city
+            WHERE city <> ALL(coalesce(maps.cities, '{}'))
+        ),
+        min_latitude = least(maps.min_latitude, delta.min_latitude),
+        max_latitude = greatest(maps.max_latitude, delta.max_latitude),
+        min_longitude = least(maps.min_longitude, delta.min_longitude),
+        max_longitude = greatest(maps.max_longitude, delta.max_longitude),
+        updated_at = timezone('utc', now())
+    FROM (
+        SELECT count(*) AS waypoint_count,
+               coalesce(sum(price), 0) AS price,
+               sum(duration) AS duration,
+               coalesce(array_agg(DISTINCT country) FILTER (WHERE country IS NOT NULL), '{}') AS countries,
+               coalesce(array_agg(DISTINCT city) FILTER (WHERE city IS NOT NULL), '{}') AS cities,
+               min(latitude) AS min_latitude,
+               max(latitude) AS max_latitude,
+               min(longitude) AS min_longitude,
+               max(longitude) AS max_longitude
+        FROM waypoints
+        WHERE map_id = :map_id AND id = ANY(:waypoint_ids)
+    ) AS delta
+    WHERE maps.id = :map_id
+""")
+
+REPAIR_SQL = """
+    UPDATE maps SET
+        waypoint_count = agg.waypoint_count,
+        price = agg.price,
+        duration = coalesce(agg.duration, maps.duration),
+        countries = agg.countries,
+        cities = agg.cities,
+        min_latitude = agg.min_latitude,
+        max_latitude = agg.max_latitude,
+        min_longitude = agg.min_longitude,
+        max_longitude = agg.max_longitude,
+        updated_at = timezone('utc', now())
+    FROM (
+        SELECT m.id,
+               count(w.id) AS waypoint_count,
+               coalesce(sum(w.price), 0) AS price,
+               sum(w.duration) AS duration,
+               coalesce(array_agg(DISTINCT w.country) FILTER (WHERE w.country IS NOT NULL), ARRAY[]::varchar[]) AS countries,
+               coalesce(array_agg(DISTINCT w.city) FILTER (WHERE w.city IS NOT NULL), ARRAY[]::varchar[]) AS cities,
+               min(w.latitude) AS min_latitude,
+               max(w.latitude) AS max_latitude,
+               min(w.longitude) AS min_longitude,
+               max(w.longitude) AS max_longitude
+        FROM maps m
+        LEFT JOIN waypoints w ON w.map_id = m.id
+        {where}
+        GROUP BY m.id
+    ) AS agg
+    WHERE maps.id = agg.id
+"""
+
+def reset_map_aggregates(map_):
+    """Clears the derived columns and clusters, e.g. when a map's waypoints are replaced wholesale."""
+    remove_map_cells([map_.id])
+    map_.price = 0.0
+    map_.countries = []
+    map_.cities = []
+    map_.duration = None
+    map_.waypoint_count = 0
+    map_.min_latitude = map_.max_latitude = None
+    map_.min_longitude = map_.max_longitude = None
+
+def apply_waypoints_added(map_, waypoints):
+    """
+    Folds newly added waypoints into the map's aggregates. Only the new rows are read,
+    so the cost is proportional to the change rather than to the size of the map.
+    """
+    if not waypoints:
+        return
+    # Fills in places the client left out before the rows are written
+    fill_places(waypoints)
+    db.session.flush()
+    waypoint_ids = [waypoint.id for waypoint in waypoints]
+    db.session.execute(APPLY_WAYPOINTS_SQL, {"map_id": map_.id, "waypoint_ids": waypoint_ids})
+    add_waypoint_cells(waypoint_ids=waypoint_ids)
+    db.session.expire(map_, AGGREGATE_FIELDS + ('updated_at',))
+
+def repair_map_aggregates(map_ids=None):
+    """Recomputes the aggregates and clusters of every map (or of `map_ids`). Returns the map row count."""
+    if map_ids is None:
+        statement, params = db.text(REPAIR_SQL.format(where='')), {}
+    else:
+        statement = db.text(REPAIR_SQL.format(where='WHERE m.id = ANY(:map_ids)'))
+        params = {"map_ids": list(map_ids)}
+    db.session.flush()
+    result = db.session.execute(statement, params)
+    rebuild_waypoint_cells(map_ids)
+    db.session.expire_all()
+    return result.rowcount
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+import unicodedata
+from collections import Counter
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from ..auth.models import User
+from ..cache import LRUCache
+from ..config import AutocompleteConfig
+from ..extensions import db, logger
+from .changes import change_entries_since, current_cursor
+from .models import Map
+
+# Typeahead suggestions for the filter inputs, answered from memory. Each worker keeps a
+# sorted list of the distinct tags, countries, cities and creator aliases of the live maps,
+# with the number of maps using each. A prefix is a bisect range of that list, ranked by
+# count. A background thread builds it on the worker's first request, then follows the
+# map change log from where the build started, re-reading only the maps that changed.
+# Writes that bypass the log (alias renames, `flask maps backfill-places`) show up with the
+# next full rebuild, every FULL_REBUILD_SECONDS.
+
+KINDS = ('tag', 'country', 'city', 'alias')
+MAX_SUGGESTIONS = 20
+MAX_PREFIX_LENGTH = 100
+RANKED_CACHE_MIN_RANGE = 256  # Prefixes matching more values than this keep their ranking until the next change
+CHANGE_BATCH_SIZE = 1000
+
+def normalize(text):
+    """Case and accent insensitive form used for matching, so "sao" finds "São Paulo"."""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+class PrefixIndex:
+    """Values with their usage counts, searchable by normalized prefix."""
+
+    def __init__(self, counts=None):
+        self.counts = {value: count for value, count in (counts or {}).items() if count > 0}
+        self._keys = sorted((normalize(value), value) for value in self.counts)
+        self._ranked = LRUCache(maxsize=1024)
+
+    def add(self, value, delta):
+        count = self.counts.get(value, 0) + delta
+        key = (normalize(value), value)
+        if count > 0:
+            if value not in self.counts:
+                insort(self._keys, key)
+            self.counts[value] = count
+        elif value in self.counts:
+            del self.counts[value]
+            del self._keys[bisect_left(self._keys, key)]
+        self._ranked.clear()
+
+    def search(self, prefix, limit):
+        prefix = normalize(prefix)
+        ranked = self._ranked.get(prefix)
+        if ranked is None:
+            low = bisect_left(self._keys, (prefix,))
+            high = bisect_left(self._keys, (prefix + '\U0010ffff',), low)
+            ranked = nsmallest(MAX_SUGGESTIONS, self._keys[low:high], key=lambda key: (-self.counts[key[1]], key))
+            if high - low > RANKED_CACHE_MIN_RANGE:
+                self._ranked.set(prefix, ranked)
+        return [{"value": value, "count": self.counts[value]} for _, value in ranked[:limit]]
+
+class AutocompleteIndex:
+    """Per-worker prefix indexes of the live maps, refreshed by a daemon thread."""
+
+    def __init__(self, refresh_seconds, full_rebuild_seconds):
+        self.refresh_seconds = refresh_seconds
+        self.full_rebuild_seconds = full_rebuild_seconds
+        self.app = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()  # Set once the first build has finished or failed
+        self._pid = None
+        self._indexes = {kind: PrefixIndex() for kind in KINDS}
+        self._map_values = {}  # map_id -> {kind: values it counts towards}
+        self._cursor = None
+        self._built_at = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def ensure_started(self):
+        # Started in each worker, since a thread does not survive a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid() or self.app is None:
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='autocomplete-refresher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    if self._built_at is None or time.monotonic() - self._built_at >= self.full_rebuild_seconds:
+                        self.rebuild()
+                    else:
+                        self.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing the autocomplete index: {str(e)}")
+                finally:
+                    db.session.remove()
+                    self._ready.set()
+            time.sleep(self.refresh_seconds)
+
+    def _values_of(self, row, aliases):
+        alias = aliases.get(row.creator_id)
+        return {
+            'tag': frozenset(row.tags or ()),
+            'country': frozenset(row.countries or ()),
+            'city': frozenset(row.cities or ()),
+            'alias': frozenset((alias,) if alias else ()),
+        }
+
+    def _load(self, map_ids=None):
+        """{map_id: values} of the live maps, all of them or those of `map_ids`."""
+        query = db.session.query(Map.id, Map.tags, Map.countries, Map.cities, Map.creator_id)
+        if map_ids is not None:
+            query = query.filter(Map.id.in_(map_ids))
+        rows = query.all()
+        creator_ids = {row.creator_id for row in rows if row.creator_id is not None}
+        aliases = dict(db.session.query(User.id, User.alias).filter(User.id.in_(creator_ids))) if creator_ids else {}
+        return {row.id: self._values_of(row, aliases) for row in rows}
+
+    def _apply(self, map_id, values):
+        """Replaces what the map counts towards with `values`, None once it is deleted."""
+        for kind, old in self._map_values.pop(map_id, {}).items():
+            for value in old:
+                self._indexes[kind].add(value, -1)
+        if values is not None:
+            for kind, new in values.items():
+                for value in new:
+                    self._indexes[kind].add(value, 1)
+            self._map_values[map_id] = values
+
+    def rebuild(self):
+        """Reloads every live map, then swaps the new indexes in."""
+        # Taken before the load, so the changes committed meanwhile are replayed after it
+        cursor = current_cursor()
+        map_values = self._load()
+        counts = {kind: Counter() for kind in KINDS}
+        for values in map_values.values():
+            for kind, kind_values in values.items():
+                counts[kind].update(kind_values)
+        indexes = {kind: PrefixIndex(counts[kind]) for kind in KINDS}
+        with self._lock:
+            self._indexes, self._map_values = indexes, map_values
+            self._cursor = cursor
+            self._built_at = time.monotonic()
+        self.refresh()
+
+    def refresh(self):
+        """Re-reads the maps written since the last build or refresh. Returns how many there were."""
+        changed = 0
+        while True:
+            entries, cursor, has_more = change_entries_since(self._cursor, CHANGE_BATCH_SIZE)
+            map_ids = {entry.map_id for entry in entries}
+            loaded = self._load(map_ids) if map_ids else {}
+            with self._lock:
+                for map_id in map_ids:
+                    self._apply(map_id, loaded.get(map_id))
+                self._cursor = cursor
+            changed += len(map_ids)
+            if not has_more:
+                return changed
+
+    def suggest(self, kind, prefix, limit=10):
+        """Up to `limit` values of `kind` starting with `prefix`, most used first."""
+        self.ensure_started()
+        # Only the first requests of a worker wait, for the initial build
+        if not self._ready.is_set():
+            self._ready.wait(AutocompleteConfig.BUILD_WAIT_SECONDS)
+        with self._lock:
+            return self._indexes[kind].search(prefix, limit)
+
+autocomplete_index = AutocompleteIndex(AutocompleteConfig.REFRESH_SECONDS, AutocompleteConfig.FULL_REBUILD_SECONDS)
+
+def parse_autocomplete_params(args):
+    """(kind, prefix, limit) from the query parameters. Raises ValueError."""
+    kind = args.get('kind')
+    if kind not in KINDS:
+        raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+    prefix = args.get('prefix', '')
+    if len(prefix) > MAX_PREFIX_LENGTH:
+        raise ValueError(f"prefix must be at most {MAX_PREFIX_LENGTH} characters")
+    try:
+        limit = int(args.get('limit', 10))
+    except (TypeError, ValueError):
+        limit = None
+    if limit is None or not 1 <= limit <= MAX_SUGGESTIONS:
+        raise ValueError(f"limit must be between 1 and {MAX_SUGGESTIONS}")
+    return kind, prefix, limit
+
+def init_autocomplete(app):
+    autocomplete_index.init_app(app)
+    # The index is built by each worker as it starts serving, not by CLI commands
+    app.before_request(autocomplete_index.ensure_started)
@@ -0,0 +1,349 @@
+import base64
+import json
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from ..auth.models import User
+from ..extensions import db
+from .aggregates import repair_map_aggregates
+from .geocoder import get_geocoder, fill_places
+from .map_utils import IMAGE_SIGNATURES, MAX_IMAGE_SIZE_BYTES, sniff_image_type
+from .models import Map, MapChange, Rating, Waypoint
+
+# NDJSON interchange format, one map per line:
+#   {"title", "description", "duration" (seconds), "tags", "created_at", "creator" (email),
+#    "rating": {"average_rating", "num_ratings"}, "image": <image>,
+#    "waypoints": [{"title", "description", "info", "latitude", "longitude", "times_of_day",
+#                   "price", "rating", "duration" (seconds), "country", "city", "image": <image>}]}
+# where <image> is null, {"base64": "..."} or {"path": "relative/to/the/images/dir"}.
+# Price, countries, cities and the other aggregates are derived from the waypoints on import.
+
+IMAGE_EXTENSIONS = {image_type: f".{image_type.replace('jpeg', 'jpg')}" for image_type in IMAGE_SIGNATURES.values()}
+EXPORT_CHUNK_SIZE = 500  # Maps per server-side cursor fetch, their waypoints are loaded per chunk
+
+WAYPOINT_FIELDS = ('title', 'description', 'info', 'latitude', 'longitude', 'times_of_day', 'price', 'rating', 'country', 'city')
+
+class ImportRecordError(ValueError):
+    def __init__(self, line_no, message):
+        super().__init__(f"Line {line_no}: {message}")
+
+# Export
+
+def _duration_seconds(duration):
+    return duration.total_seconds() if duration is not None else None
+
+def _export_image(data, images_dir, kind, row_id):
+    if data is None or images_dir is False:
+        return None
+    if images_dir is None:
+        return {"base64": base64.b64encode(data).decode('utf-8')}
+    relative_path = os.path.join(kind, f"{row_id}{IMAGE_EXTENSIONS.get(sniff_image_type(data), '')}")
+    with open(os.path.join(images_dir, relative_path), 'wb') as image_file:
+        image_file.write(data)
+    return {"path": relative_path}
+
+def iter_export_records(images_dir=None):
+    """
+    Yields every map as an export record, reading maps through a server-side cursor and
+    their waypoints one chunk of maps at a time. Images are inlined as base64, written
+    under `images_dir` and referenced by path, or left out when `images_dir` is False.
+    """
+    if images_dir:
+        for kind in ('maps', 'waypoints'):
+            os.makedirs(os.path.join(images_dir, kind), exist_ok=True)
+
+    map_rows = db.session.execute(
+        select(
+            Map.id, Map.title, Map.description, Map.duration, Map.tags, Map.created_at, Map.image_data,
+            User.email, Rating.average_rating, Rating.num_ratings,
+        )
+        .outerjoin(User, Map.creator_id == User.id)
+        .outerjoin(Rating, Map.rating_id == Rating.id)
+        .order_by(Map.id)
+        .execution_options(stream_results=True)
+    )
+    waypoint_columns = [getattr(Waypoint, field) for field in WAYPOINT_FIELDS]
+
+    for chunk in map_rows.partitions(EXPORT_CHUNK_SIZE):
+        waypoints_by_map = {}
+        waypoint_rows = db.session.execute(
+            select(Waypoint.map_id, Waypoint.id, Waypoint.duration, Waypoint.image_data, *waypoint_columns)
+            .where(Waypoint.map_id.in_([row.id for row in chunk]))
+            .order_by(Waypoint.map_id, Waypoint.id)
+        )
+        for row in waypoint_rows:
+            waypoint = {field: getattr(row, field) for field in WAYPOINT_FIELDS}
+            waypoint["duration"] = _duration_seconds(row.duration)
+            waypoint["image"] = _export_image(row.image_data, images_dir, 'waypoints', row.id)
+            waypoints_by_map.setdefault(row.map_id, []).append(waypoint)
+
+        for row in chunk:
+            yield {
+                "title": row.title,
+                "description": row.description,
+                "duration": _duration_seconds(row.duration),
+                "tags": row.tags or [],
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "creator": row.email,
+                "rating": {"average_rating": row.average_rating, "num_ratings": row.num_ratings}
+                          if row.average_rating is not None else None,
+                "image": _export_image(row.image_data, images_dir, 'maps', row.id),
+                "waypoints": waypoints_by_map.get(row.id, []),
+            }
+
+def export_maps(out, images_dir=None):
+    """Writes every map as NDJSON to `out`. Returns the number of maps written."""
+    count = 0
+    for record in iter_export_records(images_dir):
+        out.write(json.dumps(record, separators=(',', ':')))
+        out.write('\n')
+        count += 1
+    return count
+
+# Import
+
+def _import_image(image, images_dir, line_no):
+    if not image:
+        return None
+    if 'base64' in image:
+        try:
+            data = base64.b64decode(image['base64'], validate=True)
+        except (TypeError, ValueError):
+            raise ImportRecordError(line_no, "image 'base64' is not valid base64")
+    elif 'path' in image:
+        with open(os.path.join(images_dir, image['path']), 'rb') as image_file:
+            data = image_file.read(MAX_IMAGE_SIZE_BYTES + 1)
+    else:
+        raise ImportRecordError(line_no, "image needs a 'base64' or 'path' key")
+    if len(data) > MAX_IMAGE_SIZE_BYTES:
+        raise ImportRecordError(line_no, f"image exceeds {MAX_IMAGE_SIZE_BYTES // (1024 * 1024)}MB")
+    if sniff_image_type(data) is None:
+        raise ImportRecordError(line_no, "image is not a JPEG or PNG")
+    return data
+
+def _import_duration(value):
+    # Seconds from an export, or any interval text Postgres accepts (e.g. "2 hours")
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)):
+        return timedelta(seconds=value)
+    return value
+
+def _import_datetime(value, line_no):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ImportRecordError(line_no, f"created_at is not an ISO 8601 timestamp: {value!r}")
+
+def _allocate_ids(table, count):
+    return db.session.execute(
+        db.text(f"SELECT nextval(pg_get_serial_sequence('{table}', 'id')) FROM generate_series(1, :count)"),
+        {"count": count},
+    ).scalars().all()
+
+def _parse_line(line, line_no):
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ImportRecordError(line_no, f"invalid JSON ({e})")
+    if not isinstance(record, dict) or not record.get('title'):
+        raise ImportRecordError(line_no, "a map needs a title")
+    for waypoint in record.get('waypoints') or []:
+        if not waypoint.get('title') or waypoint.get('latitude') is None or waypoint.get('longitude') is None:
+            raise ImportRecordError(line_no, "a waypoint needs a title, latitude and longitude")
+    return record
+
+def import_batch(records, images_dir, creator_id=None):
+    """
+    Inserts a batch of (line_no, record) pairs with one multi-row INSERT per table, then
+    derives the map aggregates in a single statement. Returns the new map ids. The caller
+    owns the transaction.
+    """
+    map_ids = _allocate_ids('maps', len(records))
+    rating_ids = _allocate_ids('ratings', len(records))
+
+    emails = {record.get('creator') for _, record in records if record.get('creator')}
+    creators = dict(db.session.query(User.email, User.id).filter(User.email.in_(emails))) if emails else {}
+
+    ratings, maps, waypoints = [], [], []
+    for (line_no, record), map_id, rating_id in zip(records, map_ids, rating_ids):
+        rating = record.get('rating') or {}
+        ratings.append({
+            "id": rating_id,
+            "average_rating": rating.get('average_rating', 0.0),
+            "num_ratings": rating.get('num_ratings', 0),
+        })
+        record_waypoints = record.get('waypoints') or []
+        tags = record.get('tags')
+        if tags is None:
+            tags = [tag for waypoint in record_waypoints for tag in waypoint.get('tags', [])]
+        created_at = _import_datetime(record['created_at'], line_no) if record.get('created_at') else datetime.utcnow()
+        maps.append({
+            "id": map_id,
+            "title": record['title'],
+            "description": record.get('description', ''),
+            "duration": _import_duration(record.get('duration')),
+            "creator_id": creators.get(record.get('creator'), creator_id),
+            "rating_id": rating_id,
+            "average_rating": rating.get('average_rating') or 0.0,
+            "tags": tags,
+            "image_data": _import_image(record.get('image'), images_dir, line_no),
+            "price": 0.0,
+            "created_at": created_at,
+            "updated_at": created_at,
+            "countries": [],
+            "cities": [],
+        })
+        for waypoint in record_waypoints:
+            waypoints.append({
+                "map_id": map_id,
+                "title": waypoint['title'],
+                "description": waypoint.get('description', ''),
+                "info": waypoint.get('info', ''),
+                "latitude": waypoint['latitude'],
+                "longitude": waypoint['longitude'],
+                "times_of_day": waypoint.get('times_of_day', {}),
+                "price": waypoint.get('price') or 0.0,
+                "rating": waypoint.get('rating') or 0.0,
+                "duration": _import_duration(waypoint.get('duration')),
+                "image_data": _import_image(waypoint.get('image'), images_dir, line_no),
+                "country": waypoint.get('country'),
+                "city": waypoint.get('city'),
+            })
+
+    # Executemany of a plain INSERT is sent as multi-row VALUES pages by the psycopg2 dialect
+    db.session.execute(Rating.__table__.insert(), ratings)
+    db.session.execute(Map.__table__.insert(), maps)
+    if waypoints:
+        fill_places(waypoints, dict.get, dict.__setitem__)
+        db.session.execute(Waypoint.__table__.insert(), waypoints)
+    db.session.execute(MapChange.__table__.insert(), [{"map_id": map_id, "op": 'create'} for map_id in map_ids])
+    repair_map_aggregates(map_ids)
+    return map_ids
+
+def _read_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def _write_checkpoint(path, checkpoint):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(tmp_path, path)
+
+def resume_position(checkpoint):
+    """
+    (byte offset, line number) to continue from. A batch is marked pending with its first
+    map id before it commits, so a crash between the commit and the checkpoint update is
+    detected by that map existing and the batch is not imported twice.
+    """
+    pending = checkpoint.get('pending')
+    if pending and db.session.get(Map, pending['map_id']) is not None:
+        return pending['offset'], pending['line']
+    return checkpoint.get('offset', 0), checkpoint.get('line', 0)
+
+def import_maps(path, images_dir=None, batch_size=500, checkpoint_path=None, creator_id=None, progress=None):
+    """
+    Streams the NDJSON file at `path` into the database, committing every `batch_size` maps.
+    With `checkpoint_path` the position is saved after each batch and a rerun picks up after
+    the last committed batch. Returns the number of maps imported by this run.
+    """
+    images_dir = images_dir or os.path.dirname(os.path.abspath(path))
+    checkpoint = _read_checkpoint(checkpoint_path)
+    offset, line_no = resume_position(checkpoint)
+    imported = 0
+
+    # Binary mode so tell() is a byte offset that seek() can return to
+    with open(path, 'rb') as source:
+        source.seek(offset)
+        while True:
+            records, start_line = [], line_no
+            while len(records) < batch_size:
+                line = source.readline()
+                if not line:
+                    break
+                line_no += 1
+                if line.strip():
+                    records.append((line_no, _parse_line(line, line_no)))
+            next_offset = source.tell()
+            if not records:
+                break
+
+            try:
+                map_ids = import_batch(records, images_dir, creator_id)
+                _write_checkpoint(checkpoint_path, {
+                    "offset": offset, "line": start_line,
+                    "pending": {"offset": next_offset, "line": line_no, "map_id": map_ids[0]},
+                })
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            _write_checkpoint(checkpoint_path, {"offset": next_offset, "line": line_no})
+
+            offset = next_offset
+            imported += len(records)
+            if progress:
+                progress(imported, line_no)
+    return imported
+
+# Place backfill
+
+BACKFILL_PLACES_SQL = """
+    UPDATE waypoints SET
+        city = {city},
+        country = {country}
+    FROM (VALUES {values}) AS v(id, city, country)
+    WHERE waypoints.id = v.id
+"""
+
+def backfill_places(batch_size=5000, overwrite=False, progress=None):
+    """
+    Reverse geocodes the waypoints missing a city or country (every waypoint with
+    `overwrite`) from the offline index, one keyset page of `batch_size` per transaction,
+    and rederives the aggregates of the maps touched. Returns the number of waypoints updated.
+    """
+    geocoder = get_geocoder()
+    if geocoder is None:
+        raise FileNotFoundError("No reverse geocoding index, build it with `flask maps build-geocoder`")
+    if overwrite:
+        city, country = 'coalesce(v.city, waypoints.city)', 'coalesce(v.country, waypoints.country)'
+    else:
+        city, country = "coalesce(nullif(waypoints.city, ''), v.city)", "coalesce(nullif(waypoints.country, ''), v.country)"
+
+    query = select(Waypoint.id, Waypoint.map_id, Waypoint.latitude, Waypoint.longitude).order_by(Waypoint.id).limit(batch_size)
+    if not overwrite:
+        query = query.where((db.func.coalesce(Waypoint.city, '') == '') | (db.func.coalesce(Waypoint.country, '') == ''))
+    last_id, updated = 0, 0
+    while True:
+        rows = db.session.execute(query.where(Waypoint.id > last_id)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        cities, countries = geocoder.lookup([row.latitude for row in rows], [row.longitude for row in rows])
+        found = [(row, row_city, row_country) for row, row_city, row_country in zip(rows, cities, countries)
+                 if row_city or row_country]
+        try:
+            if found:
+                params = {}
+                for i, (row, row_city, row_country) in enumerate(found):
+                    params[f"id_{i}"], params[f"city_{i}"], params[f"country_{i}"] = row.id, row_city, row_country
+                values = ', '.join(
+                    f"(:id_{i}, CAST(:city_{i} AS varchar), CAST(:country_{i} AS varchar))" for i in range(len(found))
+                )
+                db.session.execute(db.text(BACKFILL_PLACES_SQL.format(city=city, country=country, values=values)), params)
+                repair_map_aggregates({row.map_id for row, _, _ in found})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        updated += len(found)
+        if progress:
+            progress(updated, last_id)
+    return updated
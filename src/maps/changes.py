@@ -0,0 +1,83 @@
+from sqlalchemy import tuple_
+from ..extensions import db
+from .models import Map, MapChange
+
+MAX_CHANGE_ID = 2 ** 63 - 1
+
+class InvalidCursor(ValueError):
+    pass
+
+def record_map_change(map_id, op):
+    """Adds a change log entry to the current transaction. Call before committing the write it describes."""
+    db.session.add(MapChange(map_id=map_id, op=op))
+
+def encode_cursor(txid, change_id):
+    return f"{txid}.{change_id}"
+
+def decode_cursor(cursor):
+    if not cursor or cursor == '0':
+        return None
+    try:
+        txid, change_id = cursor.split('.')
+        return int(txid), int(change_id)
+    except ValueError:
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+
+def _horizon():
+    return db.session.execute(db.text("SELECT txid_snapshot_xmin(txid_current_snapshot())")).scalar()
+
+def current_cursor():
+    """A cursor past every transaction that has finished, for consumers that load the current state first."""
+    return encode_cursor(_horizon() - 1, MAX_CHANGE_ID)
+
+def change_entries_since(cursor, limit=500):
+    """
+    Log entries after `cursor` in (txid, id) order as (entries, next_cursor, has_more). Only
+    transactions older than the oldest one still in flight are served, so an entry can
+    never appear behind a cursor already handed out.
+    """
+    position = decode_cursor(cursor)
+    horizon = _horizon()
+
+    query = MapChange.query.filter(MapChange.txid < horizon)
+    if position is not None:
+        query = query.filter(tuple_(MapChange.txid, MapChange.id) > tuple_(*position))
+    entries = query.order_by(MapChange.txid, MapChange.id).limit(limit + 1).all()
+
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if has_more:
+        next_cursor = encode_cursor(entries[-1].txid, entries[-1].id)
+    else:
+        # Every transaction below the horizon has been served
+        next_cursor = encode_cursor(horizon - 1, MAX_CHANGE_ID)
+    return entries, next_cursor, has_more
+
+def changes_since(cursor, limit=500):
+    """
+    Returns the maps changed after `cursor` as (changes, next_cursor, has_more), paged like
+    change_entries_since(). Several entries for the same map collapse into its latest state:
+    a summary, or a tombstone when the map no longer exists.
+    """
+    entries, next_cursor, has_more = change_entries_since(cursor, limit)
+
+    latest = {}
+    for entry in entries:
+        latest.pop(entry.map_id, None)
+        latest[entry.map_id] = entry
+
+    live_maps = {}
+    upserted_ids = [map_id for map_id, entry in latest.items() if entry.op != 'delete']
+    if upserted_ids:
+        live_maps = {m.id: m for m in Map.query.filter(Map.id.in_(upserted_ids)).all()}
+
+    changes = []
+    for map_id, entry in latest.items():
+        map_ = live_maps.get(map_id)
+        changes.append({
+            "map_id": map_id,
+            "op": entry.op if map_ is not None else 'delete',
+            "changed_at": entry.created_at.isoformat() if entry.created_at else None,
+            "map": map_.serialize_summary() if map_ is not None else None,
+        })
+    return changes, next_cursor, has_more
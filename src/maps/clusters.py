@@ -0,0 +1,187 @@
+import math
+from ..extensions import db
+
+# Waypoint clusters for map viewports. Every waypoint is counted, per zoom level, in the
+# Web Mercator grid cell it falls in, with CELLS_PER_TILE x CELLS_PER_TILE cells to a
+# 256px tile (64px cells). The per-map counts in waypoint_cell_maps give each cell its
+# representative maps and let a map's contribution be removed without rereading its
+# waypoints; waypoint_cells holds their totals. Both are updated incrementally through
+# maps/aggregates.py, so a viewport query reads one row per visible cell.
+CELLS_PER_TILE = 4
+MAX_CLUSTER_ZOOM = 16  # Beyond this the client shows the waypoints themselves
+MAX_LATITUDE = 85.05112878  # Web Mercator bound
+MAX_VIEWPORT_CELLS = 4096
+REPRESENTATIVE_MAPS = 3
+
+# Cell of a waypoint at each zoom, clamped to the grid like cell_of() below
+CELL_SQL = """
+    SELECT z.zoom, w.map_id,
+           least(floor((w.longitude + 180) / 360 * z.cells), z.cells - 1)::int AS cell_x,
+           least(greatest(floor(
+               (1 - ln(tan(radians(w.lat)) + 1 / cos(radians(w.lat))) / pi()) / 2 * z.cells
+           ), 0), z.cells - 1)::int AS cell_y,
+           w.latitude, w.longitude
+    FROM (
+        SELECT map_id, latitude, longitude,
+               greatest(least(latitude, {max_latitude}), -{max_latitude}) AS lat
+        FROM waypoints
+        WHERE {where} AND latitude IS NOT NULL AND longitude IS NOT NULL
+          AND map_id NOT IN (SELECT id FROM maps WHERE deleted_at IS NOT NULL)
+    ) AS w
+    CROSS JOIN (
+        SELECT zoom, ({cells_per_tile} * 2 ^ zoom)::int AS cells FROM generate_series(0, {max_zoom}) AS zoom
+    ) AS z
+"""
+
+# Adds the cells of the selected waypoints. Rows are upserted in key order so concurrent
+# writers lock shared cells in the same order.
+ADD_CELLS_SQL = """
+    WITH delta AS (
+        SELECT zoom, cell_x, cell_y, map_id,
+               count(*) AS waypoint_count, sum(latitude) AS sum_latitude, sum(longitude) AS sum_longitude
+        FROM ({cells}) AS cells
+        GROUP BY zoom, cell_x, cell_y, map_id
+    ), per_map AS (
+        INSERT INTO waypoint_cell_maps (zoom, cell_x, cell_y, map_id, waypoint_count, sum_latitude, sum_longitude)
+        SELECT * FROM delta ORDER BY zoom, cell_x, cell_y, map_id
+        ON CONFLICT (zoom, cell_x, cell_y, map_id) DO UPDATE SET
+            waypoint_count = waypoint_cell_maps.waypoint_count + excluded.waypoint_count,
+            sum_latitude = waypoint_cell_maps.sum_latitude + excluded.sum_latitude,
+            sum_longitude = waypoint_cell_maps.sum_longitude + excluded.sum_longitude
+    )
+    INSERT INTO waypoint_cells (zoom, cell_x, cell_y, waypoint_count, sum_latitude, sum_longitude)
+    SELECT zoom, cell_x, cell_y, sum(waypoint_count), sum(sum_latitude), sum(sum_longitude)
+    FROM delta GROUP BY zoom, cell_x, cell_y ORDER BY zoom, cell_x, cell_y
+    ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET
+        waypoint_count = waypoint_cells.waypoint_count + excluded.waypoint_count,
+        sum_latitude = waypoint_cells.sum_latitude + excluded.sum_latitude,
+        sum_longitude = waypoint_cells.sum_longitude + excluded.sum_longitude
+"""
+
+# Removes the maps' cells and subtracts them from the totals, returning emptied cells
+REMOVE_MAPS_SQL = db.text("""
+    WITH removed AS (
+        DELETE FROM waypoint_cell_maps WHERE map_id = ANY(:map_ids)
+        RETURNING zoom, cell_x, cell_y, waypoint_count, sum_latitude, sum_longitude
+    ), totals AS (
+        SELECT zoom, cell_x, cell_y,
+               sum(waypoint_count) AS waypoint_count, sum(sum_latitude) AS sum_latitude, sum(sum_longitude) AS sum_longitude
+        FROM removed GROUP BY zoom, cell_x, cell_y
+    ), updated AS (
+        UPDATE waypoint_cells SET
+            waypoint_count = waypoint_cells.waypoint_count - totals.waypoint_count,
+            sum_latitude = waypoint_cells.sum_latitude - totals.sum_latitude,
+            sum_longitude = waypoint_cells.sum_longitude - totals.sum_longitude
+        FROM totals
+        WHERE waypoint_cells.zoom = totals.zoom AND waypoint_cells.cell_x = totals.cell_x AND waypoint_cells.cell_y = totals.cell_y
+        RETURNING waypoint_cells.zoom, waypoint_cells.cell_x, waypoint_cells.cell_y, waypoint_cells.waypoint_count
+    )
+    SELECT zoom, cell_x, cell_y FROM updated WHERE waypoint_count <= 0
+""")
+
+DELETE_EMPTY_CELLS_SQL = db.text("""
+    DELETE FROM waypoint_cells
+    USING unnest(CAST(:zooms AS smallint[]), CAST(:xs AS int[]), CAST(:ys AS int[])) AS empty(zoom, cell_x, cell_y)
+    WHERE waypoint_cells.zoom = empty.zoom AND waypoint_cells.cell_x = empty.cell_x AND waypoint_cells.cell_y = empty.cell_y
+""")
+
+CLUSTERS_SQL = """
+    SELECT c.cell_x, c.cell_y, c.waypoint_count,
+           c.sum_latitude / c.waypoint_count AS latitude,
+           c.sum_longitude / c.waypoint_count AS longitude,
+           ARRAY(
+               SELECT m.map_id FROM waypoint_cell_maps m
+               WHERE m.zoom = c.zoom AND m.cell_x = c.cell_x AND m.cell_y = c.cell_y
+               ORDER BY m.waypoint_count DESC, m.map_id
+               LIMIT :representatives
+           ) AS map_ids
+    FROM waypoint_cells c
+    WHERE c.zoom = :zoom AND c.cell_y BETWEEN :y_min AND :y_max AND ({x_ranges})
+    ORDER BY c.cell_y, c.cell_x
+"""
+
+def _cells_sql(where):
+    return CELL_SQL.format(
+        where=where, max_latitude=MAX_LATITUDE, cells_per_tile=CELLS_PER_TILE, max_zoom=MAX_CLUSTER_ZOOM,
+    )
+
+def grid_size(zoom):
+    return CELLS_PER_TILE * 2 ** zoom
+
+def cell_of(latitude, longitude, zoom):
+    """(x, y) of the grid cell at `zoom` containing the point, y growing southwards."""
+    cells = grid_size(zoom)
+    lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+    x = min(math.floor((longitude + 180) / 360 * cells), cells - 1)
+    y = math.floor((1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * cells)
+    return max(0, x), min(max(y, 0), cells - 1)
+
+def add_waypoint_cells(waypoint_ids=None, map_ids=None):
+    """Counts the waypoints (by id, or every waypoint of `map_ids`) into their cells, in the current transaction."""
+    if waypoint_ids is not None:
+        where, params = "id = ANY(:ids)", {"ids": list(waypoint_ids)}
+    else:
+        where, params = "map_id = ANY(:ids)", {"ids": list(map_ids)}
+    if not params["ids"]:
+        return
+    db.session.execute(db.text(ADD_CELLS_SQL.format(cells=_cells_sql(where))), params)
+
+def remove_map_cells(map_ids):
+    """Takes every waypoint of `map_ids` out of the cells, e.g. before the waypoints are replaced or deleted."""
+    map_ids = list(map_ids)
+    if not map_ids:
+        return
+    empty = db.session.execute(REMOVE_MAPS_SQL, {"map_ids": map_ids}).all()
+    if empty:
+        db.session.execute(DELETE_EMPTY_CELLS_SQL, {
+            "zooms": [row.zoom for row in empty],
+            "xs": [row.cell_x for row in empty],
+            "ys": [row.cell_y for row in empty],
+        })
+
+def rebuild_waypoint_cells(map_ids=None):
+    """Recomputes the cells of `map_ids`, or all of them, from the waypoints."""
+    if map_ids is None:
+        db.session.execute(db.text("TRUNCATE waypoint_cell_maps, waypoint_cells"))
+        db.session.execute(db.text(ADD_CELLS_SQL.format(cells=_cells_sql('true'))))
+        return
+    remove_map_cells(map_ids)
+    add_waypoint_cells(map_ids=map_ids)
+
+def parse_bbox(raw_bbox):
+    """"min_lng,min_lat,max_lng,max_lat" -> floats. min_lng > max_lng means the box crosses the antimeridian."""
+    try:
+        min_lng, min_lat, max_lng, max_lat = (float(value) for value in raw_bbox.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError("bbox must be min_lng,min_lat,max_lng,max_lat.")
+    if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("bbox is out of range or has min_lat above max_lat.")
+    return min_lng, min_lat, max_lng, max_lat
+
+def waypoint_clusters(bbox, zoom):
+    """Clusters of the grid cells at `zoom` (capped at MAX_CLUSTER_ZOOM) that intersect `bbox`."""
+    zoom = min(zoom, MAX_CLUSTER_ZOOM)
+    min_lng, min_lat, max_lng, max_lat = bbox
+    x_min, y_max = cell_of(min_lat, min_lng, zoom)
+    x_max, y_min = cell_of(max_lat, max_lng, zoom)
+    if x_min <= x_max:
+        x_ranges = [(x_min, x_max)]
+    else:
+        x_ranges = [(x_min, grid_size(zoom) - 1), (0, x_max)]
+
+    cell_count = sum(high - low + 1 for low, high in x_ranges) * (y_max - y_min + 1)
+    if cell_count > MAX_VIEWPORT_CELLS:
+        raise ValueError(f"bbox covers {cell_count} cells at zoom {zoom}, at most {MAX_VIEWPORT_CELLS} are allowed.")
+
+    params = {"zoom": zoom, "y_min": y_min, "y_max": y_max, "representatives": REPRESENTATIVE_MAPS}
+    conditions = []
+    for i, (low, high) in enumerate(x_ranges):
+        conditions.append(f"c.cell_x BETWEEN :x_min_{i} AND :x_max_{i}")
+        params[f"x_min_{i}"], params[f"x_max_{i}"] = low, high
+    rows = db.session.execute(db.text(CLUSTERS_SQL.format(x_ranges=' OR '.join(conditions))), params)
+    return [{
+        "count": row.waypoint_count,
+        "latitude": row.latitude,
+        "longitude": row.longitude,
+        "map_ids": list(row.map_ids),
+    } for row in rows]
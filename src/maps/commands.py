@@ -0,0 +1,130 @@
+import time
+import click
+from flask.cli import AppGroup
+from ..auth.models import User
+from ..config import GeocoderConfig, PurgeConfig
+from ..extensions import db
+from ..soft_delete import purge_deleted
+from .aggregates import repair_map_aggregates
+from .filter_cache import filtered_maps_cache
+from .payload_cache import map_payload_cache
+from .bulk import ImportRecordError, backfill_places, export_maps, import_maps
+from .geocoder import build_index, read_country_names, reset_geocoder
+from .leaderboards import decay_trending
+
+maps_cli = AppGroup('maps', help='Map maintenance commands.')
+
+@maps_cli.command('repair-aggregates')
+@click.option('--map-id', 'map_ids', multiple=True, type=int, help='Only repair these maps (repeatable).')
+def repair_aggregates_command(map_ids):
+    """Recompute price, countries, cities, duration, waypoint count and bounding box from the waypoints."""
+    updated = repair_map_aggregates(map_ids or None)
+    db.session.commit()
+    map_payload_cache.clear()
+    filtered_maps_cache.clear()
+    click.echo(f"Recomputed aggregates for {updated} maps.")
+
+@maps_cli.command('decay-trending')
+def decay_trending_command():
+    """Drop maps whose trending score has decayed away from the trending index. Run periodically, e.g. hourly."""
+    dropped = decay_trending()
+    db.session.commit()
+    click.echo(f"Dropped {dropped} maps from trending.")
+
+@maps_cli.command('export')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--images-dir', type=click.Path(file_okay=False), help='Write images here and reference them by path instead of inlining them as base64.')
+@click.option('--no-images', is_flag=True, help='Leave images out of the export.')
+def export_command(output, images_dir, no_images):
+    """Stream every map with its waypoints to OUTPUT (default stdout) as NDJSON."""
+    count = export_maps(output, images_dir=False if no_images else images_dir)
+    click.echo(f"Exported {count} maps.", err=True)
+
+@maps_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images-dir', type=click.Path(exists=True, file_okay=False), help='Base directory of image paths (default: the directory of PATH).')
+@click.option('--batch-size', default=500, show_default=True, help='Maps inserted per transaction.')
+@click.option('--checkpoint', 'checkpoint_path', type=click.Path(dir_okay=False), help='Progress file, a rerun resumes after the last committed batch (default: PATH.checkpoint).')
+@click.option('--no-checkpoint', is_flag=True, help='Do not record progress.')
+@click.option('--creator-email', help='Creator of maps whose creator is missing or unknown.')
+def import_command(path, images_dir, batch_size, checkpoint_path, no_checkpoint, creator_email):
+    """Load maps with their waypoints from an NDJSON file written by `flask maps export`."""
+    creator_id = None
+    if creator_email:
+        creator = User.query.filter_by(email=creator_email).first()
+        if creator is None:
+            raise click.ClickException(f"No user with email {creator_email}")
+        creator_id = creator.id
+
+    if not no_checkpoint:
+        checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+
+    started = time.monotonic()
+    def progress(imported, line_no):
+        click.echo(f"{imported} maps imported (line {line_no}, {imported / (time.monotonic() - started):.0f} maps/s)", err=True)
+
+    try:
+        imported = import_maps(path, images_dir=images_dir, batch_size=batch_size,
+                               checkpoint_path=checkpoint_path, creator_id=creator_id, progress=progress)
+    except (ImportRecordError, OSError) as e:
+        raise click.ClickException(f"{e}. Batches before this one are committed, rerun to resume.")
+    filtered_maps_cache.clear()
+    click.echo(f"Imported {imported} maps.")
+
+@maps_cli.command('build-geocoder')
+@click.argument('cities', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--country-info', type=click.Path(exists=True, dir_okay=False), help='GeoNames countryInfo.txt, for country names instead of ISO codes.')
+@click.option('--min-population', default=0, show_default=True, help='Leave out smaller places.')
+def build_geocoder_command(cities, country_info, min_population):
+    """Build the reverse geocoding index from a GeoNames cities file (e.g. cities15000.txt, default the bundled extract)."""
+    if cities is None:
+        cities = GeocoderConfig.CITIES_FILE
+        country_info = country_info or GeocoderConfig.COUNTRY_INFO_FILE
+    country_names = read_country_names(country_info) if country_info else None
+    try:
+        places = build_index(cities, GeocoderConfig.DIRECTORY, country_names, min_population)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    reset_geocoder()
+    click.echo(f"Indexed {places} places in {GeocoderConfig.DIRECTORY}. Restart the workers to pick it up.")
+
+@maps_cli.command('backfill-places')
+@click.option('--batch-size', default=5000, show_default=True, help='Waypoints updated per transaction.')
+@click.option('--overwrite', is_flag=True, help='Replace cities and countries that are already set.')
+def backfill_places_command(batch_size, overwrite):
+    """Fill in waypoint cities and countries from their coordinates with the offline index."""
+    def progress(updated, last_id):
+        click.echo(f"{updated} waypoints updated (up to id {last_id})", err=True)
+
+    try:
+        updated = backfill_places(batch_size=batch_size, overwrite=overwrite, progress=progress)
+    except FileNotFoundError as e:
+        raise click.ClickException(str(e))
+    map_payload_cache.clear()
+    filtered_maps_cache.clear()
+    click.echo(f"Filled in places for {updated} waypoints.")
+
+@maps_cli.command('purge-deleted')
+@click.option('--grace-seconds', default=PurgeConfig.GRACE_SECONDS, show_default=True, help='Only purge what was deleted longer ago than this.')
+@click.option('--map-batch-size', default=PurgeConfig.MAP_BATCH_SIZE, show_default=True, help='Maps or users removed per transaction.')
+@click.option('--waypoint-batch-size', default=PurgeConfig.WAYPOINT_BATCH_SIZE, show_default=True, help='Waypoints removed per transaction.')
+@click.option('--pause', 'pause_seconds', default=PurgeConfig.PAUSE_SECONDS, show_default=True, help='Seconds to wait between batches.')
+@click.option('--max-seconds', type=float, help='Stop after this long, the next run continues.')
+def purge_deleted_command(grace_seconds, map_batch_size, waypoint_batch_size, pause_seconds, max_seconds):
+    """Remove soft-deleted maps, their waypoints and ratings, and deleted accounts. Run periodically, e.g. hourly."""
+    def progress(kind, purged):
+        click.echo(f"{purged} {kind} purged", err=True)
+
+    purged = purge_deleted(grace_seconds, map_batch_size, waypoint_batch_size, pause_seconds, max_seconds, progress)
+    click.echo(f"Purged {purged['maps']} maps with {purged['waypoints']} waypoints and {purged['users']} users.")
+
+@maps_cli.command('cache-stats')
+@click.option('--reset', is_flag=True, help='Zero the counters after printing them.')
+def cache_stats_command(reset):
+    """Print the hit rates of the map caches shared by the workers of this host."""
+    for name, cache in (('map payloads', map_payload_cache), ('filtered pages', filtered_maps_cache)):
+        stats = cache.stats()
+        hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else 'n/a'
+        click.echo(f"{name}: {stats['hits']} hits, {stats['misses']} misses, hit rate {hit_rate}")
+        if reset:
+            cache.reset_stats()
@@ -0,0 +1,83 @@
+from sqlalchemy import Float, Text, cast, extract, func, literal, null, select, union_all
+from sqlalchemy.dialects.postgresql import array
+from ..cache import LRUCache
+from ..extensions import db
+from .filters import filter_maps
+from .models import Map
+from .signals import map_changed
+
+# Histogram bucket lower edges; the last bucket is open-ended
+PRICE_BUCKETS = (0, 25, 50, 100, 250, 500, 1000)
+DURATION_BUCKETS_DAYS = (0, 1, 2, 3, 5, 7, 14, 30)
+
+FACET_CACHE_TTL_SECONDS = 60  # Bounds staleness for writes handled by other workers
+
+# Keyed by the filter parameters; cleared on every map write in this worker
+facet_cache = LRUCache(maxsize=256, ttl=FACET_CACHE_TTL_SECONDS)
+
+def _value_counts(name, values):
+    unnested = select(func.unnest(values).label('value')).subquery()
+    return (
+        select(literal(name).label('facet'), cast(unnested.c.value, Text).label('value'), func.count().label('count'))
+        .group_by(unnested.c.value)
+    )
+
+def _bucket_counts(name, value, edges):
+    bucket = func.width_bucket(value, array([float(edge) for edge in edges]))
+    return (
+        select(literal(name).label('facet'), cast(bucket, Text).label('value'), func.count().label('count'))
+        .where(value.isnot(None))
+        .group_by(bucket)
+    )
+
+def _histogram(counts, edges):
+    buckets = []
+    for idx, low in enumerate(edges):
+        high = edges[idx + 1] if idx + 1 < len(edges) else None
+        buckets.append({"min": low, "max": high, "count": counts.get(str(idx + 1), 0)})
+    return buckets
+
+def _sorted_counts(counts):
+    return [{"value": value, "count": count} for value, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+def compute_facets(args):
+    """Counts per country, city and tag plus price/duration histograms for the maps matching `args`, in one statement."""
+    # Deleted maps are filtered by hand, the soft delete criteria do not reach into a CTE
+    filtered = filter_maps(Map.query.filter(Map.deleted_at.is_(None)), args).with_entities(
+        Map.countries, Map.cities, Map.tags, Map.price,
+        (extract('epoch', Map.duration) / 86400).label('duration_days'),
+    ).cte('filtered')
+
+    statement = union_all(
+        select(literal('total'), cast(null(), Text), func.count()).select_from(filtered),
+        _value_counts('countries', filtered.c.countries),
+        _value_counts('cities', filtered.c.cities),
+        _value_counts('tags', filtered.c.tags),
+        _bucket_counts('price', cast(filtered.c.price, Float), PRICE_BUCKETS),
+        _bucket_counts('duration', cast(filtered.c.duration_days, Float), DURATION_BUCKETS_DAYS),
+    )
+
+    grouped = {"total": {}, "countries": {}, "cities": {}, "tags": {}, "price": {}, "duration": {}}
+    for facet, value, count in db.session.execute(statement):
+        grouped[facet][value] = count
+
+    return {
+        "total": grouped["total"].get(None, 0),
+        "countries": _sorted_counts(grouped["countries"]),
+        "cities": _sorted_counts(grouped["cities"]),
+        "tags": _sorted_counts(grouped["tags"]),
+        "price": _histogram(grouped["price"], PRICE_BUCKETS),
+        "duration": _histogram(grouped["duration"], DURATION_BUCKETS_DAYS),
+    }
+
+def get_facets(args):
+    cache_key = tuple(sorted(args.items(multi=True)))
+    facets = facet_cache.get(cache_key)
+    if facets is None:
+        facets = compute_facets(args)
+        facet_cache.set(cache_key, facets)
+    return facets
+
+@map_changed.connect
+def _on_map_changed(sender, map_id, op):
+    facet_cache.clear()
@@ -0,0 +1,53 @@
+import json
+from ..config import FilterCacheConfig, SharedCacheConfig
+from ..replicas import primary_reads
+from ..shared_cache import SharedCache
+from .filters import parse_filters
+from .payload_cache import entry_response, render_entry
+from .signals import map_changed
+
+# Pages of GET /maps/get_filtered_maps_with_waypoints, serialized and compressed, shared by
+# the workers of a host. Popular filter combinations are requested by many users at once,
+# so the key is the normalized filter (see parse_filters()) rather than the raw query
+# string. Any map write can move a map in or out of any page, so all the pages share one
+# version and every map_changed invalidates them together; the TTL bounds what this host
+# does not see. Only pages of at most MAX_LIMIT maps are cached, larger listings are
+# still streamed.
+filtered_maps_cache = SharedCache(
+    'filtered-maps', SharedCacheConfig.DIRECTORY, FilterCacheConfig.MAX_BYTES, ttl=FilterCacheConfig.TTL_SECONDS,
+)
+FILTERED_PAGES = 'pages'  # The version slot shared by every page
+
+def filtered_variant(args, limit, offset, sql_json, encoding):
+    """Cache key of a listing page, None when the page is not cached."""
+    if limit is None or not 0 <= limit <= FilterCacheConfig.MAX_LIMIT:
+        return None
+    sort = args.get('sort') or None
+    return json.dumps({
+        "filters": parse_filters(args),
+        "sort": sort,
+        "order": args.get('order', 'asc').lower() if sort else None,
+        "limit": limit,
+        "offset": offset or 0,
+        # The two read paths print numbers differently (10 vs 10.0)
+        "render": 'sql' if sql_json else 'orm',
+        "encoding": encoding or 'identity',
+    }, sort_keys=True, separators=(',', ':'))
+
+def filtered_response(variant, encoding, load):
+    """
+    Response for a page of the filtered listing, from the cache or built from `load()` (its
+    JSON body as bytes, read from the primary) and cached.
+    """
+    entry = filtered_maps_cache.get(FILTERED_PAGES, variant)
+    if entry is None:
+        # Taken before the query, so a write landing during it is not cached over
+        version = filtered_maps_cache.version(FILTERED_PAGES)
+        with primary_reads():
+            entry = render_entry(load(), encoding)
+        filtered_maps_cache.set(FILTERED_PAGES, variant, entry, version)
+    return entry_response(entry)
+
+@map_changed.connect
+def _on_map_changed(sender, map_id, op):
+    filtered_maps_cache.invalidate(FILTERED_PAGES)
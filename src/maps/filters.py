@@ -0,0 +1,122 @@
+from datetime import timedelta
+from .models import Map
+
+def _parse_range(value):
+    """(low, high) floats from "low, high", None when malformed."""
+    try:
+        low, high = [float(x.strip()) for x in value.split(',')]
+    except ValueError:
+        return None
+    return low, high
+
+def parse_filters(args):
+    """
+    The listing filters in the request query parameters, normalized so that equivalent
+    requests give equal results: ranges as (low, high) and value lists sorted without
+    duplicates. Malformed values are left out rather than rejected, matching the listing endpoint.
+    """
+    price_param = args.get('price')          # Expected format: "20, 80"
+    duration_param = args.get('duration')    # Expected format: "1, 10" (days)
+    rating_param = args.get('rating')        # Expected format: "1, 5"
+    country_param = args.get('countries')    # Expected format: "USA", "Canada" or "" for no country
+    city_param = args.get('cities')          # Expected format: "New York", "Toronto" or "" for no city
+    tags_param = args.get('tags')            # Expected format: "tag1, tag2" or "" for no tags
+
+    filters = {}
+    if 'creator_id' in args:
+        try:
+            filters['creator_id'] = int(args['creator_id'])
+        except ValueError:
+            pass  # Log error if needed
+
+    for name, param in (('price', price_param), ('duration', duration_param), ('rating', rating_param)):
+        if param:
+            bounds = _parse_range(param)
+            if bounds is not None:
+                filters[name] = bounds
+
+    for name, param in (('countries', country_param), ('cities', city_param), ('tags', tags_param)):
+        if param:
+            filters[name] = sorted({value.strip() for value in param.split(',')})
+    return filters
+
+def filter_maps(query, args):
+    """Applies the listing filters from the request query parameters (see parse_filters()) to a Map query."""
+    filters = parse_filters(args)
+
+    if 'creator_id' in filters:
+        query = query.filter(Map.creator_id == filters['creator_id'])
+
+    # Filter by price range if provided
+    if 'price' in filters:
+        low_price, high_price = filters['price']
+        query = query.filter(Map.price >= low_price, Map.price <= high_price)
+
+    # Filter by duration range if provided, in days
+    if 'duration' in filters:
+        low_days, high_days = filters['duration']
+        query = query.filter(Map.duration >= timedelta(days=low_days)).filter(Map.duration <= timedelta(days=high_days))
+
+    # Filter by rating range if provided, on the copy of the average kept on the map
+    if 'rating' in filters:
+        low_rating, high_rating = filters['rating']
+        query = query.filter(Map.average_rating >= low_rating, Map.average_rating <= high_rating)
+
+    # Filter by country if provided
+    if 'countries' in filters:
+        query = query.filter(Map.countries.overlap(filters['countries']))
+
+    # Filter by city if provided
+    if 'cities' in filters:
+        query = query.filter(Map.cities.overlap(filters['cities']))
+
+    # Filter by tags if provided
+    if 'tags' in filters:
+        # Assuming Map.tags is stored as an ARRAY (or JSON) and your DB supports an "overlap" operator.
+        query = query.filter(Map.tags.overlap(filters['tags']))
+
+    return query
+
+SORT_COLUMNS = {
+    "price": Map.price,
+    "rating": Map.average_rating,
+    "duration": Map.duration,
+    "created_at": Map.created_at,
+}
+NULLABLE_SORTS = {"price", "duration"}  # Maps without a value go last in either direction
+
+def parse_sort(args):
+    """
+    ORDER BY clauses for the `sort` (price, rating, duration or created_at) and `order`
+    (asc or desc) parameters, by id when no sort is requested so that limit/offset pages
+    never overlap. Each sort matches one of the Map indexes. Raises ValueError for unknown values.
+    """
+    sort = args.get('sort')
+    if not sort:
+        return [Map.id.asc()]
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+    order = args.get('order', 'asc').lower()
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+
+    column = SORT_COLUMNS[sort]
+    if order == 'asc':
+        return [column.asc(), Map.id.asc()]
+    return [column.desc().nullslast() if sort in NULLABLE_SORTS else column.desc(), Map.id.desc()]
+
+def parse_page(args):
+    """
+    (limit, offset) from the query parameters. A missing or malformed value is None, like
+    request.args.get(name, type=int); a negative one raises ValueError.
+    """
+    page = []
+    for name in ('limit', 'offset'):
+        try:
+            value = int(args[name])
+        except (KeyError, ValueError):
+            value = None
+        if value is not None and value < 0:
+            raise ValueError(f"{name} must be a non-negative integer")
+        page.append(value)
+    return tuple(page)
@@ -0,0 +1,48 @@
+from ..extensions import db
+from .clusters import add_waypoint_cells
+
+# Forking copies a map and its waypoints inside the database with one INSERT ... SELECT
+# statement, so images and waypoints never pass through the app server. The copy gets a
+# fresh rating, zeroed popularity counters and the forking user as creator; the aggregates
+# derived from the waypoints are copied along with them, since the waypoints are the same.
+FORK_MAP_SQL = db.text("""
+    WITH rating AS (
+        INSERT INTO ratings (average_rating, num_ratings)
+        SELECT 0, 0 WHERE EXISTS (SELECT 1 FROM maps WHERE id = :map_id AND deleted_at IS NULL)
+        RETURNING id
+    ), fork AS (
+        INSERT INTO maps (
+            title, description, duration, creator_id, rating_id, tags, image_data, price,
+            created_at, updated_at, countries, cities, waypoint_count,
+            min_latitude, max_latitude, min_longitude, max_longitude,
+            save_count, view_count, trending_score, average_rating
+        )
+        SELECT coalesce(:title, m.title), m.description, m.duration, :creator_id, rating.id, m.tags, m.image_data, m.price,
+               timezone('utc', now()), timezone('utc', now()), m.countries, m.cities, m.waypoint_count,
+               m.min_latitude, m.max_latitude, m.min_longitude, m.max_longitude,
+               0, 0, NULL, 0
+        FROM maps m CROSS JOIN rating
+        WHERE m.id = :map_id AND m.deleted_at IS NULL
+        RETURNING id
+    ), waypoints_copied AS (
+        -- Ordered so the copies keep the route order, which follows waypoint ids
+        INSERT INTO waypoints (
+            map_id, title, description, info, latitude, longitude, times_of_day,
+            price, rating, duration, image_data, country, city
+        )
+        SELECT fork.id, w.title, w.description, w.info, w.latitude, w.longitude, w.times_of_day,
+               w.price, w.rating, w.duration, w.image_data, w.country, w.city
+        FROM waypoints w CROSS JOIN fork
+        WHERE w.map_id = :map_id
+        ORDER BY w.id
+    )
+    SELECT id FROM fork
+""")
+
+def fork_map(map_id, creator_id, title=None):
+    """Copies map `map_id` for `creator_id` in the current transaction. Returns the new map id, or None if there is no such map."""
+    fork_id = db.session.execute(FORK_MAP_SQL, {"map_id": map_id, "creator_id": creator_id, "title": title}).scalar()
+    if fork_id is None:
+        return None
+    add_waypoint_cells(map_ids=[fork_id])
+    return fork_id
@@ -0,0 +1,246 @@
+import csv
+import gzip
+import os
+import threading
+import numpy as np
+from ..config import GeocoderConfig
+from ..extensions import logger
+from .geo import EARTH_RADIUS_KM, unit_vectors
+
+# Offline reverse geocoding of waypoint coordinates to the nearest city and its country.
+#
+# The index is built once from a GeoNames dump (`flask maps build-geocoder cities15000.txt
+# --country-info countryInfo.txt`, from https://download.geonames.org/export/dump/) into
+# .npy files that every worker memory-maps, so the pages are shared through the page cache.
+# Without one, the first worker to start builds it from the cities15000 extract shipped in
+# data/geocoder.
+# Places are bucketed into 1 degree cells and sorted by cell; a lookup compares each point
+# with the places in the 3x3 cells around it, then 5x5, falling back to every place for the
+# rare points whose nearest candidate is farther than the cells are guaranteed to cover.
+
+CELL_DEGREES = 1
+GRID_ROWS, GRID_COLUMNS = 180 // CELL_DEGREES, 360 // CELL_DEGREES
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+SEARCH_RADII = (1, 2, None)  # Neighbourhoods tried in turn, None compares with every place
+BRUTE_FORCE_CHUNK = 256  # Points compared with every place at once
+INDEX_FILES = ('points', 'cell_offsets', 'city_names', 'country_index', 'country_names')
+
+# GeoNames tab separated columns
+NAME_COLUMN, LATITUDE_COLUMN, LONGITUDE_COLUMN, COUNTRY_CODE_COLUMN, POPULATION_COLUMN = 1, 4, 5, 8, 14
+
+def _cells(latitudes, longitudes):
+    rows = np.clip(np.floor((latitudes + 90) / CELL_DEGREES), 0, GRID_ROWS - 1).astype(np.int64)
+    columns = np.floor((longitudes + 180) / CELL_DEGREES).astype(np.int64) % GRID_COLUMNS
+    return rows, columns
+
+def read_country_names(path):
+    """{ISO code: country name} from a GeoNames countryInfo.txt."""
+    names = {}
+    with open(path, encoding='utf-8') as country_file:
+        for row in csv.reader(country_file, delimiter='\t'):
+            if row and not row[0].startswith('#') and len(row) > 4:
+                names[row[0]] = row[4]
+    return names
+
+def build_index(cities_path, directory, country_names=None, min_population=0):
+    """Writes the index for a GeoNames cities file to `directory`. Returns the number of places."""
+    names, latitudes, longitudes, countries = [], [], [], []
+    opener = gzip.open if cities_path.endswith('.gz') else open
+    with opener(cities_path, 'rt', encoding='utf-8') as cities_file:
+        for row in csv.reader(cities_file, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if len(row) <= POPULATION_COLUMN or int(row[POPULATION_COLUMN] or 0) < min_population:
+                continue
+            names.append(row[NAME_COLUMN])
+            latitudes.append(float(row[LATITUDE_COLUMN]))
+            longitudes.append(float(row[LONGITUDE_COLUMN]))
+            code = row[COUNTRY_CODE_COLUMN]
+            countries.append((country_names or {}).get(code, code))
+    if not names:
+        raise ValueError(f"No places found in {cities_path}")
+
+    latitudes, longitudes = np.array(latitudes), np.array(longitudes)
+    rows, columns = _cells(latitudes, longitudes)
+    cells = rows * GRID_COLUMNS + columns
+    order = np.argsort(cells, kind='stable')
+    cell_offsets = np.searchsorted(cells[order], np.arange(GRID_ROWS * GRID_COLUMNS + 1))
+    country_names_sorted, country_index = np.unique(np.array(countries), return_inverse=True)
+
+    os.makedirs(directory, exist_ok=True)
+    arrays = {
+        'points': unit_vectors(latitudes[order], longitudes[order]),
+        'cell_offsets': cell_offsets.astype(np.int64),
+        'city_names': np.array(names)[order],
+        'country_index': country_index[order].astype(np.int32),
+        'country_names': country_names_sorted,
+    }
+    for name, array in arrays.items():
+        # Written aside and renamed, so workers never map a half-written file, even with several building at once
+        tmp_path = os.path.join(directory, f"{name}.{os.getpid()}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+    return len(names)
+
+class ReverseGeocoder:
+    """Nearest place lookups over an index written by build_index(), memory-mapped from `directory`."""
+
+    def __init__(self, directory, max_city_km, max_country_km):
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r') for name in INDEX_FILES}
+        self.points = arrays['points']
+        self.cell_offsets = arrays['cell_offsets']
+        self.city_names = arrays['city_names']
+        self.country_index = arrays['country_index']
+        self.country_names = arrays['country_names']
+        self.max_city_km = max_city_km
+        self.max_country_km = max_country_km
+
+    def _nearest_in_neighbourhood(self, latitudes, longitudes, queries, radius):
+        """
+        (place index, cosine of the angle) per query among the places of the cells within
+        `radius` cells of its own, -1 where there are none.
+        """
+        side = 2 * radius + 1
+        rows, columns = _cells(latitudes, longitudes)
+        offsets = np.arange(-radius, radius + 1)
+        neighbour_rows = (rows[:, None, None] + offsets[None, :, None]).repeat(side, axis=2)
+        neighbour_columns = ((columns[:, None, None] + offsets[None, None, :]) % GRID_COLUMNS).repeat(side, axis=1)
+        valid = ((neighbour_rows >= 0) & (neighbour_rows < GRID_ROWS)).reshape(len(queries), side * side)
+        cells = (np.clip(neighbour_rows, 0, GRID_ROWS - 1) * GRID_COLUMNS + neighbour_columns).reshape(len(queries), side * side)
+
+        starts = self.cell_offsets[cells]
+        lengths = np.where(valid, self.cell_offsets[cells + 1] - starts, 0)
+        best = np.full(len(queries), -1, dtype=np.int64)
+        best_cos = np.full(len(queries), -2.0)
+        total = int(lengths.sum())
+        if total == 0:
+            return best, best_cos
+
+        # Every (query, candidate place) pair as flat arrays
+        flat_lengths = lengths.ravel()
+        query_of = np.repeat(np.repeat(np.arange(len(queries)), side * side), flat_lengths)
+        candidates = (np.arange(total) - np.repeat(np.cumsum(flat_lengths) - flat_lengths, flat_lengths)
+                      + np.repeat(starts.ravel(), flat_lengths))
+        cosines = np.einsum('ij,ij->i', queries[query_of], self.points[candidates])
+
+        order = np.lexsort((-cosines, query_of))
+        first = order[np.r_[True, query_of[order][1:] != query_of[order][:-1]]]
+        best[query_of[first]] = candidates[first]
+        best_cos[query_of[first]] = cosines[first]
+        return best, best_cos
+
+    def _nearest_anywhere(self, queries):
+        best = np.empty(len(queries), dtype=np.int64)
+        best_cos = np.empty(len(queries))
+        for start in range(0, len(queries), BRUTE_FORCE_CHUNK):
+            cosines = queries[start:start + BRUTE_FORCE_CHUNK] @ self.points.T
+            best[start:start + BRUTE_FORCE_CHUNK] = cosines.argmax(axis=1)
+            best_cos[start:start + BRUTE_FORCE_CHUNK] = cosines.max(axis=1)
+        return best, best_cos
+
+    def lookup(self, latitudes, longitudes):
+        """(cities, countries) lists for the points, None where no place is close enough."""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if len(latitudes) == 0:
+            return [], []
+        queries = unit_vectors(latitudes, longitudes)
+        best = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf)
+        # A neighbourhood of `radius` cells covers at least that many cells' width around the
+        # point, narrowed by the meridians converging towards the poles. A point is settled
+        # once its nearest candidate is inside that, or the whole threshold is.
+        unsure = np.ones(len(queries), dtype=bool)
+        for radius in SEARCH_RADII:
+            indices = np.flatnonzero(unsure)
+            if radius is None:
+                found, found_cos = self._nearest_anywhere(queries[indices])
+            else:
+                found, found_cos = self._nearest_in_neighbourhood(latitudes[indices], longitudes[indices], queries[indices], radius)
+            best[indices] = found
+            distances[indices] = np.where(found >= 0, EARTH_RADIUS_KM * np.arccos(np.clip(found_cos, -1.0, 1.0)), np.inf)
+            if radius is None:
+                break
+            edge_latitudes = np.minimum(np.abs(latitudes[indices]) + (radius + 1) * CELL_DEGREES, 90)
+            covered = radius * CELL_DEGREES * KM_PER_DEGREE * np.cos(np.radians(edge_latitudes))
+            unsure[indices] = (found < 0) | ((distances[indices] > covered) & (covered < self.max_country_km))
+            if not unsure.any():
+                break
+
+        places = np.maximum(best, 0)
+        city_names = np.asarray(self.city_names[places]).tolist()
+        country_names = np.asarray(self.country_names[np.asarray(self.country_index[places])]).tolist()
+        cities = [name if distance <= self.max_city_km else None for name, distance in zip(city_names, distances.tolist())]
+        countries = [name if distance <= self.max_country_km else None for name, distance in zip(country_names, distances.tolist())]
+        return cities, countries
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+_geocoder_missing = False
+
+def _load_geocoder():
+    return ReverseGeocoder(GeocoderConfig.DIRECTORY, GeocoderConfig.MAX_CITY_KM, GeocoderConfig.MAX_COUNTRY_KM)
+
+def build_bundled_index():
+    """Builds the index from GeocoderConfig.CITIES_FILE. Returns the number of places, None without the file."""
+    if not os.path.exists(GeocoderConfig.CITIES_FILE):
+        return None
+    country_names = read_country_names(GeocoderConfig.COUNTRY_INFO_FILE) if os.path.exists(GeocoderConfig.COUNTRY_INFO_FILE) else None
+    return build_index(GeocoderConfig.CITIES_FILE, GeocoderConfig.DIRECTORY, country_names)
+
+def get_geocoder():
+    """The index from GeocoderConfig.DIRECTORY, built from the bundled extract if need be, or None."""
+    global _geocoder, _geocoder_missing
+    if _geocoder is None and not _geocoder_missing:
+        with _geocoder_lock:
+            if _geocoder is None and not _geocoder_missing:
+                try:
+                    _geocoder = _load_geocoder()
+                except FileNotFoundError:
+                    try:
+                        places = build_bundled_index()
+                    except OSError as e:
+                        logger.warning(f"Could not build the reverse geocoding index in {GeocoderConfig.DIRECTORY}: {e}")
+                        places = None
+                    if places is None:
+                        _geocoder_missing = True
+                        logger.warning(f"No reverse geocoding index in {GeocoderConfig.DIRECTORY}, waypoint places are not filled in")
+                    else:
+                        logger.info(f"Indexed {places} places from {GeocoderConfig.CITIES_FILE} in {GeocoderConfig.DIRECTORY}")
+                        _geocoder = _load_geocoder()
+    return _geocoder
+
+def reset_geocoder():
+    """Drops the loaded index, e.g. after it was rebuilt."""
+    global _geocoder, _geocoder_missing
+    with _geocoder_lock:
+        _geocoder, _geocoder_missing = None, False
+
+def fill_places(waypoints, get=getattr, set_field=setattr):
+    """
+    Sets the missing city and country of waypoints (objects, or dicts with get=dict.get
+    and set_field=dict.__setitem__) from their coordinates. Values from the client are
+    kept. Returns the number of waypoints looked up.
+    """
+    geocoder = get_geocoder()
+    if geocoder is None:
+        return 0
+    missing = [
+        waypoint for waypoint in waypoints
+        if (not get(waypoint, 'city', None) or not get(waypoint, 'country', None))
+        and get(waypoint, 'latitude', None) is not None and get(waypoint, 'longitude', None) is not None
+    ]
+    if not missing:
+        return 0
+    cities, countries = geocoder.lookup(
+        [float(get(waypoint, 'latitude', None)) for waypoint in missing],
+        [float(get(waypoint, 'longitude', None)) for waypoint in missing],
+    )
+    for waypoint, city, country in zip(missing, cities, countries):
+        if not get(waypoint, 'city', None) and city:
+            set_field(waypoint, 'city', city)
+        if not get(waypoint, 'country', None) and country:
+            set_field(waypoint, 'country', country)
+    return len(missing)
+
+def init_geocoder(app):
+    # Maps the index at startup so the first write does not pay for it
+    get_geocoder()
@@ -0,0 +1,75 @@
+import numpy as np
+from sqlalchemy import select
+from .models import Waypoint
+
+# Compact waypoint geometry for drawing routes, in place of full waypoint objects.
+# Coordinates are scaled by 10^precision, rounded to integers and delta encoded
+# (each point relative to the previous one, the first one relative to 0,0):
+#   polyline  the Google encoded polyline algorithm over those deltas, as JSON
+#   packed    application/octet-stream of little-endian int32, one record per map:
+#             map_id, point count, then lat, lng delta pairs
+GEOMETRY_FORMATS = ('json', 'polyline', 'packed')
+PRECISIONS = (5, 6)  # 6 still fits int32 deltas and absolute values
+PACKED_MIMETYPE = 'application/octet-stream'
+
+def parse_geometry_params(args, formats=GEOMETRY_FORMATS):
+    """(format, precision) from the query parameters, the format defaulting to the first of `formats`. Raises ValueError."""
+    geometry_format = args.get('format', formats[0])
+    if geometry_format not in formats:
+        raise ValueError(f"format must be one of {', '.join(formats)}")
+    try:
+        precision = int(args.get('precision', PRECISIONS[0]))
+    except (TypeError, ValueError):
+        precision = None
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {', '.join(map(str, PRECISIONS))}")
+    return geometry_format, precision
+
+def coordinates_statement(map_ids):
+    """Waypoint coordinates of `map_ids` in route order, without any of the other columns."""
+    return (
+        select(Waypoint.map_id, Waypoint.latitude, Waypoint.longitude)
+        .where(Waypoint.map_id.in_(map_ids))
+        .order_by(Waypoint.map_id, Waypoint.id)
+    )
+
+def group_coordinates(rows):
+    """{map_id: (n, 2) float array} from (map_id, latitude, longitude) rows ordered by map."""
+    rows = list(rows)
+    if not rows:
+        return {}
+    map_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    coordinates = np.array([(row[1], row[2]) for row in rows], dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, map_ids[1:] != map_ids[:-1]])
+    return dict(zip(map_ids[starts].tolist(), np.split(coordinates, starts[1:])))
+
+def scaled_deltas(coordinates, precision):
+    """Rounded coordinates as int64 deltas, shape (n, 2)."""
+    scaled = np.round(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    return np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+def encode_polyline(coordinates, precision=5):
+    """Encoded polyline of (latitude, longitude) pairs."""
+    chunks = []
+    for value in scaled_deltas(coordinates, precision).ravel().tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+def pack_records(coordinates_by_map, map_ids, precision):
+    """Packed records of `map_ids`, in that order. Maps without waypoints get a count of 0."""
+    parts = []
+    for map_id in map_ids:
+        deltas = scaled_deltas(coordinates_by_map.get(map_id, ()), precision)
+        parts.append(np.array([map_id, len(deltas)], dtype=np.int64))
+        parts.append(deltas.ravel())
+    return np.concatenate(parts).astype('<i4').tobytes() if parts else b''
+
+def polyline_payload(coordinates_by_map, map_ids, precision):
+    return [
+        {"map_id": map_id, "polyline": encode_polyline(coordinates_by_map.get(map_id, ()), precision)}
+        for map_id in map_ids
+    ]
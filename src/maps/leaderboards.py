@@ -0,0 +1,107 @@
+import math
+from datetime import datetime
+from ..extensions import db
+from .models import Map, Rating
+
+# Trending is an exponentially decayed sum of rating, save and view events. Scores are stored
+# as log(sum(weight * exp((t - EPOCH) / TAU))): every map decays by the same factor, so
+# the stored value orders maps correctly at any time without being rewritten, and an
+# event is folded in with one logaddexp UPDATE of its map.
+TRENDING_EPOCH = datetime(2024, 1, 1)
+TRENDING_HALF_LIFE_HOURS = 48
+TRENDING_TAU_SECONDS = TRENDING_HALF_LIFE_HOURS * 3600 / math.log(2)
+SAVE_WEIGHT = 2.0
+VIEW_WEIGHT = 0.1  # Views are flushed in batches by maps/view_counts.py
+RATING_WEIGHT = 1.0  # For a 5 star rating, scaled down linearly for lower ones
+# Maps whose decayed score drops below this leave the trending index on the next decay run
+MIN_TRENDING_SCORE = 0.01
+
+LEADERBOARDS = ('rating', 'saves', 'recent', 'trending')
+MAX_TOP_LIMIT = 100
+
+BUMP_TRENDING_SQL = db.text("""
+    UPDATE maps SET trending_score = CASE
+        WHEN trending_score IS NULL THEN :points
+        ELSE greatest(trending_score, :points) + ln(1 + exp(-abs(trending_score - :points)))
+    END
+    WHERE id = :map_id
+""")
+
+SAVE_COUNT_SQL = db.text("UPDATE maps SET save_count = greatest(save_count + :delta, 0) WHERE id = :map_id")
+
+def _decay_offset(at):
+    return (at - TRENDING_EPOCH).total_seconds() / TRENDING_TAU_SECONDS
+
+def trending_value(score, now=None):
+    """The decayed trending score as of `now`, from its stored log form."""
+    if score is None:
+        return 0.0
+    return math.exp(score - _decay_offset(now or datetime.utcnow()))
+
+def trending_points(weight, at=None):
+    """The log form of an event of `weight` at `at`, as folded into trending_score."""
+    return math.log(weight) + _decay_offset(at or datetime.utcnow())
+
+def bump_trending(map_id, weight, at=None):
+    """Adds an event of `weight` at `at` to the map's trending score, in the current transaction."""
+    if weight <= 0:
+        return
+    db.session.execute(BUMP_TRENDING_SQL, {"map_id": map_id, "points": trending_points(weight, at)})
+
+def record_rating(map_id, rating_value):
+    bump_trending(map_id, RATING_WEIGHT * rating_value / 5)
+
+def record_save(map_id, delta):
+    """Adjusts the save count by `delta`. Saves add to trending, removals only lower the count."""
+    db.session.execute(SAVE_COUNT_SQL, {"map_id": map_id, "delta": delta})
+    if delta > 0:
+        bump_trending(map_id, SAVE_WEIGHT * delta)
+
+def decay_trending(now=None):
+    """Drops the trending score of maps decayed below MIN_TRENDING_SCORE. Returns the row count."""
+    threshold = math.log(MIN_TRENDING_SCORE) + _decay_offset(now or datetime.utcnow())
+    result = db.session.execute(
+        db.text("UPDATE maps SET trending_score = NULL WHERE trending_score < :threshold"),
+        {"threshold": threshold},
+    )
+    return result.rowcount
+
+def _top_ids(by, limit):
+    # Each ordering matches an index, so the top rows are read straight off it
+    if by == 'rating':
+        # Unrated maps stay off the board and more ratings break ties, which maps.average_rating
+        # can't express, so this one still reads the ratings index
+        rows = (
+            db.session.query(Map.id, Rating.average_rating)
+            .join(Rating, Map.rating_id == Rating.id)
+            .filter(Rating.num_ratings > 0)
+            .order_by(Rating.average_rating.desc(), Rating.num_ratings.desc(), Rating.id.desc())
+        )
+    elif by == 'saves':
+        rows = db.session.query(Map.id, Map.save_count).order_by(Map.save_count.desc(), Map.id.desc())
+    elif by == 'recent':
+        rows = db.session.query(Map.id, Map.created_at).order_by(Map.created_at.desc(), Map.id.desc())
+    else:
+        rows = (
+            db.session.query(Map.id, Map.trending_score)
+            .filter(Map.trending_score.isnot(None))
+            .order_by(Map.trending_score.desc(), Map.id.desc())
+        )
+    return rows.limit(limit).all()
+
+def top_maps(by, limit=20):
+    """The `limit` best maps for a leaderboard as summaries with their "score", best first."""
+    ranked = _top_ids(by, limit)
+    maps = {m.id: m for m in Map.query.filter(Map.id.in_([map_id for map_id, _ in ranked])).all()}
+    now = datetime.utcnow()
+
+    results = []
+    for map_id, score in ranked:
+        if map_id not in maps:
+            continue
+        if by == 'trending':
+            score = trending_value(score, now)
+        elif by == 'recent':
+            score = score.isoformat() if score else None
+        results.append({**maps[map_id].serialize_summary(), "score": score})
+    return results
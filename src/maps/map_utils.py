@@ -1,11 +1,57 @@
-
+from collections import namedtuple
 from typing import Optional
 from werkzeug.datastructures import FileStorage
 import base64
-import imghdr
+import hashlib
+import tempfile
 
 ALLOWED_MIME_TYPES = {"image/jpeg", "image/png"}
 MAX_IMAGE_SIZE_MB = 5  # 5 MB limit since we're storing directly to postgres
+MAX_IMAGE_SIZE_BYTES = MAX_IMAGE_SIZE_MB * 1024 * 1024
+MAX_BATCH_MAPS = 200  # Upper bound on ids per /maps/batch request
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+SPOOL_MEMORY_SIZE = 256 * 1024  # Larger uploads spill to a temporary file while being validated
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "jpeg",
+    b"\x89PNG\r\n\x1a\n": "png",
+}
+SNIFF_BYTES = max(len(signature) for signature in IMAGE_SIGNATURES)
+
+SpooledUpload = namedtuple('SpooledUpload', ['file', 'size', 'sha256', 'image_type'])
+
+def sniff_image_type(header: bytes) -> Optional[str]:
+    """Detects JPEG/PNG from the leading magic bytes rather than trusting the client's mimetype."""
+    for signature, image_type in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return image_type
+    return None
+
+def spool_upload(stream, max_bytes: int):
+    """
+    Copies an upload stream into a spooled temporary file in fixed-size chunks, hashing and
+    sniffing its type on the way. Stops reading as soon as `max_bytes` is crossed, so memory
+    stays bounded by the chunk and spool sizes whatever the client sends.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+    digest = hashlib.sha256()
+    header = b""
+    size = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            spool.close()
+            return None, f"File size exceeds {max_bytes // (1024 * 1024)}MB."
+        if len(header) < SNIFF_BYTES:
+            header += chunk[:SNIFF_BYTES - len(header)]
+        digest.update(chunk)
+        spool.write(chunk)
+
+    spool.seek(0)
+    return SpooledUpload(spool, size, digest.hexdigest(), sniff_image_type(header)), None
 
 def validate_image(file: Optional[FileStorage]):
     """Validate image size and type."""
@@ -14,15 +60,15 @@ def validate_image(file: Optional[FileStorage]):
     
     if file.mimetype not in ALLOWED_MIME_TYPES:
         return None, "Invalid image type. Only JPEG and PNG are allowed."
-    
-    file.seek(0, 2)  # Move cursor to end to get size
-    size_mb = file.tell() / (1024 * 1024)  # Convert bytes to MB
-    file.seek(0)  # Reset cursor
 
-    if size_mb > MAX_IMAGE_SIZE_MB:
-        return None, f"File size exceeds {MAX_IMAGE_SIZE_MB}MB."
+    upload, error = spool_upload(file.stream, MAX_IMAGE_SIZE_BYTES)
+    if error:
+        return None, error
 
-    return file.read(), None  # Read and return binary data
+    with upload.file:
+        if upload.image_type is None:
+            return None, "Invalid image type. Only JPEG and PNG are allowed."
+        return upload.file.read(), None  # Read and return binary data
 
 def validate_base64_image(b64_string: str):
     try:
@@ -30,17 +76,44 @@ def validate_base64_image(b64_string: str):
         if b64_string.startswith("data:image/"):
             header, b64_string = b64_string.split(",", 1)
 
-        image_data = base64.b64decode(b64_string)
-        image_type = imghdr.what(None, h=image_data)
+        # Reject from the encoded length and the leading bytes before decoding the whole payload
+        if len(b64_string) // 4 * 3 > MAX_IMAGE_SIZE_BYTES + 3:
+            return None, f"File size exceeds {MAX_IMAGE_SIZE_MB}MB."
 
-        if image_type not in ["jpeg", "png"]:
+        if sniff_image_type(base64.b64decode(b64_string[:4 * SNIFF_BYTES])) is None:
             return None, "Invalid image type. Only JPEG and PNG are allowed."
 
-        size_mb = len(image_data) / (1024 * 1024)
-        if size_mb > MAX_IMAGE_SIZE_MB:
+        image_data = base64.b64decode(b64_string)
+        if len(image_data) > MAX_IMAGE_SIZE_BYTES:
             return None, f"File size exceeds {MAX_IMAGE_SIZE_MB}MB."
 
         return image_data, None
 
     except Exception as e:
         return None, f"Invalid base64 image: {str(e)}"
+
+def parse_fields(raw_fields, allowed_fields):
+    """
+    Parses a field selection given as "a,b,c" or a list. Returns None when no selection was made,
+    otherwise the set of fields. Raises ValueError for unknown fields or a malformed selection.
+    """
+    if not raw_fields:
+        return None
+    if isinstance(raw_fields, str):
+        raw_fields = raw_fields.split(',')
+    if not isinstance(raw_fields, list) or not all(isinstance(field, str) for field in raw_fields):
+        raise ValueError("fields must be a comma separated string or a list of strings")
+    fields = {field.strip() for field in raw_fields if field.strip()}
+    unknown = fields - set(allowed_fields)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}. Allowed: {', '.join(allowed_fields)}")
+    return fields or None
+
+def parse_ids(raw_ids, max_ids):
+    """Parses map ids given as "1,2,3" or a list, dropping duplicates but keeping the request order."""
+    if isinstance(raw_ids, str):
+        raw_ids = [raw_id for raw_id in raw_ids.split(',') if raw_id.strip()]
+    ids = list(dict.fromkeys(int(raw_id) for raw_id in raw_ids or []))
+    if len(ids) > max_ids:
+        raise ValueError(f"At most {max_ids} ids can be requested at once.")
+    return ids
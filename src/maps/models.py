@@ -1,5 +1,6 @@
 from datetime import datetime
 from sqlalchemy.dialects.postgresql import JSON, ARRAY
+from sqlalchemy.orm import defer, joinedload, selectinload
 from ..extensions import db
 import base64
 import re
@@ -14,6 +15,11 @@ class Rating(db.Model):
     average_rating = db.Column(db.Float, default=0.0)
     num_ratings = db.Column(db.Integer, default=0)
 
+    __table_args__ = (
+        # Top-rated leaderboard
+        db.Index('ix_ratings_average_rating', average_rating.desc(), num_ratings.desc(), id.desc()),
+    )
+
     def serialize(self):
         return {
             "id": self.id,
@@ -34,59 +40,120 @@ class Map(db.Model):
     description = db.Column(db.Text, nullable=True)
     duration = db.Column(db.Interval, nullable=True)
     creator_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
-    rating_id = db.Column(db.Integer, db.ForeignKey('ratings.id', ondelete='SET NULL'))
+    rating_id = db.Column(db.Integer, db.ForeignKey('ratings.id', ondelete='SET NULL'), index=True)
     tags = db.Column(ARRAY(db.String), nullable=True)
     image_data = db.Column(db.LargeBinary, nullable=True)  # Store image as binary data
     price = db.Column(db.Float, nullable=True, default=0.0)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     countries = db.Column(ARRAY(db.String(255)), nullable=True, default=[])
     cities = db.Column(ARRAY(db.String(255)), nullable=True, default=[])
+    # Aggregates derived from the waypoints, maintained by maps/aggregates.py
+    waypoint_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    min_latitude = db.Column(db.Float, nullable=True)
+    max_latitude = db.Column(db.Float, nullable=True)
+    min_longitude = db.Column(db.Float, nullable=True)
+    max_longitude = db.Column(db.Float, nullable=True)
+    # Leaderboard scores, maintained by maps/leaderboards.py
+    save_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    view_count = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # Written behind by maps/view_counts.py
+    trending_score = db.Column(db.Float, nullable=True)  # Log of the decayed event sum, NULL once decayed out
+    # Copy of rating.average_rating so listings can filter and sort on it without a join
+    average_rating = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    # Set by a delete, which hides the map from every read (see soft_delete.py) until the purger removes it
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_maps_save_count', save_count.desc(), id.desc()),
+        db.Index('ix_maps_created_at', created_at.desc(), id.desc()),
+        db.Index('ix_maps_trending_score', trending_score.desc(), id.desc(), postgresql_where=trending_score.isnot(None)),
+        # Listing sorts (maps/filters.py). Scanned backwards for the other direction, except that
+        # nullable columns sort NULLs last both ways and need a descending index of their own.
+        db.Index('ix_maps_price', price, id),
+        db.Index('ix_maps_price_desc', price.desc().nullslast(), id.desc()),
+        db.Index('ix_maps_duration', duration, id),
+        db.Index('ix_maps_duration_desc', duration.desc().nullslast(), id.desc()),
+        db.Index('ix_maps_average_rating', average_rating, id),
+        # A creator's maps, newest first
+        db.Index('ix_maps_creator_id_created_at', creator_id, created_at.desc(), id.desc()),
+        # Array overlap filters. They get no composite with the sorts: GIN indexes, btree_gin
+        # ones included, return rows unordered, so a sorted page would still need a sort.
+        # Postgres walks the sort index and applies the filter when it matches many maps, and
+        # for rare values top-N sorts the few rows of a bitmap scan on these.
+        db.Index('ix_maps_countries', countries, postgresql_using='gin'),
+        db.Index('ix_maps_cities', cities, postgresql_using='gin'),
+        db.Index('ix_maps_tags', tags, postgresql_using='gin'),
+        # Maps waiting for the purger
+        db.Index('ix_maps_deleted_at', deleted_at, postgresql_where=deleted_at.isnot(None)),
+    )
     
     creator = db.relationship('User', backref='maps', lazy=True)
     rating = db.relationship('Rating', backref='map', lazy=True)
-    waypoints = db.relationship('Waypoint', backref='map', lazy=True, cascade="all, delete")
+    waypoints = db.relationship('Waypoint', backref='map', lazy=True, cascade="all, delete", order_by='Waypoint.id')
 
-    def update_price_from_waypoints(self):
-        """
-        Updates the Map's price attribute to be the sum of the price attributes of all its waypoints.
-        Assumes each waypoint has a 'price' attribute.
-        """
-        self.price = sum(
-            waypoint.price for waypoint in self.waypoints if waypoint.price is not None
-        )
+    SERIALIZED_FIELDS = (
+        "id", "title", "description", "duration", "creator_id", "created_at", "rating", "price",
+        "view_count", "tags", "countries", "cities", "waypoints", "image_data", "creator",
+    )
+
+    @classmethod
+    def load_options(cls, fields=None):
+        """Eager loads for the relationships serialize(fields) needs, and deferral of an unneeded map image."""
+        options = []
+        if fields is None or 'waypoints' in fields:
+            options.append(selectinload(cls.waypoints))
+        if fields is None or 'rating' in fields:
+            options.append(joinedload(cls.rating))
+        if fields is None or 'creator' in fields:
+            options.append(joinedload(cls.creator))
+        if fields is not None and 'image_data' not in fields:
+            options.append(defer(cls.image_data))
+        return options
 
-    def update_countries_from_waypoints(self):
+    def serialize(self, fields=None):
         """
-        Updates the Map's countries attribute to be a list of unique country names from all its waypoints.
-        Assumes each waypoint has a 'country' attribute.
+        Full representation of the map. `fields` limits the output to a subset of
+        SERIALIZED_FIELDS, and the fields left out are not computed at all.
         """
-        self.countries = list(
-            set(waypoint.country for waypoint in self.waypoints if waypoint.country is not None)
-        )
+        serializers = {
+            "id": lambda: self.id,
+            "title": lambda: self.title,
+            "description": lambda: self.description,
+            "duration": lambda: format_duration(self.duration),
+            "creator_id": lambda: self.creator_id,
+            "created_at": lambda: self.created_at.isoformat(),
+            "rating": lambda: self.rating.serialize() if self.rating else None,
+            "price": lambda: self.price,
+            "view_count": lambda: self.view_count,
+            'tags': lambda: self.tags,
+            'countries': lambda: self.countries,
+            'cities': lambda: self.cities,
+            "waypoints": lambda: [waypoint.serialize() for waypoint in self.waypoints],
+            'image_data': lambda: base64.b64encode(self.image_data).decode('utf-8') if self.image_data else None,
+            "creator": lambda: self.creator.serialize() if self.creator else None
+        }
+        return {key: serialize() for key, serialize in serializers.items() if fields is None or key in fields}
 
-    def serialize(self):
+    def serialize_summary(self):
+        """Lightweight representation without waypoints or creator, used for map lists."""
         return {
             "id": self.id,
             "title": self.title,
             "description": self.description,
             "duration": format_duration(self.duration),
-            "creator_id": self.creator_id,
-            "created_at": self.created_at.isoformat(),
-            "rating": self.rating.serialize() if self.rating else None,
+            "rating": self.average_rating,
             "price": self.price,
-            'tags': self.tags,
-            'countries': self.countries,
-            'cities': self.cities,
-            "waypoints": [waypoint.serialize() for waypoint in self.waypoints],
-            'image_data': base64.b64encode(self.image_data).decode('utf-8') if self.image_data else None,
-            "creator": self.creator.serialize() if self.creator else None
+            "view_count": self.view_count,
+            "countries": self.countries,
+            "tags": self.tags,
+            "image_data": base64.b64encode(self.image_data).decode('utf-8') if self.image_data else None
         }
 
 class Waypoint(db.Model):
     __tablename__ = 'waypoints'
     
     id = db.Column(db.Integer, primary_key=True)
-    map_id = db.Column(db.Integer, db.ForeignKey('maps.id', ondelete='CASCADE'))
+    map_id = db.Column(db.Integer, db.ForeignKey('maps.id', ondelete='CASCADE'), index=True)
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, nullable=True)
     info = db.Column(db.Text, nullable=True)
@@ -117,6 +184,48 @@ class Waypoint(db.Model):
         }
     
 
+class MapChange(db.Model):
+    """Append-only log of map writes backing the /maps/changes sync feed."""
+    __tablename__ = 'map_changes'
+    __table_args__ = (db.Index('ix_map_changes_txid_id', 'txid', 'id'),)
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    map_id = db.Column(db.Integer, nullable=False)  # No foreign key, tombstones outlive the map
+    op = db.Column(db.String(16), nullable=False)   # create, update, delete or rate
+    # Writing transaction, the feed only serves transactions older than every in-flight one
+    txid = db.Column(db.BigInteger, nullable=False, server_default=db.text('txid_current()'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class WaypointCellMap(db.Model):
+    """Waypoints of one map in one grid cell of one zoom level, maintained by maps/clusters.py."""
+    __tablename__ = 'waypoint_cell_maps'
+    __table_args__ = (
+        # A cell's representative maps, most waypoints first
+        db.Index('ix_waypoint_cell_maps_top', 'zoom', 'cell_x', 'cell_y', db.text('waypoint_count DESC'), 'map_id'),
+    )
+
+    zoom = db.Column(db.SmallInteger, primary_key=True)
+    cell_x = db.Column(db.Integer, primary_key=True)
+    cell_y = db.Column(db.Integer, primary_key=True)
+    map_id = db.Column(db.Integer, primary_key=True, index=True)  # No foreign key, removed with the map's waypoints
+    waypoint_count = db.Column(db.Integer, nullable=False)
+    sum_latitude = db.Column(db.Float, nullable=False)
+    sum_longitude = db.Column(db.Float, nullable=False)
+
+
+class WaypointCell(db.Model):
+    """Waypoint count and coordinate sums of one grid cell of one zoom level, the totals of WaypointCellMap."""
+    __tablename__ = 'waypoint_cells'
+
+    zoom = db.Column(db.SmallInteger, primary_key=True)
+    cell_x = db.Column(db.Integer, primary_key=True)
+    cell_y = db.Column(db.Integer, primary_key=True)
+    waypoint_count = db.Column(db.Integer, nullable=False)
+    sum_latitude = db.Column(db.Float, nullable=False)
+    sum_longitude = db.Column(db.Float, nullable=False)
+
+
 def format_duration(duration):
     if not duration:
         return None
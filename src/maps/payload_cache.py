@@ -0,0 +1,61 @@
+import hashlib
+from flask import Response, current_app, request
+from ..compression import compress, negotiate_encoding
+from ..config import CompressionConfig, SharedCacheConfig
+from ..replicas import primary_reads
+from ..shared_cache import SharedCache
+from .signals import map_changed
+
+# Final GET /maps/<id> bodies, per field selection and content encoding, shared by the
+# workers of a host so a hot map is serialized and compressed once and then served
+# without touching the database
+map_payload_cache = SharedCache(
+    'map-payloads', SharedCacheConfig.DIRECTORY, SharedCacheConfig.MAX_BYTES, ttl=SharedCacheConfig.TTL_SECONDS,
+)
+
+def payload_variant(fields, encoding):
+    return f"{','.join(sorted(fields)) if fields else '*'};{encoding or 'identity'}"
+
+def render_entry(body, encoding):
+    """Cache entry for a JSON `body`: compressed with `encoding` when worth it, headed by its ETag and encoding."""
+    content_encoding = 'identity'
+    if encoding is not None and len(body) >= CompressionConfig.MIN_SIZE:
+        body, content_encoding = compress(body, encoding), encoding
+    etag = hashlib.sha1(body).hexdigest()
+    return f"{etag} {content_encoding}\n".encode('ascii') + body
+
+def split_entry(entry):
+    """(etag, content encoding, body) of a cache entry."""
+    header, body = entry.split(b'\n', 1)
+    etag, content_encoding = header.decode('ascii').split(' ')
+    return etag, content_encoding, body
+
+def map_payload_response(map_id, fields, load):
+    """
+    Response for GET /maps/<id>, from the shared cache or built from `load()` (the map's
+    serialized dict, read from the primary) and cached. Compression and ETags are handled here rather than by
+    the after_request hook, so a hit costs one file read.
+    """
+    encoding = negotiate_encoding()
+    variant = payload_variant(fields, encoding)
+    entry = map_payload_cache.get(map_id, variant)
+    if entry is None:
+        version = map_payload_cache.version(map_id)
+        with primary_reads():
+            entry = render_entry(current_app.json.response(load()).get_data(), encoding)
+        map_payload_cache.set(map_id, variant, entry, version)
+    return entry_response(entry)
+
+def entry_response(entry):
+    """Conditional response serving a cache entry as-is."""
+    etag, content_encoding, body = split_entry(entry)
+    response = Response(body, status=200, mimetype='application/json')
+    if content_encoding != 'identity':
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@map_changed.connect
+def _on_map_changed(sender, map_id, op):
+    map_payload_cache.invalidate(map_id)
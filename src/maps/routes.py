@@ -1,14 +1,44 @@
-from datetime import timedelta
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, abort, current_app, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from .models import Map, Rating, Waypoint
+from ..compression import negotiate_encoding
 from ..extensions import db, logger
+from ..soft_delete import soft_delete_maps
 from ..users.services import get_current_user
-from .map_utils import validate_base64_image, validate_image
+from .map_utils import MAX_BATCH_MAPS, parse_fields, parse_ids, validate_base64_image, validate_image
+from .autocomplete import autocomplete_index, parse_autocomplete_params
+from .aggregates import apply_waypoints_added, reset_map_aggregates
+from .clusters import MAX_CLUSTER_ZOOM, parse_bbox, waypoint_clusters
+from .changes import InvalidCursor, changes_since, record_map_change
+from .facets import get_facets
+from .forks import fork_map
+from .geometry import (
+    PACKED_MIMETYPE, coordinates_statement, group_coordinates, pack_records, parse_geometry_params, polyline_payload,
+)
+from .filter_cache import filtered_response, filtered_variant
+from .filters import filter_maps, parse_page, parse_sort
+from .leaderboards import LEADERBOARDS, MAX_TOP_LIMIT, record_rating, top_maps
+from .payload_cache import map_payload_response
+from .signals import notify_map_changed
+from .similarity import similarity_index
+from .routing import plan_route, route_cache
+from .sql_json import maps_json_text, sql_json_enabled, stream_maps_json
+from .view_counts import view_counter
 import random
 import json
 
 maps_bp = Blueprint('maps', __name__)
+waypoints_bp = Blueprint('waypoints', __name__)
+autocomplete_bp = Blueprint('autocomplete', __name__)
+
+def release_image_data(obj):
+    """
+    Writes the row now and drops the image bytes from the session, so a request with
+    many images holds one of them in memory at a time instead of all until commit.
+    """
+    if obj.image_data is not None:
+        db.session.flush()
+        db.session.expire(obj, ['image_data'])
 
 @maps_bp.route('/create_with_waypoints', methods=['POST'])
 @jwt_required()
@@ -38,29 +68,28 @@ def create_map_with_waypoints():
             map_image = image_files.get('map_image')
             image_data, error = validate_image(map_image)
             if error and error != "No file uploaded.":
-                return jsonify({"error": f"Error when retrieving map image: {error}"}),
+                return jsonify({"error": f"Error when retrieving map image: {error}"}), 400
 
-            # Create a new Map object
+            # Create a new Map object, price and duration are derived from the waypoints below
             new_map = Map(
                 title=data['title'],
                 description=data.get('description', ''),
-                duration=data.get('duration') if data.get('duration') else None,
                 creator_id=user_id,
                 rating=rating,
                 tags=map_tags,
-                price=data.get('price', 0.0),
                 image_data=image_data
             )
             db.session.add(new_map)
             db.session.flush()  # Get the new_map ID before committing
 
             # Add waypoints to the new map
+            new_waypoints = []
             for idx, wp in enumerate(waypoints):
                 image_file = image_files.get(f'waypoint_image_{idx}')  # Get image for this waypoint
                 image_data, error = validate_image(image_file)
 
                 if error and error != "No file uploaded.":
-                    return jsonify({"error": f"Waypoint {wp['title']}: {error}"}),
+                    return jsonify({"error": f"Waypoint {wp['title']}: {error}"}), 400
                 waypoint = Waypoint(
                     map_id=new_map.id,
                     title=wp['title'],
@@ -72,16 +101,22 @@ def create_map_with_waypoints():
                     price=wp.get('price', 0.0),
                     duration=wp.get('duration') if wp.get('duration') else None,
                     image_data=image_data,
-                    country=wp.get('country', None)
+                    country=wp.get('country', None),
+                    city=wp.get('city', None)
                 )
                 db.session.add(waypoint)
+                new_waypoints.append(waypoint)
+                release_image_data(waypoint)
             
-            # Update the map's price/countrie based on the waypoints
-            new_map.update_price_from_waypoints()
-            new_map.update_countries_from_waypoints()
+            # Update the map's aggregates (price, countries, cities, duration, bbox) from the waypoints
+            apply_waypoints_added(new_map, new_waypoints)
+            if new_map.duration is None and data.get('duration'):
+                new_map.duration = data.get('duration')
 
         # Commit the transaction
+        record_map_change(new_map.id, 'create')
         db.session.commit()
+        notify_map_changed(new_map.id, 'create')
         return jsonify({"message": "Map and waypoints created successfully", "map_id": new_map.id}), 201
 
     except Exception as e:
@@ -109,8 +144,9 @@ def update_map_with_waypoints(map_id):
             # Update map fields
             existing_map.title = data.get('title', existing_map.title)
             existing_map.description = data.get('description', existing_map.description)
-            existing_map.duration = data.get('duration') or existing_map.duration
-            existing_map.price = float(data.get('price', existing_map.price))
+            # Price and duration are derived from the waypoints, a form duration only fills in a missing one
+            if existing_map.duration is None and data.get('duration'):
+                existing_map.duration = data.get('duration')
 
             # Update map image if new one provided
             map_image = image_files.get('map_image')
@@ -127,8 +163,10 @@ def update_map_with_waypoints(map_id):
 
                 # Clear existing waypoints
                 Waypoint.query.filter_by(map_id=map_id).delete()
+                reset_map_aggregates(existing_map)
 
                 # Add new waypoints
+                new_waypoints = []
                 for idx, wp in enumerate(waypoints):
                     image_file = image_files.get(f'waypoint_image_{idx}')
                     image_data = None
@@ -155,12 +193,17 @@ def update_map_with_waypoints(map_id):
                         city=wp.get('city', None)
                     )
                     db.session.add(new_wp)
+                    new_waypoints.append(new_wp)
+                    release_image_data(new_wp)
 
                 # Update map metadata based on new waypoints
-                existing_map.update_price_from_waypoints()
-                existing_map.update_countries_from_waypoints()
+                apply_waypoints_added(existing_map, new_waypoints)
+                if existing_map.duration is None and data.get('duration'):
+                    existing_map.duration = data.get('duration')
 
+        record_map_change(existing_map.id, 'update')
         db.session.commit()
+        notify_map_changed(existing_map.id, 'update')
         return jsonify({"message": "Map and waypoints updated successfully", "map_id": existing_map.id}), 200
 
     except Exception as e:
@@ -180,16 +223,10 @@ def delete_map(map_id):
         if not map_to_delete:
             return jsonify({"error": "Map not found or unauthorized"}), 404
 
-        with db.session.begin_nested():
-            # Delete associated waypoints and rating
-            Waypoint.query.filter_by(map_id=map_id).delete()
-            if map_to_delete.rating_id:
-                Rating.query.filter_by(id=map_to_delete.rating_id).delete()
-
-            # Delete the map itself
-            db.session.delete(map_to_delete)
-
+        # Hidden right away, its waypoints, images and rating are removed later by the purger
+        soft_delete_maps([map_id])
         db.session.commit()
+        notify_map_changed(map_id, 'delete')
         return jsonify({"message": "Map and associated waypoints deleted successfully."}), 200
 
     except Exception as e:
@@ -198,16 +235,140 @@ def delete_map(map_id):
         return jsonify({"error": "Failed to delete map", "details": str(e)}), 500
 
 
+@maps_bp.route('/<int:map_id>/fork', methods=['POST'])
+@jwt_required()
+def fork_map_route(map_id):
+    # Optional JSON body {"title": "..."}, the copy keeps the original title otherwise
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    title = body.get('title')
+    if title is not None and (not isinstance(title, str) or not title.strip() or len(title) > 255):
+        return jsonify({"error": "title must be a non-empty string of at most 255 characters"}), 400
+    user_id = get_jwt_identity()['id']
+
+    try:
+        fork_id = fork_map(map_id, user_id, title)
+        if fork_id is None:
+            return jsonify({"error": "Map not found"}), 404
+        record_map_change(fork_id, 'create')
+        db.session.commit()
+        notify_map_changed(fork_id, 'create')
+        return jsonify({"message": "Map forked successfully", "map_id": fork_id, "forked_from": map_id}), 201
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error forking map {map_id}: {str(e)}")
+        return jsonify({"error": "Failed to fork map", "details": str(e)}), 500
+
 @maps_bp.route('/<int:map_id>', methods=['GET'])
 def get_map(map_id):
-    map = Map.query.get_or_404(map_id)
-    return jsonify(map.serialize()), 200
+    try:
+        fields = parse_fields(request.args.get('fields'), Map.SERIALIZED_FIELDS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def load():
+        map = Map.query.options(*Map.load_options(fields)).filter_by(id=map_id).first_or_404()
+        return map.serialize(fields)
+
+    response = map_payload_response(map_id, fields, load)
+    view_counter.record(map_id)
+    return response
+
+@maps_bp.route('/batch', methods=['GET', 'POST'])
+def get_maps_batch():
+    # GET /batch?ids=1,2,3&fields=id,title or POST /batch {"ids": [...], "fields": [...]} for long lists
+    params = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    if not isinstance(params, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    try:
+        ids = parse_ids(params.get('ids'), MAX_BATCH_MAPS)
+        fields = parse_fields(params.get('fields'), Map.SERIALIZED_FIELDS)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    found = {}
+    if ids:
+        found = {m.id: m for m in Map.query.options(*Map.load_options(fields)).filter(Map.id.in_(ids)).all()}
+
+    return jsonify({
+        "maps": [found[map_id].serialize(fields) for map_id in ids if map_id in found],
+        "missing": [map_id for map_id in ids if map_id not in found]
+    }), 200
+
+@maps_bp.route('/geometry', methods=['GET', 'POST'])
+def get_maps_geometry():
+    # GET /geometry?ids=1,2,3&format=polyline|packed&precision=5, or POST the same as JSON for long lists
+    params = (request.get_json(silent=True) or {}) if request.method == 'POST' else request.args
+    if not isinstance(params, dict):
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+    try:
+        ids = parse_ids(params.get('ids'), MAX_BATCH_MAPS)
+        geometry_format, precision = parse_geometry_params(params, formats=('polyline', 'packed'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    existing = set()
+    if ids:
+        existing = {map_id for (map_id,) in db.session.query(Map.id).filter(Map.id.in_(ids))}
+    found = [map_id for map_id in ids if map_id in existing]
+    coordinates = group_coordinates(db.session.execute(coordinates_statement(found))) if found else {}
+
+    if geometry_format == 'packed':
+        # Missing maps have no record
+        return Response(pack_records(coordinates, found, precision), mimetype=PACKED_MIMETYPE)
+    return jsonify({
+        "precision": precision,
+        "maps": polyline_payload(coordinates, found, precision),
+        "missing": [map_id for map_id in ids if map_id not in existing]
+    }), 200
+
+@maps_bp.route('/<int:map_id>/similar', methods=['GET'])
+def get_similar_maps(map_id):
+    map_ = Map.query.get_or_404(map_id)
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+
+    scored = similarity_index.similar(map_, limit)
+    similar_maps = {m.id: m for m in Map.query.filter(Map.id.in_([similar_id for similar_id, _ in scored])).all()}
+
+    results = []
+    for similar_id, score in scored:
+        similar_map = similar_maps.get(similar_id)
+        if similar_map is None:
+            # Deleted by another worker since the index last refreshed
+            similarity_index.discard(similar_id)
+            continue
+        results.append({**similar_map.serialize_summary(), "similarity": round(score, 4)})
+
+    return jsonify(results), 200
+
+@maps_bp.route('/<int:map_id>/route', methods=['GET'])
+def get_map_route(map_id):
+    map_ = Map.query.get_or_404(map_id)
+    optimize = request.args.get('optimize', 'false').lower() in ('1', 'true', 'yes')
+
+    cache_key = (map_.id, map_.updated_at, optimize)
+    route = route_cache.get(cache_key)
+    if route is None:
+        waypoints = (
+            db.session.query(Waypoint.id, Waypoint.latitude, Waypoint.longitude)
+            .filter(Waypoint.map_id == map_id)
+            .order_by(Waypoint.id)
+            .all()
+        )
+        route = {"map_id": map_id, "optimized": optimize, **plan_route(waypoints, optimize)}
+        route_cache.set(cache_key, route)
+
+    return jsonify(route), 200
 
 @maps_bp.route('/<int:map_id>/waypoints', methods=['POST'])
 @jwt_required()
 def add_waypoint(map_id):
     data = request.form
     current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
     map_ = Map.query.get_or_404(map_id)
 
     # Ensure only the map creator can add waypoints
@@ -228,13 +389,18 @@ def add_waypoint(map_id):
         info=data.get('info', ''),
         latitude=data['latitude'],
         longitude=data['longitude'],
-        tags=data.get('tags', []),
         times_of_day=data.get('times_of_day', {}),
         price=data.get('price', 0.0),
-        image_data=image_data
+        duration=data.get('duration') or None,
+        image_data=image_data,
+        country=data.get('country'),
+        city=data.get('city')
     )
     db.session.add(waypoint)
+    apply_waypoints_added(map_, [waypoint])
+    record_map_change(map_id, 'update')
     db.session.commit()
+    notify_map_changed(map_id, 'update')
 
     return jsonify({"message": "Waypoint added successfully", "waypoint_id": waypoint.id}), 201
 
@@ -252,15 +418,33 @@ def rate_map(map_id):
         return jsonify({"error": "Rating entity not found for this map"}), 404
 
     rating.update_rating(rating_value)
+    map_.average_rating = rating.average_rating
+    record_rating(map_id, rating_value)
+    record_map_change(map_id, 'rate')
     db.session.commit()
+    notify_map_changed(map_id, 'rate')
 
     return jsonify(rating.serialize()), 200
 
 @maps_bp.route('/<int:map_id>/waypoints', methods=['GET'])
 def get_waypoints(map_id):
-    map = Map.query.get_or_404(map_id)
-    waypoints = [waypoint.serialize() for waypoint in map.waypoints]
-    return jsonify(waypoints)
+    # ?format=polyline|packed returns only the coordinates, for drawing the route (maps/geometry.py)
+    try:
+        geometry_format, precision = parse_geometry_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if geometry_format == 'json':
+        map = Map.query.get_or_404(map_id)
+        waypoints = [waypoint.serialize() for waypoint in map.waypoints]
+        return jsonify(waypoints)
+
+    if db.session.query(Map.id).filter_by(id=map_id).first() is None:
+        abort(404)
+    coordinates = group_coordinates(db.session.execute(coordinates_statement([map_id])))
+    if geometry_format == 'packed':
+        return Response(pack_records(coordinates, [map_id], precision), mimetype=PACKED_MIMETYPE)
+    return jsonify({"precision": precision, **polyline_payload(coordinates, [map_id], precision)[0]}), 200
 
 @maps_bp.route('/<int:map_id>', methods=['GET'])
 @jwt_required()
@@ -272,10 +456,12 @@ def get_map_with_waypoints(map_id):
 @jwt_required()
 def get_all_maps_with_waypoints():
     # Query all maps from the database
-    maps = Map.query.all()
+    maps_query = Map.query
+    if sql_json_enabled():
+        return stream_maps_json(maps_query)
 
     # Serialize each map along with its waypoints
-    maps_with_waypoints = [map.serialize() for map in maps]
+    maps_with_waypoints = [map.serialize() for map in maps_query.all()]
 
     return jsonify(maps_with_waypoints), 200
 
@@ -283,72 +469,33 @@ def get_all_maps_with_waypoints():
 @jwt_required()
 def get_filtered_maps_with_waypoints():
     try:
-        # Retrieve filter values from query parameters
-        price_param = request.args.get('price')       # Expected format: "20, 80"
-        duration_param = request.args.get('duration')   # Expected format: "1, 10"
-        rating_param = request.args.get('rating')       # Expected format: "1, 5"
-        country_param = request.args.get('countries')     # Expected format: "USA", "Canada" or "" for no country
-        city_param = request.args.get('cities')         # Expected format: "New York", "Toronto" or "" for no city
-        tags_param = request.args.get('tags')           # Expected format: "tag1, tag2" or "" for no tags
-
-        query = Map.query
-
-        if 'creator_id' in request.args:
-            try:
-                query = query.filter(Map.creator_id == int(request.args['creator_id']))
-            except ValueError:
-                pass  # Log error if needed
-
-        # Filter by price range if provided
-        if price_param:
-            try:
-                low_price, high_price = [float(x.strip()) for x in price_param.split(',')]
-                query = query.filter(Map.price >= low_price, Map.price <= high_price)
-            except ValueError:
-                pass  # Log error if needed
-
-        # Filter by duration range if provided
-        # Parse duration and convert to timedelta
-        if duration_param:
-            parts = [x.strip() for x in duration_param.split(',')]
-            if len(parts) == 2:
-                try:
-                    low_duration = timedelta(days=float(parts[0]))
-                    high_duration = timedelta(days=float(parts[1]))
-                    query = query.filter(Map.duration >= low_duration).filter(Map.duration <= high_duration)
-                except ValueError:
-                    pass
-
-        # Filter by rating range if provided TODO: Properly update ratings in the model
-        # if rating_param:
-        #     try:
-        #         parsed = low_price, high_price = [float(x.strip()) for x in rating_param.split(',')]
-        #         if parsed:
-        #             low_rating, high_rating = parsed
-        #             # Join the Rating table and filter on its 'score' column instead
-        #             query = query.join(Rating).filter(Rating.average_rating >= low_rating).filter(Rating.average_rating <= high_rating)
-        #     except ValueError:
-        #         pass
-
-        # Filter by country if provided
-        if country_param:
-            countries_list = [country.strip() for country in country_param.split(',')]
-            query = query.filter(Map.countries.overlap(countries_list))
-
-        # Filter by city if provided
-        if city_param:
-            cities_list = [city.strip() for city in city_param.split(',')]
-            query = query.filter(Map.cities.overlap(cities_list))
-
-
-        # Filter by tags if provided
-        if tags_param:
-            tags_list = [tag.strip() for tag in tags_param.split(',')]
-            # Assuming Map.tags is stored as an ARRAY (or JSON) and your DB supports an "overlap" operator.
-            query = query.filter(Map.tags.overlap(tags_list))
-            # Adjust filtering if tags are stored differently
-
-        maps = query.all()
+        order_by = parse_sort(request.args)
+        limit, offset = parse_page(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        query = filter_maps(Map.query, request.args).order_by(*order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        if offset:
+            query = query.offset(offset)
+        sql_json = sql_json_enabled()
+
+        # Pages of popular filters are served from the host's cache (maps/filter_cache.py)
+        encoding = negotiate_encoding()
+        variant = filtered_variant(request.args, limit, offset, sql_json, encoding)
+        if variant is not None:
+            if sql_json:
+                return filtered_response(variant, encoding, lambda: maps_json_text(query, order_by).encode('utf-8'))
+            return filtered_response(variant, encoding, lambda: current_app.json.response(
+                [map.serialize() for map in query.options(*Map.load_options()).all()]
+            ).get_data())
+
+        if sql_json:
+            return stream_maps_json(query, order_by)
+
+        maps = query.options(*Map.load_options()).all()
         return jsonify([map.serialize() for map in maps]), 200
 
     except Exception as e:
@@ -357,6 +504,65 @@ def get_filtered_maps_with_waypoints():
 
 
 
+@maps_bp.route('/changes', methods=['GET'])
+@jwt_required()
+def get_map_changes():
+    limit = max(1, min(request.args.get('limit', 500, type=int), 1000))
+    try:
+        changes, cursor, has_more = changes_since(request.args.get('since'), limit)
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"changes": changes, "cursor": cursor, "has_more": has_more}), 200
+
+@maps_bp.route('/facets', methods=['GET'])
+@jwt_required()
+def get_map_facets():
+    # Accepts the same filter parameters as get_filtered_maps_with_waypoints
+    try:
+        return jsonify(get_facets(request.args)), 200
+    except Exception as e:
+        logger.error(f"Error computing map facets: {str(e)}")
+        return jsonify({"error": "Failed to compute facets", "details": str(e)}), 500
+
+@maps_bp.route('/top', methods=['GET'])
+@jwt_required()
+def get_top_maps():
+    by = request.args.get('by', 'trending')
+    if by not in LEADERBOARDS:
+        return jsonify({"error": f"by must be one of {', '.join(LEADERBOARDS)}"}), 400
+    limit = request.args.get('limit', 20, type=int)
+    if not 1 <= limit <= MAX_TOP_LIMIT:
+        return jsonify({"error": f"limit must be between 1 and {MAX_TOP_LIMIT}"}), 400
+
+    return jsonify({"by": by, "maps": top_maps(by, limit)}), 200
+
+@autocomplete_bp.route('', methods=['GET'])
+@jwt_required()
+def get_autocomplete():
+    # GET /autocomplete?kind=tag|country|city|alias&prefix=par&limit=10
+    try:
+        kind, prefix, limit = parse_autocomplete_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"kind": kind, "prefix": prefix, "suggestions": autocomplete_index.suggest(kind, prefix, limit)}), 200
+
+@waypoints_bp.route('/clusters', methods=['GET'])
+@jwt_required()
+def get_waypoint_clusters():
+    # GET /waypoints/clusters?bbox=min_lng,min_lat,max_lng,max_lat&zoom=5
+    zoom = request.args.get('zoom', type=int)
+    if zoom is None or zoom < 0:
+        return jsonify({"error": "zoom must be a non-negative integer"}), 400
+    try:
+        bbox = parse_bbox(request.args.get('bbox'))
+        clusters = waypoint_clusters(bbox, zoom)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"zoom": min(zoom, MAX_CLUSTER_ZOOM), "clusters": clusters}), 200
+
 @maps_bp.route('/get_all_tags', methods=['GET'])
 @jwt_required()
 def get_all_tags():
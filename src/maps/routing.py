@@ -0,0 +1,88 @@
+import time
+import numpy as np
+from ..cache import LRUCache
+from .geo import haversine_km
+
+ROUTE_TIME_BUDGET_SECONDS = 0.25  # Upper bound on 2-opt time per map, the result is still a valid tour
+MIN_IMPROVEMENT_KM = 1e-9
+
+# Keyed by (map id, Map.updated_at, optimize); updated_at moves whenever the waypoints change
+route_cache = LRUCache(maxsize=512)
+
+def distance_matrix(latitudes, longitudes):
+    """Pairwise haversine distances in km, computed in one broadcast pass."""
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lng = np.asarray(longitudes, dtype=np.float64)
+    return haversine_km(lat[:, None], lng[:, None], lat[None, :], lng[None, :])
+
+def nearest_neighbour_tour(dist, start=0):
+    """Greedy open tour starting at `start` that always moves to the closest unvisited point."""
+    n = len(dist)
+    visited = np.zeros(n, dtype=bool)
+    tour = np.empty(n, dtype=np.int64)
+    current = start
+    for position in range(n):
+        tour[position] = current
+        visited[current] = True
+        if position < n - 1:
+            candidates = np.where(visited, np.inf, dist[current])
+            current = int(np.argmin(candidates))
+    return tour
+
+def two_opt(tour, dist, deadline):
+    """
+    Improves an open tour (first point fixed, free end) by segment reversals until no reversal
+    helps or `deadline` (time.monotonic()) passes. Every candidate end of the reversed segment
+    is evaluated at once for a given start, so one pass costs O(n) vectorized steps.
+    """
+    tour = tour.copy()
+    n = len(tour)
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(1, n - 1):
+            ends = np.arange(i + 1, n)
+            before, first = tour[i - 1], tour[i]
+            last = tour[ends]
+            has_next = ends < n - 1
+            after = tour[np.minimum(ends + 1, n - 1)]
+
+            removed = dist[before, first] + np.where(has_next, dist[last, after], 0.0)
+            added = dist[before, last] + np.where(has_next, dist[first, after], 0.0)
+            delta = added - removed
+
+            best = int(np.argmin(delta))
+            if delta[best] < -MIN_IMPROVEMENT_KM:
+                j = ends[best]
+                tour[i:j + 1] = tour[i:j + 1][::-1]
+                improved = True
+            if time.monotonic() >= deadline:
+                break
+    return tour
+
+def plan_route(waypoints, optimize=True, time_budget=ROUTE_TIME_BUDGET_SECONDS):
+    """
+    Builds the route for `waypoints` (rows with id, latitude and longitude, in stored order).
+    With `optimize` the order is nearest neighbour + 2-opt from the first waypoint, otherwise the
+    stored order is kept. Returns the order with per-leg and total distances in km.
+    """
+    ids = [waypoint.id for waypoint in waypoints]
+    if len(waypoints) < 2:
+        return {"order": ids, "legs": [], "total_distance_km": 0.0}
+
+    dist = distance_matrix([w.latitude for w in waypoints], [w.longitude for w in waypoints])
+    tour = np.arange(len(waypoints))
+    if optimize:
+        deadline = time.monotonic() + time_budget
+        tour = two_opt(nearest_neighbour_tour(dist), dist, deadline)
+
+    leg_distances = dist[tour[:-1], tour[1:]]
+    legs = [
+        {"from": ids[a], "to": ids[b], "distance_km": round(float(km), 3)}
+        for a, b, km in zip(tour[:-1], tour[1:], leg_distances)
+    ]
+    return {
+        "order": [ids[position] for position in tour],
+        "legs": legs,
+        "total_distance_km": round(float(leg_distances.sum()), 3),
+    }
@@ -0,0 +1,12 @@
+from blinker import Namespace
+from flask import current_app
+
+_signals = Namespace()
+
+# Sent after a map write has been committed, with `map_id` and `op`
+# ("create", "update", "delete" or "rate"). In-process consumers (indexes,
+# caches) subscribe to it; other workers catch up through Map.updated_at.
+map_changed = _signals.signal('map-changed')
+
+def notify_map_changed(map_id, op):
+    map_changed.send(current_app._get_current_object(), map_id=map_id, op=op)
@@ -0,0 +1,220 @@
+import threading
+import time
+from datetime import timedelta
+import numpy as np
+from sqlalchemy import extract, or_
+from ..extensions import db
+from .geo import EARTH_RADIUS_KM, unit_vectors
+from .models import Map
+from .signals import map_changed
+
+# Weights of the individual similarity terms, each term is in [0, 1]
+TAG_WEIGHT = 3.0
+COUNTRY_WEIGHT = 2.0
+CITY_WEIGHT = 2.0
+PRICE_WEIGHT = 1.0
+DURATION_WEIGHT = 1.0
+DISTANCE_WEIGHT = 2.0
+DISTANCE_SCALE_KM = 500.0  # Centroids this far apart score 1/e on distance
+
+REFRESH_INTERVAL_SECONDS = 30
+# Rows whose updated_at is this close to the watermark are reloaded, covering
+# clock skew between app servers and transactions that committed late
+REFRESH_OVERLAP = timedelta(seconds=10)
+
+FAMILIES = ('tags', 'countries', 'cities')
+FAMILY_WEIGHTS = (TAG_WEIGHT, COUNTRY_WEIGHT, CITY_WEIGHT)
+
+class SimilarityIndex:
+    """
+    Per-worker feature matrix over every map, used to score "similar maps" with NumPy.
+
+    Numeric features (log price, log duration, bounding-box centre) live in flat arrays
+    indexed by row; tags, countries and cities are kept as inverted posting lists so the
+    overlap with the query map is a bincount over a handful of postings. The index is
+    loaded on first use and then refreshed incrementally from Map.updated_at, plus
+    immediately for writes handled by this worker (see `map_changed`).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._size = 0
+        self._rows = {}          # map id -> row
+        self._free_rows = []
+        self._row_tokens = {}    # row -> (tags, countries, cities) as frozensets
+        self._postings = tuple({} for _ in FAMILIES)        # token -> set of rows
+        self._posting_arrays = tuple({} for _ in FAMILIES)  # token -> cached np.ndarray of the set
+        self._ids = np.full(0, -1, dtype=np.int64)
+        self._active = np.zeros(0, dtype=bool)
+        self._log_price = np.zeros(0, dtype=np.float64)
+        self._log_duration = np.zeros(0, dtype=np.float64)
+        self._centres = np.full((0, 3), np.nan, dtype=np.float64)  # Bounding-box centre on the unit sphere, NaN without waypoints
+        self._token_counts = np.zeros((0, len(FAMILIES)), dtype=np.int32)
+        self._pending = set()
+        self._watermark = None
+        self._refreshed_at = None
+
+    def _grow(self, capacity):
+        def grow(array, fill):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+
+        self._ids = grow(self._ids, -1)
+        self._active = grow(self._active, False)
+        self._log_price = grow(self._log_price, 0.0)
+        self._log_duration = grow(self._log_duration, 0.0)
+        self._centres = grow(self._centres, np.nan)
+        self._token_counts = grow(self._token_counts, 0)
+
+    def _features_query(self):
+        return db.session.query(
+            Map.id, Map.tags, Map.countries, Map.cities, Map.price,
+            extract('epoch', Map.duration), Map.min_latitude, Map.max_latitude,
+            Map.min_longitude, Map.max_longitude, Map.updated_at,
+        )
+
+    def refresh(self, force=False):
+        """Loads maps changed since the last refresh. Throttled unless `force` or this worker wrote a map."""
+        with self._lock:
+            now = time.monotonic()
+            if (not force and not self._pending and self._refreshed_at is not None
+                    and now - self._refreshed_at < REFRESH_INTERVAL_SECONDS):
+                return
+
+            query = self._features_query()
+            pending = set(self._pending)
+            if self._watermark is not None:
+                changed = Map.updated_at >= self._watermark - REFRESH_OVERLAP
+                query = query.filter(or_(changed, Map.id.in_(pending)) if pending else changed)
+
+            loaded = set()
+            for row in query.all():
+                self._upsert(*row[:10])
+                loaded.add(row[0])
+                if row[10] is not None and (self._watermark is None or row[10] > self._watermark):
+                    self._watermark = row[10]
+
+            # Pending maps that no longer exist were deleted
+            for map_id in pending - loaded:
+                self.discard(map_id)
+            self._pending -= pending
+            self._refreshed_at = now
+
+    def mark_dirty(self, map_id):
+        with self._lock:
+            self._pending.add(map_id)
+
+    def discard(self, map_id):
+        with self._lock:
+            row = self._rows.pop(map_id, None)
+            if row is None:
+                return
+            self._unindex_tokens(row)
+            self._active[row] = False
+            self._ids[row] = -1
+            self._free_rows.append(row)
+
+    def upsert_map(self, map_):
+        with self._lock:
+            duration = map_.duration.total_seconds() if map_.duration else None
+            self._upsert(map_.id, map_.tags, map_.countries, map_.cities, map_.price, duration,
+                         map_.min_latitude, map_.max_latitude, map_.min_longitude, map_.max_longitude)
+
+    def _upsert(self, map_id, tags, countries, cities, price, duration_seconds,
+                min_latitude, max_latitude, min_longitude, max_longitude):
+        row = self._rows.get(map_id)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                if self._size == len(self._ids):
+                    self._grow(max(1024, len(self._ids) * 2))
+                row = self._size
+                self._size += 1
+            self._rows[map_id] = row
+        else:
+            self._unindex_tokens(row)
+
+        self._ids[row] = map_id
+        self._active[row] = True
+        self._log_price[row] = np.log1p(max(float(price or 0.0), 0.0))
+        self._log_duration[row] = np.log1p(max(float(duration_seconds or 0.0), 0.0) / 86400)
+        if None in (min_latitude, max_latitude, min_longitude, max_longitude):
+            self._centres[row] = np.nan
+        else:
+            self._centres[row] = unit_vectors((min_latitude + max_latitude) / 2, (min_longitude + max_longitude) / 2)
+
+        tokens = tuple(frozenset(values or ()) for values in (tags, countries, cities))
+        self._row_tokens[row] = tokens
+        for family, family_tokens in enumerate(tokens):
+            self._token_counts[row, family] = len(family_tokens)
+            for token in family_tokens:
+                self._postings[family].setdefault(token, set()).add(row)
+                self._posting_arrays[family].pop(token, None)
+
+    def _unindex_tokens(self, row):
+        for family, family_tokens in enumerate(self._row_tokens.pop(row, ())):
+            for token in family_tokens:
+                rows = self._postings[family].get(token)
+                if rows is not None:
+                    rows.discard(row)
+                    if not rows:
+                        del self._postings[family][token]
+                self._posting_arrays[family].pop(token, None)
+            self._token_counts[row, family] = 0
+
+    def _posting_array(self, family, token):
+        array = self._posting_arrays[family].get(token)
+        if array is None:
+            rows = self._postings[family].get(token, ())
+            array = np.fromiter(rows, dtype=np.int64, count=len(rows))
+            self._posting_arrays[family][token] = array
+        return array
+
+    def similar(self, map_, limit=10):
+        """Returns up to `limit` (map_id, score) pairs most similar to `map_`, best first."""
+        self.refresh()
+        with self._lock:
+            if map_.id not in self._rows:
+                self.upsert_map(map_)
+            row = self._rows[map_.id]
+            size = self._size
+            scores = np.zeros(size, dtype=np.float64)
+
+            # Jaccard overlap per token family, from the query map's posting lists only
+            for family, weight in enumerate(FAMILY_WEIGHTS):
+                tokens = self._row_tokens[row][family]
+                if not tokens:
+                    continue
+                postings = np.concatenate([self._posting_array(family, token) for token in tokens])
+                overlap = np.bincount(postings, minlength=size)[:size]
+                union = self._token_counts[:size, family] + len(tokens) - overlap
+                scores += weight * np.divide(overlap, union, out=np.zeros(size), where=union > 0)
+
+            scores += PRICE_WEIGHT * np.exp(-np.abs(self._log_price[:size] - self._log_price[row]))
+            scores += DURATION_WEIGHT * np.exp(-np.abs(self._log_duration[:size] - self._log_duration[row]))
+
+            if not np.isnan(self._centres[row, 0]):
+                cosines = np.clip(self._centres[:size] @ self._centres[row], -1.0, 1.0)
+                distances = EARTH_RADIUS_KM * np.arccos(cosines)
+                scores += DISTANCE_WEIGHT * np.nan_to_num(np.exp(-distances / DISTANCE_SCALE_KM), nan=0.0)
+
+            scores[~self._active[:size]] = -np.inf
+            scores[row] = -np.inf
+
+            candidates = min(limit, len(self._rows) - 1)
+            if candidates <= 0:
+                return []
+            top = np.argpartition(-scores, candidates - 1)[:candidates]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(int(self._ids[r]), float(scores[r])) for r in top if np.isfinite(scores[r])]
+
+similarity_index = SimilarityIndex()
+
+@map_changed.connect
+def _on_map_changed(sender, map_id, op):
+    if op == 'delete':
+        similarity_index.discard(map_id)
+    else:
+        similarity_index.mark_dirty(map_id)
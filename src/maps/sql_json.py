@@ -0,0 +1,155 @@
+from flask import Response, request, stream_with_context
+from sqlalchemy import BigInteger, Text, case, cast, extract, func, literal, or_, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Query
+from ..auth.models import User
+from ..config import ReadPathConfig
+from ..extensions import db
+from .models import Map, Rating, Waypoint
+
+# Alternative read path for the listing endpoints: Postgres renders every map
+# document with json_build_object/json_agg and the text is streamed as-is, so
+# no ORM objects or Python dicts are built. The documents decode to the same
+# JSON as Map.serialize() (Postgres prints integral floats as 10 instead of 10.0).
+
+def sql_json_enabled(endpoint=None, args=None):
+    """
+    Whether the endpoint (default: the current Flask one) should be rendered by Postgres.
+    `?render=sql|orm` in `args` (default: the request's) overrides the config.
+    """
+    render = (request.args if args is None else args).get('render')
+    if render in ('sql', 'orm'):
+        return render == 'sql'
+    return (request.endpoint if endpoint is None else endpoint) in ReadPathConfig.SQL_JSON_ENDPOINTS
+
+def _plural(value):
+    return case((value > 1, 's'), else_='')
+
+def _format_duration_sql(column):
+    """SQL twin of format_duration() for non-negative intervals."""
+    epoch = extract('epoch', column)
+    seconds = cast(func.floor(epoch), BigInteger)
+    days = cast(func.floor(seconds / 86400), BigInteger)
+    hours = cast(func.floor((seconds % 86400) / 3600), BigInteger)
+    minutes = cast(func.floor((seconds % 3600) / 60), BigInteger)
+
+    formatted = func.concat_ws(
+        ', ',
+        case((days > 0, cast(days, Text) + ' day' + _plural(days))),
+        case((hours > 0, cast(hours, Text) + ' hour' + _plural(hours))),
+        # str(timedelta) zero-pads minutes and format_duration keeps the padding
+        case((minutes > 0, func.lpad(cast(minutes, Text), 2, '0') + ' minute' + _plural(minutes))),
+    )
+    return case((or_(epoch.is_(None), epoch == 0), None), else_=formatted)
+
+def _isoformat_sql(column):
+    """SQL twin of datetime.isoformat() for naive timestamps."""
+    microseconds = func.to_char(column, 'US')
+    return func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS') + case(
+        (microseconds == '000000', ''), else_='.' + microseconds
+    )
+
+def _base64_sql(column):
+    # encode() wraps lines every 76 characters, base64.b64encode does not
+    return func.translate(func.encode(column, 'base64'), '\n', '')
+
+def waypoint_json():
+    """json_build_object twin of Waypoint.serialize()."""
+    return func.json_build_object(
+        'id', Waypoint.id,
+        'title', Waypoint.title,
+        'description', Waypoint.description,
+        'info', Waypoint.info,
+        'latitude', Waypoint.latitude,
+        'longitude', Waypoint.longitude,
+        'times_of_day', Waypoint.times_of_day,
+        'price', Waypoint.price,
+        'duration', _format_duration_sql(Waypoint.duration),
+        'image_data', _base64_sql(Waypoint.image_data),
+        'country', Waypoint.country,
+        'city', Waypoint.city,
+    )
+
+def rating_json():
+    """json_build_object twin of Rating.serialize(), null when the map has no rating."""
+    return case((Rating.id.is_(None), None), else_=func.json_build_object(
+        'id', Rating.id,
+        'average_rating', Rating.average_rating,
+        'num_ratings', Rating.num_ratings,
+    ))
+
+def user_json():
+    """json_build_object twin of User.serialize(), null when the creator is gone."""
+    return case((User.id.is_(None), None), else_=func.json_build_object(
+        'id', User.id,
+        'email', User.email,
+        'role', User.role,
+        'name', User.name,
+        'bio', User.bio,
+        'map_ids', func.to_json(User.map_ids),
+        'image_data', _base64_sql(User.image_data),
+        'alias', User.alias,
+    ))
+
+def map_json():
+    """json_build_object twin of Map.serialize(), with waypoints aggregated by a correlated subquery."""
+    waypoints = (
+        select(func.coalesce(
+            func.json_agg(aggregate_order_by(waypoint_json(), Waypoint.id)),
+            literal('[]').cast(db.JSON),
+        ))
+        .where(Waypoint.map_id == Map.id)
+        .scalar_subquery()
+    )
+    return func.json_build_object(
+        'id', Map.id,
+        'title', Map.title,
+        'description', Map.description,
+        'duration', _format_duration_sql(Map.duration),
+        'creator_id', Map.creator_id,
+        'created_at', _isoformat_sql(Map.created_at),
+        'rating', rating_json(),
+        'price', Map.price,
+        'view_count', Map.view_count,
+        'tags', func.to_json(Map.tags),
+        'countries', func.to_json(Map.countries),
+        'cities', func.to_json(Map.cities),
+        'waypoints', waypoints,
+        'image_data', _base64_sql(Map.image_data),
+        'creator', user_json(),
+    )
+
+def maps_json_statement(map_query, order_by=None):
+    """
+    One statement returning a serialized document (as text) per map selected by `map_query`,
+    in `order_by` order (ORDER BY clauses on Map columns) or by id.
+    """
+    # An ORM query on the Flask path, a select() on the async one
+    statement = map_query.statement if isinstance(map_query, Query) else map_query
+    map_ids = statement.with_only_columns(Map.id).subquery()
+    return (
+        select(cast(map_json(), Text))
+        .select_from(Map)
+        .outerjoin(Rating, Map.rating_id == Rating.id)
+        .outerjoin(User, Map.creator_id == User.id)
+        .where(Map.id.in_(select(map_ids.c.id)))
+        .order_by(*(order_by or [Map.id]))
+    )
+
+def maps_json_text(map_query, order_by=None):
+    """The JSON array of the maps selected by `map_query`, as one string."""
+    documents = db.session.execute(maps_json_statement(map_query, order_by)).scalars()
+    return '[' + ','.join(documents) + ']'
+
+def stream_maps_json(map_query, order_by=None):
+    """Streams the JSON array of the maps selected by `map_query` straight from a server-side cursor."""
+    statement = maps_json_statement(map_query, order_by).execution_options(stream_results=True)
+
+    def generate():
+        result = db.session.execute(statement)
+        yield '['
+        for idx, document in enumerate(result.scalars()):
+            yield document if idx == 0 else ',' + document
+        yield ']'
+
+    return Response(stream_with_context(generate()), status=200, mimetype='application/json')
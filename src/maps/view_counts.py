@@ -0,0 +1,101 @@
+import atexit
+import os
+import threading
+from ..config import ViewCountConfig
+from ..extensions import db, logger
+from .leaderboards import VIEW_WEIGHT, trending_points
+
+# Map views are counted in memory and written behind: each worker sums its views per map
+# and a background thread adds them to maps.view_count (and folds them into trending)
+# every FLUSH_SECONDS with one UPDATE ... FROM (VALUES ...) per batch of maps, instead of
+# a write to a hot row on every GET. A crash loses at most one interval of views.
+
+FLUSH_VIEWS_SQL = """
+    UPDATE maps SET
+        view_count = maps.view_count + v.views,
+        trending_score = CASE
+            WHEN maps.trending_score IS NULL THEN v.points
+            ELSE greatest(maps.trending_score, v.points) + ln(1 + exp(-abs(maps.trending_score - v.points)))
+        END
+    FROM (VALUES {values}) AS v(id, views, points)
+    WHERE maps.id = v.id
+"""
+FLUSH_BATCH_SIZE = 1000  # Maps per UPDATE
+
+class ViewCounter:
+    """Per-process buffer of view increments, flushed to the primary by a daemon thread."""
+
+    def __init__(self, flush_seconds, flush_pending_maps):
+        self.flush_seconds = flush_seconds
+        self.flush_pending_maps = flush_pending_maps
+        self.app = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def _start(self):
+        # Started on first use in each process, since a thread does not survive a fork
+        self._pid = os.getpid()
+        self._pending = {}
+        threading.Thread(target=self._run, name='view-count-flusher', daemon=True).start()
+        atexit.register(self.flush)
+
+    def record(self, map_id, views=1):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            self._pending[map_id] = self._pending.get(map_id, 0) + views
+            if len(self._pending) >= self.flush_pending_maps:
+                self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered views. Returns the number of maps updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending or self.app is None:
+            return 0
+
+        # Sorted so concurrent flushes from several workers lock the rows in the same order
+        items = sorted(pending.items())
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                for start in range(0, len(items), FLUSH_BATCH_SIZE):
+                    batch = items[start:start + FLUSH_BATCH_SIZE]
+                    params = {}
+                    for i, (map_id, views) in enumerate(batch):
+                        params[f"id_{i}"] = map_id
+                        params[f"views_{i}"] = views
+                        params[f"points_{i}"] = trending_points(VIEW_WEIGHT * views)
+                    values = ', '.join(f"(:id_{i}, :views_{i}, :points_{i})" for i in range(len(batch)))
+                    connection.execute(db.text(FLUSH_VIEWS_SQL.format(values=values)), params)
+        except Exception as e:
+            logger.error(f"Error flushing view counts for {len(items)} maps: {str(e)}")
+            # Kept for the next flush rather than lost
+            with self._lock:
+                for map_id, views in items:
+                    self._pending[map_id] = self._pending.get(map_id, 0) + views
+            return 0
+        return len(items)
+
+view_counter = ViewCounter(ViewCountConfig.FLUSH_SECONDS, ViewCountConfig.FLUSH_PENDING_MAPS)
+
+def init_view_counts(app):
+    view_counter.init_app(app)
+
+def creator_stats(maps):
+    """Totals over a creator's maps for their profile."""
+    return {
+        "maps": len(maps),
+        "views": sum(map_.view_count or 0 for map_ in maps),
+        "saves": sum(map_.save_count or 0 for map_ in maps),
+    }
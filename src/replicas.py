@@ -0,0 +1,191 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from .auth.identity import optional_user_id
+from .cache import LRUCache
+from .config import ReplicaConfig
+
+logger = logging.getLogger(__name__)
+
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+STICKY_COOKIE = 'read_primary_until'
+
+# Lag in seconds, 0 on a primary or a standby that has replayed everything it received
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+class ReplicaPool:
+    """
+    Engines for the read replicas, handed out round-robin among the healthy ones.
+
+    A replica is probed at most once per `health_check_interval` and is skipped until the
+    next probe when it is unreachable or lags by more than `max_lag` seconds. A connection
+    error while serving a query takes it out of rotation straight away, and connecting
+    gives up after `connect_timeout` seconds.
+    """
+
+    def __init__(self, urls, health_check_interval, max_lag, engine_options=None, connect_timeout=None):
+        self.health_check_interval = health_check_interval
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        engine_options = dict(engine_options or {})
+        if connect_timeout is not None:
+            engine_options['connect_args'] = {**engine_options.get('connect_args', {}), 'connect_timeout': connect_timeout}
+        self._engines = [create_engine(url, pool_pre_ping=True, **engine_options) for url in urls]
+        self._healthy = {engine: True for engine in self._engines}
+        self._checked_at = {engine: None for engine in self._engines}
+        self._round_robin = itertools.cycle(self._engines)
+        for engine in self._engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def __len__(self):
+        return len(self._engines)
+
+    def _on_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        with self._lock:
+            if self._healthy.get(engine):
+                logger.warning(f"Read replica {engine.url.host or engine.url.database} is down, reading from the primary")
+            self._healthy[engine] = False
+            self._checked_at[engine] = time.monotonic()
+
+    def _check(self, engine):
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(REPLICA_LAG_SQL).scalar()
+        except Exception as e:
+            logger.warning(f"Read replica health check failed: {e}")
+            return False
+        if lag > self.max_lag:
+            logger.warning(f"Read replica lags by {lag:.1f}s, reading from the primary")
+            return False
+        return True
+
+    def _is_healthy(self, engine):
+        now = time.monotonic()
+        with self._lock:
+            checked_at = self._checked_at[engine]
+            if checked_at is not None and now - checked_at < self.health_check_interval:
+                return self._healthy[engine]
+            # Claim the probe so concurrent requests keep using the previous verdict meanwhile
+            self._checked_at[engine] = now
+        healthy = self._check(engine)
+        with self._lock:
+            self._healthy[engine] = healthy
+        return healthy
+
+    def choose(self):
+        """Returns a healthy replica engine, or None when every replica is down."""
+        for _ in range(len(self._engines)):
+            with self._lock:
+                engine = next(self._round_robin)
+            if self._is_healthy(engine):
+                return engine
+        return None
+
+    def dispose(self):
+        for engine in self._engines:
+            engine.dispose()
+
+class RoutingSession(SignallingSession):
+    """
+    Session that sends the reads of a read-only request to the replica chosen for it.
+    Anything that flushes goes to the primary, and so does the rest of that request.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            if self._flushing:
+                g.read_replica = None
+            elif g.get('read_replica') is not None:
+                return g.read_replica
+        return super().get_bind(mapper, clause)
+
+@contextmanager
+def primary_reads():
+    """
+    Sends the reads inside the block to the primary. For filling caches shared with other
+    clients: a lagging replica would otherwise store a pre-write body under the version
+    the write just bumped, and serve it to everyone including the writer.
+    """
+    if not has_request_context():
+        yield
+        return
+    replica = g.get('read_replica')
+    g.read_replica = None
+    try:
+        yield
+    finally:
+        g.read_replica = replica
+
+# Per worker, users who wrote recently -> time until which they read from the primary
+_sticky_users = LRUCache(maxsize=100000, ttl=ReplicaConfig.STICKY_SECONDS)
+
+def _reads_from_primary():
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+            return True
+    except ValueError:
+        pass
+    user_id = optional_user_id()
+    return user_id is not None and _sticky_users.get(user_id) is not None
+
+def route_request():
+    """before_request hook: picks a replica for read-only requests outside their author's stickiness window."""
+    pool = current_app.extensions.get('replica_pool')
+    g.read_replica = None
+    if (pool is None or request.method not in READ_METHODS
+            or request.endpoint in ReplicaConfig.PRIMARY_ENDPOINTS or _reads_from_primary()):
+        return
+    g.read_replica = pool.choose()
+
+def stick_to_primary(response):
+    """after_request hook: after a successful write, the client reads from the primary for a while."""
+    if request.method in READ_METHODS or response.status_code >= 400:
+        return response
+    until = time.time() + ReplicaConfig.STICKY_SECONDS
+    user_id = optional_user_id()
+    if user_id is not None:
+        _sticky_users.set(user_id, until)
+    response.set_cookie(STICKY_COOKIE, f"{until:.0f}", max_age=ReplicaConfig.STICKY_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+def retry_on_primary(error):
+    """
+    errorhandler: a read whose replica failed mid-request is run again once, on the primary.
+    The replica is already out of rotation (ReplicaPool._on_error). Views that turn errors
+    into a response of their own never get here, and answer that request with their 500.
+    """
+    if request.method not in READ_METHODS or g.get('read_replica') is None or request.endpoint is None:
+        return current_app.handle_exception(error)
+    # Flask-SQLAlchemy's db, which imports this module for RoutingSession
+    current_app.extensions['sqlalchemy'].db.session.rollback()
+    g.read_replica = None
+    return current_app.make_response(current_app.view_functions[request.endpoint](**request.view_args))
+
+def init_replicas(app):
+    if not ReplicaConfig.REPLICA_URLS:
+        return
+    app.extensions['replica_pool'] = ReplicaPool(
+        ReplicaConfig.REPLICA_URLS,
+        health_check_interval=ReplicaConfig.HEALTH_CHECK_SECONDS,
+        max_lag=ReplicaConfig.MAX_LAG_SECONDS,
+        engine_options=app.config.get('SQLALCHEMY_ENGINE_OPTIONS'),
+        connect_timeout=ReplicaConfig.CONNECT_TIMEOUT_SECONDS,
+    )
+    app.before_request(route_request)
+    app.after_request(stick_to_primary)
+    app.register_error_handler(OperationalError, retry_on_primary)
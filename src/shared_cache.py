@@ -0,0 +1,178 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Entry header: global generation, key version, stored at (unix time)
+ENTRY_HEADER = struct.Struct('<qqd')
+# A worker sweeps after this many sets or after writing this fraction of max_bytes
+SWEEP_EVERY_SETS = 64
+SWEEP_EVERY_FRACTION = 1 / 16
+
+class SharedCache:
+    """
+    Byte-bounded cache shared by every worker process on the host.
+
+    Entries are files in `directory`, normally on tmpfs (/dev/shm) so they live in shared
+    memory, written atomically with a rename and evicted least recently used first once
+    they take more than `max_bytes`. Validity is tracked in a memory-mapped table of
+    versions: `invalidate(key_id)` bumps the version of its slot (ids share slots modulo
+    the table size, which only costs extra misses) and an entry stored under an older
+    version is never served. Take `version()` before reading the data being cached, so a
+    write that lands in between also invalidates the entry computed from the old data.
+    The table also counts hits and misses across the workers, for stats().
+    """
+
+    def __init__(self, name, directory, max_bytes, ttl=None, version_slots=65536):
+        self.directory = os.path.join(directory, name)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version_slots = version_slots
+        self.hits = 0
+        self.misses = 0
+        self._versions = None
+        self._sets = 0
+        self._written = 0
+        self._init_lock = threading.Lock()
+
+    def _table(self):
+        # Slot 0 holds the generation bumped by clear(), key ids use slots 1..version_slots,
+        # followed by the hit and miss counters
+        if self._versions is None:
+            with self._init_lock:
+                if self._versions is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    path = os.path.join(self.directory, 'versions')
+                    size = (self.version_slots + 3) * 8
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                    try:
+                        if os.fstat(fd).st_size < size:
+                            os.ftruncate(fd, size)
+                        self._mmap = mmap.mmap(fd, size)
+                    finally:
+                        os.close(fd)
+                    self._versions = memoryview(self._mmap).cast('q')
+        return self._versions
+
+    def _slot(self, key_id):
+        # crc32 rather than hash(), which is salted differently in every process
+        if not isinstance(key_id, int):
+            key_id = zlib.crc32(str(key_id).encode('utf-8'))
+        return 1 + key_id % self.version_slots
+
+    def version(self, key_id):
+        versions = self._table()
+        return versions[0], versions[self._slot(key_id)]
+
+    def invalidate(self, key_id):
+        # A fresh timestamp rather than an increment, so concurrent writers need no lock
+        self._table()[self._slot(key_id)] = time.time_ns()
+
+    def clear(self):
+        self._table()[0] = time.time_ns()
+
+    def _count(self, hit):
+        # Unlocked increments may lose a few counts when workers race, fine for a rate
+        versions = self._table()
+        slot = self.version_slots + (1 if hit else 2)
+        versions[slot] += 1
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        """Hits and misses of every worker of the host since the last reset_stats()."""
+        versions = self._table()
+        hits, misses = versions[self.version_slots + 1], versions[self.version_slots + 2]
+        return {"hits": hits, "misses": misses, "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None}
+
+    def reset_stats(self):
+        versions = self._table()
+        versions[self.version_slots + 1] = versions[self.version_slots + 2] = 0
+
+    def _path(self, key_id, variant):
+        digest = hashlib.sha1(f"{key_id}\0{variant}".encode('utf-8')).hexdigest()[:20]
+        return os.path.join(self.directory, f"{key_id}.{digest}")
+
+    def get(self, key_id, variant=''):
+        path = self._path(key_id, variant)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+        except FileNotFoundError:
+            self._count(False)
+            return None
+
+        generation, version, stored_at = ENTRY_HEADER.unpack_from(data)
+        if ((generation, version) != self.version(key_id)
+                or (self.ttl is not None and time.time() - stored_at > self.ttl)):
+            self._remove(path)
+            self._count(False)
+            return None
+
+        try:
+            os.utime(path)  # Recency for the LRU sweep
+        except FileNotFoundError:
+            pass
+        self._count(True)
+        return data[ENTRY_HEADER.size:]
+
+    def set(self, key_id, variant, value, version):
+        """Stores `value` (bytes) if `version`, taken before computing it, is still current."""
+        if len(value) + ENTRY_HEADER.size > self.max_bytes or version != self.version(key_id):
+            return
+        path = self._path(key_id, variant)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as entry:
+            entry.write(ENTRY_HEADER.pack(version[0], version[1], time.time()))
+            entry.write(value)
+        os.replace(tmp_path, path)
+
+        self._sets += 1
+        self._written += len(value)
+        if self._sets >= SWEEP_EVERY_SETS or self._written >= self.max_bytes * SWEEP_EVERY_FRACTION:
+            self._sets = self._written = 0
+            self.sweep()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def sweep(self):
+        """Evicts least recently used entries until the cache is back under 90% of `max_bytes`."""
+        with open(os.path.join(self.directory, 'sweep.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another worker is sweeping
+            entries, total = [], 0
+            with os.scandir(self.directory) as scan:
+                for dir_entry in scan:
+                    if dir_entry.name in ('versions', 'sweep.lock'):
+                        continue
+                    try:
+                        stat = dir_entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if dir_entry.name.endswith('.tmp'):
+                        # Left behind by a worker that died mid-write
+                        if time.time() - stat.st_mtime > 60:
+                            self._remove(dir_entry.path)
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * 0.9:
+                    break
+                self._remove(path)
+                total -= size
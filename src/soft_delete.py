@@ -0,0 +1,177 @@
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+from .auth.models import User
+from .cache import LRUCache
+from .config import PurgeConfig
+from .extensions import db, jwt
+from .maps.changes import record_map_change
+from .maps.clusters import remove_map_cells
+from .maps.models import Map
+from .maps.signals import notify_map_changed
+from .replicas import primary_reads
+
+# Deleting a map or an account only stamps deleted_at, which is a quick single-row write.
+# Every ORM select leaves stamped rows out (pass execution_options(include_deleted=True)
+# to see them), so they disappear from all read paths at once; raw SQL over maps has to
+# filter on deleted_at itself. The rows themselves, and the waypoint images that make up
+# most of their size, are removed later by purge_deleted() in small throttled batches.
+
+# Ids of deleted accounts, whose tokens are rejected. Only this verdict is cached: a cached
+# "live" would let another worker accept the token after the deletion, and create maps
+# that are never hidden or purged. Ids are not reused, so the verdict never goes stale.
+deleted_users = LRUCache(maxsize=10000)
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(execute_state):
+    if execute_state.is_select and not execute_state.execution_options.get('include_deleted', False):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(Map, Map.deleted_at.is_(None), include_aliases=True),
+            with_loader_criteria(User, User.deleted_at.is_(None), include_aliases=True),
+        )
+
+SOFT_DELETE_MAPS_SQL = db.text("""
+    UPDATE maps SET deleted_at = timezone('utc', now())
+    WHERE id = ANY(:map_ids) AND deleted_at IS NULL
+    RETURNING id
+""")
+
+def soft_delete_maps(map_ids):
+    """
+    Marks the maps deleted in the current transaction, takes them out of the clusters and
+    logs their tombstones. Returns the ids that were not already deleted; the caller sends
+    map_changed for them after committing.
+    """
+    map_ids = list(map_ids)
+    if not map_ids:
+        return []
+    deleted = sorted(db.session.execute(SOFT_DELETE_MAPS_SQL, {"map_ids": map_ids}).scalars())
+    remove_map_cells(deleted)
+    for map_id in deleted:
+        record_map_change(map_id, 'delete')
+    return deleted
+
+def soft_delete_user(user_id):
+    """Marks the account and all of its maps deleted. Returns the ids of the maps deleted, None if there is no such user."""
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    user.deleted_at = datetime.utcnow()
+    map_ids = [map_id for (map_id,) in db.session.query(Map.id).filter(Map.creator_id == user_id)]
+    deleted_users.set(user_id, True)
+    return soft_delete_maps(map_ids)
+
+# Waypoints go first, in batches of their own since they hold the images; a map is only
+# removed once it has none left, and an account once it has no maps left.
+PURGE_WAYPOINTS_SQL = db.text("""
+    DELETE FROM waypoints WHERE id IN (
+        SELECT w.id FROM maps m JOIN waypoints w ON w.map_id = m.id
+        WHERE m.deleted_at < :cutoff
+        LIMIT :limit
+    )
+""")
+
+PURGE_MAPS_SQL = db.text("""
+    WITH purged AS (
+        DELETE FROM maps WHERE id IN (
+            SELECT m.id FROM maps m
+            WHERE m.deleted_at < :cutoff AND NOT EXISTS (SELECT 1 FROM waypoints w WHERE w.map_id = m.id)
+            ORDER BY m.deleted_at
+            LIMIT :limit
+        )
+        RETURNING id, rating_id
+    ), ratings_purged AS (
+        DELETE FROM ratings WHERE id IN (SELECT rating_id FROM purged)
+    )
+    SELECT count(*) FROM purged
+""")
+
+PURGE_USERS_SQL = db.text("""
+    DELETE FROM users WHERE id IN (
+        SELECT u.id FROM users u
+        WHERE u.deleted_at < :cutoff AND NOT EXISTS (SELECT 1 FROM maps m WHERE m.creator_id = u.id)
+        ORDER BY u.deleted_at
+        LIMIT :limit
+    )
+""")
+
+def purge_deleted(grace_seconds=PurgeConfig.GRACE_SECONDS, map_batch_size=PurgeConfig.MAP_BATCH_SIZE,
+                  waypoint_batch_size=PurgeConfig.WAYPOINT_BATCH_SIZE, pause_seconds=PurgeConfig.PAUSE_SECONDS,
+                  max_seconds=None, progress=None):
+    """
+    Removes what was deleted more than `grace_seconds` ago, one committed batch at a time
+    with a pause after each full batch. Stops after `max_seconds` if given, a rerun picks
+    up where it left off. Returns the number of waypoints, maps and users removed.
+    """
+    # Maps created by a request that raced the deletion of their creator's account
+    orphaned = [
+        map_id for (map_id,) in db.session.query(Map.id).join(User, Map.creator_id == User.id)
+        .filter(User.deleted_at.isnot(None), Map.deleted_at.is_(None))
+        .execution_options(include_deleted=True)
+    ]
+    try:
+        orphaned = soft_delete_maps(orphaned)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for map_id in orphaned:
+        notify_map_changed(map_id, 'delete')
+
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    purged = {"waypoints": 0, "maps": 0, "users": 0}
+    phases = (
+        ("waypoints", PURGE_WAYPOINTS_SQL, waypoint_batch_size, lambda result: result.rowcount),
+        ("maps", PURGE_MAPS_SQL, map_batch_size, lambda result: result.scalar()),
+        ("users", PURGE_USERS_SQL, map_batch_size, lambda result: result.rowcount),
+    )
+    for kind, statement, batch_size, count in phases:
+        while True:
+            try:
+                removed = count(db.session.execute(statement, {"cutoff": cutoff, "limit": batch_size}))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            purged[kind] += removed
+            if progress and removed:
+                progress(kind, purged[kind])
+            if removed < batch_size:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return purged
+            time.sleep(pause_seconds)
+    return purged
+
+def _deleted_at(user_id):
+    """Whether the account is deleted, None when there is no such row (purged, or not replicated yet)."""
+    row = db.session.query(User.deleted_at).filter_by(id=user_id).execution_options(include_deleted=True).first()
+    return None if row is None else row.deleted_at is not None
+
+def token_of_deleted_user(jwt_payload):
+    """Whether the token's account is deleted. Needs an app context, and queries outside the cache."""
+    identity = jwt_payload.get(current_app.config['JWT_IDENTITY_CLAIM'])
+    user_id = identity.get('id') if isinstance(identity, dict) else None
+    if user_id is None:
+        return False
+    if deleted_users.get(user_id):
+        return True
+    # A primary key lookup per request with a token, on the request's replica if it has
+    # one. A missing row may just not have replicated yet, so the primary decides that.
+    deleted = _deleted_at(user_id)
+    if deleted is None:
+        with primary_reads():
+            deleted = _deleted_at(user_id)
+    if deleted is not False:
+        deleted_users.set(user_id, True)
+        return True
+    return False
+
+def init_soft_delete(app):
+    # The async read endpoints (asgi.py) call token_of_deleted_user themselves
+    @jwt.token_in_blocklist_loader
+    def blocklist_loader(jwt_header, jwt_payload):
+        return token_of_deleted_user(jwt_payload)
@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from ..maps.leaderboards import record_save
 from ..maps.models import Map
+from ..maps.sql_json import sql_json_enabled, stream_maps_json
 from ..extensions import db
 from .services import get_current_user
 
@@ -10,6 +12,8 @@ user_bp = Blueprint('users', __name__)
 @jwt_required()
 def get_profile():
     current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
     return jsonify(current_user.serialize()), 200
 
 @user_bp.route('/profile', methods=['PATCH'])
@@ -17,6 +21,8 @@ def get_profile():
 def update_profile():
     data = request.get_json()
     current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
 
     # Update profile fields
     current_user.name = data.get('name', current_user.name)
@@ -31,15 +37,19 @@ def save_map():
     data = request.get_json()
     map_id = data.get('map_id')
     current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
 
     # Check if map exists
     map_ = Map.query.get(map_id)
     if not map_:
         return jsonify({"error": "Map not found"}), 404
 
-    # Add map_id to user's saved maps if not already saved
-    if map_id not in current_user.map_ids:
-        current_user.map_ids.append(map_id)
+    # Add map_id to user's saved maps if not already saved. The array is reassigned, in-place changes are not tracked
+    saved_ids = current_user.map_ids or []
+    if map_id not in saved_ids:
+        current_user.map_ids = saved_ids + [map_id]
+        record_save(map_id, 1)
         db.session.commit()
         return jsonify({"message": "Map saved successfully"}), 200
     else:
@@ -49,17 +59,27 @@ def save_map():
 @jwt_required()
 def get_saved_maps():
     current_user = get_current_user()
-    saved_maps = Map.query.filter(Map.id.in_(current_user.map_ids)).all()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
+    saved_maps_query = Map.query.filter(Map.id.in_(current_user.map_ids or []))
+    if sql_json_enabled():
+        return stream_maps_json(saved_maps_query)
+
+    saved_maps = saved_maps_query.all()
     return jsonify([map.serialize() for map in saved_maps]), 200
 
 @user_bp.route('/saved-maps/<int:map_id>', methods=['DELETE'])
 @jwt_required()
 def remove_saved_map(map_id):
     current_user = get_current_user()
+    if current_user is None:
+        return jsonify({"error": "User not found"}), 404
 
     # Check if map_id is in user's saved maps
-    if map_id in current_user.map_ids:
-        current_user.map_ids.remove(map_id)
+    saved_ids = current_user.map_ids or []
+    if map_id in saved_ids:
+        current_user.map_ids = [saved_id for saved_id in saved_ids if saved_id != map_id]
+        record_save(map_id, -1)
         db.session.commit()
         return jsonify({"message": "Map removed from saved maps"}), 200
     else:
@@ -0,0 +1,117 @@
+import unittest
+from unittest import mock
+from src.admission import RateLimiter, TokenBucket, parse_rate_limits
+
+# Token buckets and rate limit rules of src/admission.py, on a fake clock. Needs no database.
+
+class FakeClock:
+    """Stands in for the time module in src.admission."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('src.admission.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_burst_then_retry_after(self):
+        bucket = TokenBucket(rate=2.0, capacity=3)
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        # Empty: the next token is 1 / rate away
+        self.assertAlmostEqual(bucket.take(), 0.5)
+        self.assertAlmostEqual(bucket.take(), 0.5)
+
+    def test_retry_after_counts_partial_refill(self):
+        bucket = TokenBucket(rate=2.0, capacity=1)
+        self.assertEqual(bucket.take(), 0)
+        self.clock.advance(0.2)
+        self.assertAlmostEqual(bucket.take(), 0.3)
+        self.clock.advance(0.3)
+        self.assertEqual(bucket.take(), 0)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=1.0, capacity=2)
+        bucket.take()
+        bucket.take()
+        self.clock.advance(1.0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertGreater(bucket.take(), 0)
+
+    def test_refill_capped_at_capacity(self):
+        bucket = TokenBucket(rate=10.0, capacity=2)
+        bucket.take()
+        self.clock.advance(3600)
+        self.assertEqual([bucket.take() for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.take(), 0.1)
+
+    def test_refused_requests_take_nothing(self):
+        bucket = TokenBucket(rate=1.0, capacity=1)
+        bucket.take()
+        for _ in range(5):
+            bucket.take()
+        self.clock.advance(1.0)
+        self.assertEqual(bucket.take(), 0)
+
+class ParseRateLimitsTest(unittest.TestCase):
+
+    def test_rate_and_burst(self):
+        self.assertEqual(parse_rate_limits({'maps': '120/60', 'auth': '20/10'}), {'maps': (2.0, 120), 'auth': (2.0, 20)})
+
+class RateLimiterTest(ClockTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.limiter = RateLimiter(parse_rate_limits({
+            'maps': '3/60',
+            'maps.get_all_maps_with_waypoints': '1/60',
+        }))
+
+    def test_unlimited_without_rule(self):
+        for _ in range(100):
+            self.assertEqual(self.limiter.check('ip:1', 'users.get_profile', 'users'), 0)
+
+    def test_blueprint_rule(self):
+        checks = [self.limiter.check('user:1', 'maps.get_map', 'maps') for _ in range(3)]
+        self.assertEqual(checks, [0, 0, 0])
+        # The blueprint's endpoints share one bucket
+        self.assertAlmostEqual(self.limiter.check('user:1', 'maps.get_map_route', 'maps'), 20.0)
+
+    def test_endpoint_rule_first(self):
+        self.assertEqual(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+        self.assertAlmostEqual(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 60.0)
+        # Its own bucket, the blueprint's is untouched
+        self.assertEqual(self.limiter.check('user:1', 'maps.get_map', 'maps'), 0)
+
+    def test_clients_kept_apart(self):
+        self.assertEqual(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+        self.assertGreater(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+        self.assertEqual(self.limiter.check('user:2', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+        self.assertEqual(self.limiter.check('ip:10.0.0.1', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+
+    def test_retry_after_shrinks_then_admits(self):
+        self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps')
+        self.clock.advance(45)
+        self.assertAlmostEqual(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 15.0)
+        self.clock.advance(15)
+        self.assertEqual(self.limiter.check('user:1', 'maps.get_all_maps_with_waypoints', 'maps'), 0)
+
+    def test_evicted_bucket_starts_full(self):
+        limiter = RateLimiter(parse_rate_limits({'maps': '1/60'}), max_clients=1)
+        self.assertEqual(limiter.check('user:1', 'maps.get_map', 'maps'), 0)
+        self.assertEqual(limiter.check('user:2', 'maps.get_map', 'maps'), 0)
+        self.assertEqual(limiter.check('user:1', 'maps.get_map', 'maps'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
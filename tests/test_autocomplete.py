@@ -0,0 +1,121 @@
+import unittest
+from werkzeug.datastructures import MultiDict
+from src.maps.autocomplete import (
+    MAX_PREFIX_LENGTH, MAX_SUGGESTIONS, RANKED_CACHE_MIN_RANGE, PrefixIndex, normalize, parse_autocomplete_params,
+)
+
+# The in-memory prefix index behind /autocomplete (src/maps/autocomplete.py). Needs no database.
+
+def values(results):
+    return [result["value"] for result in results]
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def assertConsistent(self, index):
+        # _keys is the sorted (normalized, value) list of exactly the counted values
+        self.assertEqual(index._keys, sorted((normalize(value), value) for value in index.counts))
+        self.assertTrue(all(count > 0 for count in index.counts.values()))
+
+    def test_add_and_remove(self):
+        index = PrefixIndex()
+        index.add('Paris', 1)
+        index.add('Paris', 2)
+        index.add('Lyon', 1)
+        self.assertEqual(index.counts, {'Paris': 3, 'Lyon': 1})
+        index.add('Paris', -1)
+        self.assertEqual(index.counts, {'Paris': 2, 'Lyon': 1})
+        self.assertConsistent(index)
+
+    def test_count_zero_leaves_keys(self):
+        index = PrefixIndex({'Paris': 1, 'Parma': 2})
+        index.add('Paris', -1)
+        self.assertNotIn('Paris', index.counts)
+        self.assertEqual(index._keys, [('parma', 'Parma')])
+        self.assertEqual(values(index.search('par', 10)), ['Parma'])
+        # Removing what is not there, or going below zero, keeps nothing around
+        index.add('Nice', -1)
+        index.add('Parma', -5)
+        self.assertEqual(index.counts, {})
+        self.assertEqual(index._keys, [])
+
+    def test_initial_counts_drop_non_positive(self):
+        index = PrefixIndex({'a': 1, 'b': 0, 'c': -2})
+        self.assertEqual(index.counts, {'a': 1})
+        self.assertConsistent(index)
+
+    def test_readd_after_removal(self):
+        index = PrefixIndex({'Rome': 1})
+        index.add('Rome', -1)
+        index.add('Rome', 1)
+        self.assertEqual(index._keys, [('rome', 'Rome')])
+        self.assertEqual(index.search('ro', 10), [{"value": "Rome", "count": 1}])
+
+    def test_accent_and_case_insensitive(self):
+        index = PrefixIndex({'São Paulo': 2, 'Sapporo': 1, 'Straße': 1, 'ÉCOLE': 1})
+        self.assertEqual(values(index.search('sao', 10)), ['São Paulo'])
+        self.assertEqual(values(index.search('SÃO P', 10)), ['São Paulo'])
+        self.assertEqual(values(index.search('sa', 10)), ['São Paulo', 'Sapporo'])
+        self.assertEqual(values(index.search('strass', 10)), ['Straße'])
+        self.assertEqual(values(index.search('ecole', 10)), ['ÉCOLE'])
+
+    def test_same_normalized_form_kept_apart(self):
+        index = PrefixIndex({'Cafe': 1, 'Café': 3})
+        self.assertEqual(index.search('caf', 10), [{"value": "Café", "count": 3}, {"value": "Cafe", "count": 1}])
+        index.add('Café', -3)
+        self.assertEqual(index.search('caf', 10), [{"value": "Cafe", "count": 1}])
+
+    def test_prefix_range_upper_bound(self):
+        # Everything after the prefix sorts below prefix + U+10FFFF, including astral characters
+        index = PrefixIndex({'ab': 1, 'ab\U0001f600': 1, 'ab\U0010fffe': 1, 'abz': 1, 'aa': 1, 'ac': 1, 'b': 1})
+        self.assertEqual(sorted(values(index.search('ab', 20))), sorted(['ab', 'ab\U0001f600', 'ab\U0010fffe', 'abz']))
+        self.assertEqual(values(index.search('ac', 20)), ['ac'])
+        self.assertEqual(values(index.search('abc', 20)), [])
+
+    def test_empty_prefix_matches_everything(self):
+        index = PrefixIndex({'x': 1, 'y': 2})
+        self.assertEqual(values(index.search('', 10)), ['y', 'x'])
+
+    def test_ranking_and_limit(self):
+        index = PrefixIndex({'Paris': 5, 'Parma': 5, 'Pau': 9, 'Perth': 1})
+        # Most used first, ties in normalized order
+        self.assertEqual(values(index.search('p', 10)), ['Pau', 'Paris', 'Parma', 'Perth'])
+        self.assertEqual(values(index.search('p', 2)), ['Pau', 'Paris'])
+
+    def test_ranked_cache_cleared_by_add(self):
+        index = PrefixIndex({f'tag{i:04d}': 1 for i in range(RANKED_CACHE_MIN_RANGE + 1)})
+        self.assertEqual(len(index.search('tag', MAX_SUGGESTIONS)), MAX_SUGGESTIONS)
+        self.assertIsNotNone(index._ranked.get('tag'))
+        index.add('tag0500', 10)
+        self.assertEqual(index.search('tag', 1), [{"value": "tag0500", "count": 10}])
+
+class ParseAutocompleteParamsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(parse_autocomplete_params(MultiDict({'kind': 'tag'})), ('tag', '', 10))
+
+    def test_values(self):
+        args = MultiDict({'kind': 'city', 'prefix': 'São', 'limit': '20'})
+        self.assertEqual(parse_autocomplete_params(args), ('city', 'São', 20))
+
+    def test_kind(self):
+        for kind in (None, '', 'Tag', 'title'):
+            with self.subTest(kind=kind):
+                args = MultiDict({'kind': kind} if kind is not None else {})
+                with self.assertRaisesRegex(ValueError, 'kind must be one of tag, country, city, alias'):
+                    parse_autocomplete_params(args)
+
+    def test_prefix_length(self):
+        self.assertEqual(parse_autocomplete_params(MultiDict({'kind': 'alias', 'prefix': 'a' * MAX_PREFIX_LENGTH}))[1],
+                         'a' * MAX_PREFIX_LENGTH)
+        with self.assertRaisesRegex(ValueError, 'prefix must be at most'):
+            parse_autocomplete_params(MultiDict({'kind': 'alias', 'prefix': 'a' * (MAX_PREFIX_LENGTH + 1)}))
+
+    def test_limit(self):
+        for limit in ('0', '21', '-1', 'ten', '', '2.5'):
+            with self.subTest(limit=limit):
+                with self.assertRaisesRegex(ValueError, 'limit must be between 1 and 20'):
+                    parse_autocomplete_params(MultiDict({'kind': 'tag', 'limit': limit}))
+        self.assertEqual(parse_autocomplete_params(MultiDict({'kind': 'tag', 'limit': '1'}))[2], 1)
+
+if __name__ == '__main__':
+    unittest.main()
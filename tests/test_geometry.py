@@ -0,0 +1,85 @@
+import struct
+import unittest
+from src.maps.geometry import encode_polyline, pack_records, polyline_payload, scaled_deltas
+
+# The compact route formats of src/maps/geometry.py. Needs no database.
+
+# The example of https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+GOOGLE_POINTS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+def decode_polyline(polyline, precision):
+    values, value, shift = [], 0, 0
+    for char in polyline:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    points, latitude, longitude = [], 0, 0
+    for delta_latitude, delta_longitude in zip(values[::2], values[1::2]):
+        latitude += delta_latitude
+        longitude += delta_longitude
+        points.append((latitude / 10 ** precision, longitude / 10 ** precision))
+    return points
+
+class PolylineTest(unittest.TestCase):
+
+    def test_google_example(self):
+        self.assertEqual(encode_polyline(GOOGLE_POINTS), '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_precision_6(self):
+        polyline = encode_polyline(GOOGLE_POINTS, precision=6)
+        self.assertEqual(polyline, '_izlhA~rlgdF_{geC~ywl@_kwzCn`{nI')
+        self.assertEqual(decode_polyline(polyline, 6), GOOGLE_POINTS)
+
+    def test_round_trip(self):
+        points = [(0.0, 0.0), (-0.00001, 0.00001), (89.99999, -179.99999), (-90.0, 180.0), (1.000004, 1.000006)]
+        decoded = decode_polyline(encode_polyline(points), 5)
+        for (latitude, longitude), (expected_latitude, expected_longitude) in zip(decoded, points):
+            self.assertAlmostEqual(latitude, expected_latitude, places=5)
+            self.assertAlmostEqual(longitude, expected_longitude, places=5)
+
+    def test_empty_map(self):
+        self.assertEqual(encode_polyline([]), '')
+        self.assertEqual(scaled_deltas([], 5).shape, (0, 2))
+        self.assertEqual(polyline_payload({}, [4], 5), [{"map_id": 4, "polyline": ''}])
+
+class ScaledDeltasTest(unittest.TestCase):
+
+    def test_first_point_relative_to_origin(self):
+        self.assertEqual(
+            scaled_deltas(GOOGLE_POINTS, 5).tolist(),
+            [[3850000, -12020000], [220000, -75000], [255200, -550300]],
+        )
+
+    def test_rounding(self):
+        # 0.29 * 10^5 is 28999.999999999996, which truncation would turn into 28999
+        self.assertEqual(scaled_deltas([(0.29, -0.29)], 5).tolist(), [[29000, -29000]])
+        self.assertEqual(scaled_deltas([(0.57, 0.0000014)], 6).tolist(), [[570000, 1]])
+
+class PackRecordsTest(unittest.TestCase):
+
+    def unpack(self, payload):
+        self.assertEqual(len(payload) % 4, 0)
+        return list(struct.unpack(f'<{len(payload) // 4}i', payload))
+
+    def test_record_layout(self):
+        # map_id, point count, then the lat, lng delta pairs, as little-endian int32
+        payload = pack_records({7: GOOGLE_POINTS[:2], 3: [(-1.5, 2.25)]}, [3, 7], 5)
+        self.assertEqual(self.unpack(payload), [
+            3, 1, -150000, 225000,
+            7, 2, 3850000, -12020000, 220000, -75000,
+        ])
+
+    def test_precision_6_fits_int32(self):
+        payload = pack_records({1: [(-90.0, 180.0), (90.0, -180.0)]}, [1], 6)
+        self.assertEqual(self.unpack(payload), [1, 2, -90000000, 180000000, 180000000, -360000000])
+
+    def test_empty_map(self):
+        # Requested maps without waypoints keep their place with a count of 0
+        self.assertEqual(self.unpack(pack_records({5: [(1.0, 1.0)]}, [9, 5], 5)), [9, 0, 5, 1, 100000, 100000])
+        self.assertEqual(pack_records({}, [], 5), b'')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import unittest
+from datetime import datetime, timedelta
+
+# The Postgres-rendered listings (src/maps/sql_json.py) have to decode to the same JSON as
+# Map.serialize(). Fixture maps are written in a transaction that is rolled back, so the
+# test can run against a development database: DATABASE_URL=... python -m unittest discover tests
+
+PNG = bytes.fromhex('89504e470d0a1a0a') + bytes(range(256))  # Long enough for base64 line wrapping
+
+def normalize(value):
+    # Postgres prints integral floats as 10 where Python prints 10.0, the one documented difference
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize(item) for item in value]
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL'), "needs DATABASE_URL")
+class SqlJsonParityTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from src import create_app
+        cls.app = create_app()
+
+    def setUp(self):
+        from src.extensions import db
+        self.db = db
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.db.session.rollback()
+        self.context.pop()
+
+    def add_fixture_maps(self):
+        from src.auth.models import User
+        from src.maps.models import Map, Rating, Waypoint
+        creator = User(email='parity@example.com', password='x', role='traveler', name='Parity', bio='Bio',
+                       alias='parity-fixture', image_data=PNG, map_ids=[3, 1])
+        full = Map(
+            title='Full', description='Every field set', duration=timedelta(days=1, hours=2, minutes=5),
+            creator=creator, rating=Rating(average_rating=4.25, num_ratings=4), tags=['food', 'wine'],
+            image_data=PNG, price=12.5, created_at=datetime(2024, 5, 6, 7, 8, 9, 123456),
+            countries=['France'], cities=['Paris', 'Lyon'], view_count=7,
+        )
+        full.waypoints = [
+            Waypoint(title='A', description='First', info='Info', latitude=48.8566, longitude=2.3522,
+                     times_of_day={'morning': True, 'hours': [9, 10]}, price=10.0, duration=timedelta(minutes=90),
+                     image_data=PNG, country='France', city='Paris'),
+            Waypoint(title='B', latitude=-33.5, longitude=151.25, price=0.5, duration=timedelta(days=2)),
+            Waypoint(title='C', latitude=0.0, longitude=0.0, price=None, duration=timedelta(0)),
+        ]
+        bare = Map(title='Bare', created_at=datetime(2024, 1, 1), price=10.0, tags=None)
+        self.db.session.add_all([full, bare])
+        self.db.session.flush()
+        return [full.id, bare.id]
+
+    def test_sql_documents_match_serialize(self):
+        from src.maps.models import Map
+        from src.maps.sql_json import maps_json_text
+        map_ids = self.add_fixture_maps()
+        # Reload, so serialize() sees the values as stored rather than as constructed
+        self.db.session.expire_all()
+        query = Map.query.filter(Map.id.in_(map_ids))
+
+        rendered = json.loads(maps_json_text(query))
+        serialized = json.loads(self.app.json.dumps([map_.serialize() for map_ in query.order_by(Map.id)]))
+        self.assertEqual(len(rendered), len(map_ids))
+        for sql_map, orm_map in zip(rendered, serialized):
+            self.assertEqual(normalize(sql_map), normalize(orm_map))
+
+if __name__ == '__main__':
+    unittest.main()